@@ -1,22 +1,44 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request, stream_with_context
 import json
-from app import app, data_manager  # Import the Flask app instance
+from app import app, data_manager, library_cache  # Import the Flask app instance
 from flask_login import current_user, login_required, login_user, logout_user
-from datamanager.SQLite_data_manager import SQLiteDataManager, Status
+from datamanager.SQLite_data_manager import SQLiteDataManager, Status, PAGE_SIZE, REVIEWS_PAGE_SIZE
 from datamanager.database import Movie
+from datamanager.serializer import dumps, row_to_dict, movie_to_dict
+from datamanager.bulk_import import ImportBudgetExceeded, MAX_REQUEST_ITEMS, TooManyItems, parse_items, summarize
+from datamanager.export import ndjson_chunks, gzip_chunks
+from datamanager.fragment_cache import library_etag
+from datamanager import instrumentation
 
 import jsonpickle
 import random
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')  # Create a Blueprint for the API routes
 
+# Answer of POST /api/user/<id> by add_new_movie status
+ADD_STATUS = {Status.ALREADY_ADDED: 'Error. Already in the library', Status.NOT_FOUND: 'Error. Not found',
+              Status.RATE_LIMITED: 'Error. Too many requests', Status.OK: 'OK'}
+
+
+def add_status_code(status):
+    """HTTP status of an add_new_movie answer: 429 over the OMDb limit or the user's budget"""
+    return 429 if status == Status.RATE_LIMITED else 200
+
+
+def json_response(data):
+    """JSON response of plain data (dicts/lists of column values), serialized with the fast serializer"""
+    return Response(dumps(data), mimetype='application/json')
+
 
 @api_bp.route('/')
 def index():
     """ Route for the API index page. Returns a random movie's data as a JSON response.
+        With ?n=<number> returns a list of n distinct random movies.
         """
-    random_movie = data_manager.get_user_movies(0)
-    return random_movie[0].to_dict()
+    n = request.args.get('n', type=int)
+    if n is None:
+        return json_response(data_manager.random_movies_rows()[0])
+    return json_response(data_manager.random_movies_rows(max(1, min(n, 50))))
 
 
 # Define a route to get user's movies data as JSON
@@ -24,21 +46,58 @@ def index():
 def user_movies(id: int, sort: int = 0):
     """ Route to get user's movies data as JSON or add a new movie to the user's library.
         If the request method is POST, it adds a new movie to the user's library.
-        If the request method is GET, it retrieves the user's movies data as JSON.
+        If the request method is GET, it retrieves one page of the user's movies data as JSON:
+        {"movies": [...], "next_page": token or null}. Query parameters: sort (0-4), limit, page (token).
         """
     if request.method == 'POST':
         new_movie = request.get_json()
-        print(new_movie['title'])
         status = data_manager.add_new_movie(id, new_movie['title'])
-        if status == Status.ALREADY_ADDED:
-            return jsonify({'Status': 'Error. Already in the library'})
-        elif status == Status.NOT_FOUND:
-            return jsonify({'Status': 'Error. Not found'})
-        elif status == Status.OK:
-            return jsonify({'Status': 'OK'})
+        return jsonify({'Status': ADD_STATUS[status]}), add_status_code(status)
     else:
-        user_movies = data_manager.get_user_movies(id, sort)[::-1] if sort == 0 else data_manager.get_user_movies(id, sort)
-        return json.dumps(user_movies, default=lambda x: x.to_dict())
+        sort = request.args.get('sort', default=sort, type=int)
+        limit = request.args.get('limit', default=PAGE_SIZE, type=int)
+        page = request.args.get('page')
+        # the body only changes with the library version: ETag + cached body
+        version = data_manager.library_version(id)
+        etag = library_etag(id, version, 'api', sort, limit, page)
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+
+        def render():
+            user_movies, next_page = data_manager.get_user_movies_rows(id, sort, page, limit)
+            return dumps({'movies': user_movies, 'next_page': next_page})
+        try:
+            body = library_cache.get((id, version, 'api', sort, limit, page), render)
+        except ValueError:
+            return jsonify({'Status': 'Error. Invalid page token'}), 400
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+@api_bp.route('/user/<int:id>/import', methods=['POST'])
+def import_movies(id: int):
+    """ Route to add many movies to the user's library at once.
+        Body: JSON list of titles/imdbIDs (or objects with "title"/"imdbID"), or CSV with Content-Type text/csv.
+        Returns the summary and the status of every item, 413 above MAX_REQUEST_ITEMS items (import_library.py
+        takes larger files), or 429 if the movies missing from the catalog are more than the OMDb lookups left in
+        the user's daily budget (nothing is imported).
+        """
+    content_type = 'csv' if request.mimetype in ('text/csv', 'application/csv') else 'json'
+    try:
+        items = parse_items(request.get_data(), content_type, MAX_REQUEST_ITEMS)
+    except TooManyItems as error:
+        return jsonify({'Status': 'Error. ' + str(error) + ', use import_library.py for larger imports'}), 413
+    except ValueError as error:
+        return jsonify({'Status': 'Error. ' + str(error)}), 400
+    try:
+        report = data_manager.bulk_add_movies(id, items)
+    except ImportBudgetExceeded as error:
+        return jsonify({'Status': 'Error. ' + str(error)}), 429
+    return json_response({'Status': 'OK', 'summary': summarize(report), 'items': report})
 
 
 @api_bp.route('/user/<int:id>/update/<int:movie_id>', methods=['POST'])
@@ -54,7 +113,6 @@ def update_movies(id: int, movie_id: int):
     notes_upd = update_movie['notes'] if update_movie['notes'] is not None else movie_data.notes
 
     notes = movie_data.get('notes', "")
-    print(type(movie_data))
     # Check if the rating might be converted to float
     try:
         float(rating_upd)
@@ -84,6 +142,142 @@ def delete_movies_from_db(movie_id: int):
         return jsonify({'Status': 'OK'})
 
 
+@api_bp.route('/search', methods=['GET'])
+def search_movies():
+    """ Route to search movies by title, director and plot. Query parameters: q (words, prefixes work: "matr"),
+        limit (default 20, max 100), fuzzy (1 by default, 0 disables typo tolerant matching).
+        """
+    query = request.args.get('q', default='')
+    limit = request.args.get('limit', default=20, type=int)
+    fuzzy = request.args.get('fuzzy', default='1') != '0'
+    return json_response(data_manager.search_movies(query, max(1, min(limit, 100)), fuzzy))
+
+
+@api_bp.route('/movie/<int:movie_id>/similar', methods=['GET'])
+def similar_movies(movie_id: int):
+    """ Route to get the movies most similar to a movie by title, director and plot (content index).
+        Query parameter: k (number of movies, default 10, max 50).
+        """
+    k = request.args.get('k', default=10, type=int)
+    similar = data_manager.similar_movies(movie_id, max(1, min(k, 50)))
+    if similar == Status.NOT_FOUND:
+        return jsonify({'Status': 'Error. Not found'}), 404
+    return json_response(similar)
+
+
+@api_bp.route('/movie/<int:movie_id>/reviews', methods=['GET'])
+def movie_reviews(movie_id: int):
+    """ Route to get one page of the reviews of a movie as JSON, newest first:
+        {"reviews": [...], "next_page": token or null}. Query parameters: limit, page (token).
+        """
+    limit = request.args.get('limit', default=REVIEWS_PAGE_SIZE, type=int)
+    try:
+        reviews, next_page = data_manager.get_reviews_page(movie_id, request.args.get('page'), limit)
+    except ValueError:
+        return jsonify({'Status': 'Error. Invalid page token'}), 400
+    return json_response({'reviews': [row_to_dict(review) for review in reviews], 'next_page': next_page})
+
+
+@api_bp.route('/movie/<int:movie_id>/stats', methods=['GET'])
+def movie_review_stats(movie_id: int):
+    """ Route to get the community rating of a movie: review count, rating mean, histogram of the ratings (1 to 10)
+        and date of the latest review.
+        """
+    return json_response(data_manager.review_stats(movie_id))
+
+
+@api_bp.route('/movie/<int:movie_id>/recommendations', methods=['GET', 'POST'])
+def movie_recommendations(movie_id: int):
+    """ Route to get the recommended movies of a movie as JSON: {"Status": "OK", "movies": [...]}, or
+        {"Status": "PENDING"} (202) while the recommendation worker computes them. POST asks for new ones.
+        Under asgi.py the same route computes missing recommendations inside the request.
+        A POST of a logged in user counts against the user's chat-gpt budget (429 when it is spent).
+        """
+    if request.method == 'POST':
+        user_id = int(current_user.id) if current_user.is_authenticated else None
+        status = data_manager.recommend_new_movies(movie_id, user_id=user_id)
+        if status != Status.OK:
+            return recommendations_response(status)
+    return recommendations_response(data_manager.recommended_movies(movie_id))
+
+
+@api_bp.route('/usage', methods=['GET'])
+def upstream_usage():
+    """ Route to get the OMDb/OpenAI usage of a day: requests and prompt/completion tokens per upstream and user.
+        Query parameters: day (YYYY-MM-DD, default today), user (user id, 0: requests of no user).
+        """
+    return json_response(data_manager.upstream_usage(request.args.get('day'), request.args.get('user', type=int)))
+
+
+def recommendations_body(result):
+    """(JSON data, HTTP status) of a recommended_movies result: list of Movie objects or Status"""
+    if result == Status.NOT_FOUND:
+        return {'Status': 'Error. Not found'}, 404
+    if result == Status.PENDING:
+        return {'Status': 'PENDING'}, 202
+    if result == Status.FAILED:
+        return {'Status': 'Error. No recommendations found, POST to try again'}, 404
+    if result == Status.RATE_LIMITED:
+        return {'Status': 'Error. Too many requests'}, 429
+    return {'Status': 'OK', 'movies': [movie_to_dict(movie) for movie in result]}, 200
+
+
+def recommendations_response(result):
+    data, status = recommendations_body(result)
+    return Response(dumps(data), status=status, mimetype='application/json')
+
+
+def export_response(rows, name: str):
+    """Streaming NDJSON response of rows (generator), gzip compressed with ?gzip=1"""
+    chunks = ndjson_chunks(rows)
+    if request.args.get('gzip') == '1':
+        return Response(stream_with_context(gzip_chunks(chunks)), mimetype='application/gzip',
+                        headers={'Content-Disposition': f'attachment; filename={name}.ndjson.gz'})
+    return Response(stream_with_context(chunks), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': f'attachment; filename={name}.ndjson'})
+
+
+@api_bp.route('/export/user/<int:id>', methods=['GET'])
+def export_user_movies(id: int):
+    """
+    Route to export a user's library as NDJSON (one movie per line, user rating/notes merged). ?gzip=1 compresses.
+    """
+    return export_response(data_manager.export_rows('library', id), f'user_{id}_movies')
+
+
+@api_bp.route('/export/reviews', methods=['GET'])
+def export_reviews():
+    """
+    Route to export all reviews as NDJSON. ?gzip=1 compresses.
+    """
+    return export_response(data_manager.export_rows('reviews'), 'reviews')
+
+
+@api_bp.route('/export/movies', methods=['GET'])
+def export_movies():
+    """
+    Route to export the whole movies table as NDJSON. ?gzip=1 compresses.
+    """
+    return export_response(data_manager.export_rows('movies'), 'movies')
+
+
+@api_bp.route('/pool', methods=['GET'])
+def pool_stats():
+    """
+    Route to get the database connection pool statistics (checked out / checked in connections).
+    """
+    return jsonify(data_manager.pool_stats())
+
+
+@api_bp.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Route to get the timers of the instrumentation (INSTRUMENTATION=1): count and p50/p95/p99 of every data manager
+    method, SQL statement, OMDb/chat-gpt call, template and route, and the timings of the last requests.
+    """
+    return json_response(instrumentation.snapshot())
+
+
 # Register the Blueprint with the Flask app
 app.register_blueprint(api_bp)
 
@@ -1,6 +1,11 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import Flask, render_template, request, redirect, url_for, flash, session, make_response
+from markupsafe import Markup
 from os import getenv
 from datamanager.SQLite_data_manager import *
+from datamanager.database import DATABASE_URL
+from datamanager.user_cache import UserCache, SQLiteInvalidationLog
+from datamanager.fragment_cache import FragmentCache, library_etag
+from datamanager import instrumentation
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import LoginManager, current_user, login_required, login_user, logout_user
 from datetime import date
@@ -8,21 +13,34 @@ from datetime import date
 app = Flask(__name__)
 # Set the SECRET_KEY for your Flask app, use getenv to provide a default value if not set
 app.config["SECRET_KEY"] = getenv("SECRET_KEY", default="secret_key_example")
-# Define the database path
-db_path = 'sqlite:////Users/anastasyabolshem/PycharmProjects/masterschool/movies_107.3/datamanager/movies.sqlite'
+# Define the database path (DATABASE_URL, see datamanager/database.py)
+db_path = DATABASE_URL
 # Initialize the data manager with the database path
 app.config['SQLALCHEMY_DATABASE_URI'] = db_path
-data_manager = SQLiteDataManager(db_path)
+# RECOMMENDER=local uses the item-item recommender, RECOMMENDER=content the plot similarity index (no chat-gpt calls
+# except for movies they know nothing about), default gpt
+data_manager = SQLiteDataManager(db_path, recommender=getenv("RECOMMENDER", default="gpt"))
+# One data manager session per request, closed (and rolled back on error) when the request ends
+data_manager.init_app(app)
+# INSTRUMENTATION=1 times data manager methods, SQL, OMDb/chat-gpt calls and templates (see /api/metrics)
+instrumentation.install(app, data_manager)
 # Initialize the login manager for Flask-Login
 login_manager = LoginManager(app)
 # Initialize the database
 db.init_app(app)
 
 
+# Cache of logged in users, shared invalidations between worker processes. Changes of User rows invalidate it
+user_cache = UserCache(backend=SQLiteInvalidationLog())
+user_cache.watch(User)
+# Rendered movie grids of library pages, keyed by user, library version, sort (path) and page
+library_cache = FragmentCache()
+
+
 @login_manager.user_loader
 def load_user(user_id: str):
-    """User loader function for Flask-Login to load a user given the user_id"""
-    return User.get(user_id)
+    """User loader function for Flask-Login to load a user given the user_id (cached, see user_cache.py)"""
+    return user_cache.get(int(user_id), User.get)
 
 
 # INDEX PAGE
@@ -104,13 +122,10 @@ def logout():
 def user_movies(id: int, sort: int = 0):
     """Route for the user's main page and adding a new movie. Get the user's movies from the data manager
     If the user ID doesn't match the current user's ID, render an error page with 403 status code
-    Using Status object (enum) for statuses of added movies. Sort used for sorting movies on the page"""
+    Using Status object (enum) for statuses of added movies. Sort used for sorting movies on the page.
+    The movie grid is cached per library version (see library_page), repeat views cost one version lookup"""
     if id != int(current_user.id):
         return render_template('error.html', error=403, username=current_user.username, user_id=current_user.id), 403
-    # Without sorting movie that was just added will be appear first ([::-1])
-    user_movies = data_manager.get_user_movies(id, sort)[::-1] if sort == 0 else data_manager.get_user_movies(id, sort)
-    if len(user_movies) == 0:
-        user_movies = None
     if request.method == "POST":
         new_movie = request.form['title']
         status = data_manager.add_new_movie(int(current_user.id), new_movie)
@@ -120,12 +135,44 @@ def user_movies(id: int, sort: int = 0):
         elif status == Status.NOT_FOUND:
             flash('Movie not found. Please try again')
             return redirect(request.url)
+        elif status == Status.RATE_LIMITED:
+            flash('Too many requests. Please try again later')
+            return redirect(request.url)
         elif status == Status.OK:
             flash('Added')
             return redirect(request.url)
     else:
-        return render_template('users_movie.html', username=current_user.username, movies=user_movies,
-                               user_id=current_user.id)
+        return library_page(id, sort)
+
+
+def library_page(id: int, sort: int):
+    """Render the library page of a user with the cached movie grid.
+    The ETag is the library version: a browser with an up to date page gets 304 (unless a message is flashed)"""
+    page = request.args.get('page')
+    version = data_manager.library_version(id)
+    etag = library_etag(id, version, request.path, page)
+    has_flashes = bool(session.get('_flashes'))
+    if not has_flashes and request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    def render_grid():
+        # Without sorting movie that was just added will be appear first. One page per request, ?page=<token>
+        try:
+            user_movies, next_page = data_manager.get_user_movies_page(id, sort, page)
+        except ValueError:
+            user_movies, next_page = data_manager.get_user_movies_page(id, sort)
+        return Markup(render_template('movie_grid.html', movies=user_movies or None, user_id=id,
+                                      next_page=next_page))
+    grid = library_cache.get((id, version, request.path, page), render_grid)
+    response = make_response(render_template('users_movie.html', username=current_user.username, grid=grid,
+                                             user_id=current_user.id))
+    if not has_flashes:
+        response.set_etag(etag, weak=True)
+    # the browser revalidates the page every time (the library can change in another tab)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 # UPDATE
@@ -196,7 +243,8 @@ def review(id: int, movie_id: int):
     """ Route for adding and displaying movie reviews.
     If the user ID doesn't match the current user's ID, render an error page with 403 status code
      Checks if movie exists (if not: error 404) and renders the reviews.html template with movie details and
-     existing reviews (Review object), or adds a new review if a POST request is received."""
+     one page of the existing reviews (?page=<token> for the next ones), or adds a new review if a POST request
+     is received."""
     if id != int(current_user.id):
         return render_template('error.html', error=403, username=current_user.username, user_id=current_user.id), 403
     movie_data = data_manager.movie_info(int(current_user.id), movie_id)
@@ -221,11 +269,15 @@ def review(id: int, movie_id: int):
             flash('Please try again')
             return redirect(request.url)
     else:
-        # Display existing reviews for the movie
-        reviews = data_manager.get_reviews(movie_id)
+        # Display one page of the existing reviews for the movie, newest first
+        try:
+            reviews, next_page = data_manager.get_reviews_page(movie_id, request.args.get('page'))
+        except ValueError:
+            reviews, next_page = data_manager.get_reviews_page(movie_id)
+        stats = data_manager.review_stats(movie_id)
         return render_template('reviews.html', user_id=current_user.id, username=current_user.username,
                                movie_id=movie_id, title=title, director=director, year=year, rating=rating,
-                               img=img, imdbID=imdbID, reviews=reviews)
+                               img=img, imdbID=imdbID, reviews=reviews, next_page=next_page, stats=stats)
 
 
 # SORT
@@ -247,6 +299,7 @@ def recommend_movie(id: int, rec: int):
     Route for displaying recommended movies based on a selected movie title using data_manager.recommended_movies.
     Renders the recommended.html template with recommended movies (2 or 3 objects. There are 3 recommendations,
     But chat gpt sometimes send the requested movie as a recomended. In that case template doesn't add it (by imdbID).
+    Recommendations are precomputed by recommend_worker.py, if they are not ready the page shows a pending state.
     """
     if id != int(current_user.id):
         return render_template('error.html', error=403, username=current_user.username, user_id=current_user.id), 403
@@ -254,6 +307,13 @@ def recommend_movie(id: int, rec: int):
     recommended_movies = data_manager.recommended_movies(rec)
     if recommended_movies == Status.NOT_FOUND:
         return render_template('error.html', error=404, username=current_user.username, user_id=current_user.id), 404
+    if recommended_movies == Status.PENDING:
+        return render_template('recommended.html', username=current_user.username, movies=None, pending=True,
+                               user_id=current_user.id, current_movie=current_movie_data)
+    if recommended_movies == Status.FAILED:
+        # the worker gave up: no refresh, "Regenerate Recommendations" tries again
+        return render_template('recommended.html', username=current_user.username, movies=None, failed=True,
+                               user_id=current_user.id, current_movie=current_movie_data), 404
     return render_template('recommended.html', username=current_user.username, movies=recommended_movies,
                            user_id=current_user.id, current_movie=current_movie_data)
 
@@ -261,17 +321,19 @@ def recommend_movie(id: int, rec: int):
 @app.route("/user/<int:id>/new_rec/<int:movie_id>", methods=["POST", "GET"])
 @login_required
 def new_rec_movie(id: int, movie_id: int):
-    """ Almost identical to reccomend movie. But recommend_new_movie resets the reccomendation data first, and uses a
-    bit different request to open_ai to avoid using saved requests"""
+    """ Regenerate recommendations. recommend_new_movie resets the reccomendation data and queues a job that uses a
+    bit different request to open_ai to avoid using saved requests. Redirects to the recommend page (pending state)
+    Every regeneration counts against the user's chat-gpt budget (see datamanager/rate_limit.py)"""
     if id != int(current_user.id):
         return render_template('error.html', error=403, username=current_user.username, user_id=current_user.id), 403
-    current_movie_data = data_manager.movie_info_by_id(movie_id)
-    new_rec = data_manager.recommend_new_movies(movie_id)
+    new_rec = data_manager.recommend_new_movies(movie_id, user_id=id)
     if new_rec == Status.NOT_FOUND:
         return render_template('error.html', error=404, username=current_user.username, user_id=current_user.id), 404
-
-    return render_template('recommended.html', username=current_user.username, movies=new_rec,
-                           user_id=current_user.id, current_movie=current_movie_data)
+    if new_rec == Status.RATE_LIMITED:
+        # the user's chat-gpt budget is spent, the current recommendations stay
+        flash('Too many requests. Please try again later')
+    # New recommendations are computed in the background, the recommend page shows them when ready
+    return redirect(url_for('recommend_movie', id=current_user.id, rec=movie_id))
 
 
 @app.route("/user/<int:id>/add/<int:movie_id>", methods=["POST", "GET"])
@@ -0,0 +1,120 @@
+"""ASGI entry point of the app, e.g.:
+    uvicorn asgi:application --port 5002
+
+The JSON routes that wait for OMDb or chat-gpt run on the event loop with the async methods of the data manager:
+    POST /api/user/<id>                          add_new_movie_async
+    GET  /api/movie/<id>/recommendations         recommended_movies_async (computed inside the request)
+    POST /api/movie/<id>/recommendations         recommend_new_movies_async (charged to the logged in user)
+A request waiting for an upstream answer holds no thread, so one process serves hundreds of them.
+Every other route is the Flask app (WSGI), run in a thread pool by asgiref. app.py keeps working as before.
+"""
+import json
+import re
+from flask_login import current_user
+from api import app, data_manager, ADD_STATUS, add_status_code, recommendations_body
+from datamanager import instrumentation
+from datamanager.data_manager_interface import Status
+from datamanager.serializer import dumps
+
+# asgiref is optional: only needed to serve the app with an ASGI server
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    WsgiToAsgi = None
+
+if WsgiToAsgi is None:
+    raise RuntimeError("The ASGI deployment needs asgiref (pip install asgiref)")
+flask_application = WsgiToAsgi(app)
+
+
+async def read_json(receive):
+    """Read the request body and decode it as JSON (None if it isn't valid)"""
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+async def send_json(send, data, status: int = 200):
+    body = dumps(data).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def request_user_id(scope):
+    """Id of the user logged in with the session cookie of the request (current_user of the Flask routes, loaded
+    by the app's user_loader), None for anonymous requests"""
+    headers = [(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope.get('headers', [])]
+    with app.test_request_context(scope['path'], method=scope['method'], headers=headers):
+        return int(current_user.id) if current_user.is_authenticated else None
+
+
+async def add_movie(scope, receive, send, user_id: int):
+    new_movie = await read_json(receive)
+    if not isinstance(new_movie, dict) or not isinstance(new_movie.get('title'), str):
+        await send_json(send, {'Status': 'Error. Missing title'}, 400)
+        return
+    status = await data_manager.add_new_movie_async(user_id, new_movie['title'])
+    await send_json(send, {'Status': ADD_STATUS[status]}, add_status_code(status))
+
+
+async def recommendations(scope, receive, send, movie_id: int):
+    await send_json(send, *recommendations_body(await data_manager.recommended_movies_async(movie_id)))
+
+
+async def new_recommendations(scope, receive, send, movie_id: int):
+    # the user's chat-gpt budget, as the WSGI route (api.movie_recommendations)
+    status = await data_manager.recommend_new_movies_async(movie_id, user_id=request_user_id(scope))
+    if status != Status.OK:
+        await send_json(send, *recommendations_body(status))
+        return
+    await recommendations(scope, receive, send, movie_id)
+
+
+# (method, path pattern, handler(scope, receive, send, id))
+ROUTES = [
+    ('POST', re.compile(r'^/api/user/(\d+)$'), add_movie),
+    ('GET', re.compile(r'^/api/movie/(\d+)/recommendations$'), recommendations),
+    ('POST', re.compile(r'^/api/movie/(\d+)/recommendations$'), new_recommendations),
+]
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await data_manager.omdb.close_async()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGI application: async routes on the event loop, the rest to the Flask app"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] == 'http':
+        for method, pattern, handler in ROUTES:
+            match = pattern.match(scope['path'])
+            if match and scope['method'] == method:
+                # concurrent requests share the event loop thread: timed, not sampled by the profiler
+                token = instrumentation.begin_request(f"{method} {pattern.pattern}", profile=False) \
+                    if instrumentation.ENABLED else None
+                try:
+                    await handler(scope, receive, send, int(match.group(1)))
+                finally:
+                    # the session of this request (asyncio task), as Flask does at the end of a request
+                    data_manager.close_session()
+                    if token is not None:
+                        instrumentation.end_request(token, profile=False)
+                return
+    await flask_application(scope, receive, send)
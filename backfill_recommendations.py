@@ -0,0 +1,59 @@
+"""Fill Movie.recomend1..3 for the whole catalog with batched GPT requests (gpt_recomendation_batch),
+a fraction of the cost and time of one request per movie.
+
+Usage:
+    python backfill_recommendations.py [--batch 20] [--db sqlite:///...]
+"""
+import argparse
+import time
+from datamanager.SQLite_data_manager import SQLiteDataManager
+from datamanager import gpt
+from datamanager.database import DATABASE_URL
+from datamanager.rate_limit import RateLimited
+
+# Longest wait for the 'openai' rate limit, the backfill stops (rerun it later) when it would wait longer
+MAX_WAIT = 120
+
+
+def backfill(data_manager: SQLiteDataManager, batch_size: int = gpt.BATCH_SIZE, client=None,
+             max_wait: float = MAX_WAIT):
+    """Compute and store recommendations of every movie without them, batch_size movies per GPT request.
+    Over the rate limit the backfill waits for it (up to max_wait seconds, otherwise it stops) and retries the
+    movies the batch didn't reach. Returns the number of updated movies"""
+    movies = data_manager.movies_without_recommendations()
+    remaining = list(movies)
+    updated = 0
+    while remaining:
+        chunk = remaining[:batch_size]
+        titles = [title for movie_id, title in chunk]
+        try:
+            recommendations, limited = gpt.gpt_recomendation_batch(titles, client=client, partial=False), None
+        except RateLimited as error:
+            recommendations, limited = error.results, error
+        by_movie = {movie_id: recommendations[title] for movie_id, title in chunk if title in recommendations}
+        updated += data_manager.save_recommendations(by_movie)
+        data_manager.close_session()
+        if limited is None:
+            remaining = remaining[len(chunk):]
+        else:
+            remaining = [movie for movie in remaining if movie[0] not in by_movie]
+        print(f"{len(movies) - len(remaining)}/{len(movies)} movies processed, {updated} updated")
+        if limited is not None:
+            if limited.retry_after > max_wait:
+                print(f"Stopped: {limited}. Run the backfill again later for the {len(remaining)} other movies")
+                break
+            time.sleep(limited.retry_after)
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill movie recommendations with batched GPT requests")
+    parser.add_argument("--batch", type=int, default=gpt.BATCH_SIZE, help="movies per GPT request")
+    parser.add_argument("--db", default=DATABASE_URL, help="database url")
+    args = parser.parse_args()
+    gpt.BATCH_SIZE = args.batch
+    backfill(SQLiteDataManager(args.db), args.batch)
+
+
+if __name__ == '__main__':
+    main()
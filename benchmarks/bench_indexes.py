@@ -0,0 +1,93 @@
+"""Benchmark: query plans and latency of the data manager's lookups before and after the schema migrations.
+
+Usage:
+    python -m benchmarks.bench_indexes [--user-movies 1000000] [--movies 100000] [--reviews 200000]
+
+Builds a temporary database with the original schema (no indexes) and synthetic data, prints
+EXPLAIN QUERY PLAN and mean latency of each query, runs datamanager.migrations.migrate() and prints them again.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from sqlalchemy import create_engine
+from datamanager.migrations import migrate
+
+# Schema of datamanager/movies.sqlite before the migrations
+BASE_SCHEMA = [
+    'CREATE TABLE user_data (user_id INTEGER NOT NULL PRIMARY KEY, username VARCHAR, email VARCHAR, password VARCHAR)',
+    'CREATE TABLE movies (movie_id INTEGER NOT NULL PRIMARY KEY, title VARCHAR(50), director VARCHAR, year VARCHAR, '
+    'rating FLOAT, img VARCHAR, "imdbID" VARCHAR, plot VARCHAR, notes TEXT, recomend1 TEXT, recomend2 TEXT, '
+    'recomend3 TEXT)',
+    'CREATE TABLE user_movies (row_id INTEGER NOT NULL PRIMARY KEY, user_id INTEGER, movie_id INTEGER, '
+    'user_notes TEXT, user_rating FLOAT)',
+    'CREATE TABLE reviews (review_id INTEGER NOT NULL PRIMARY KEY, user_id INTEGER, movie_id INTEGER, '
+    'review_title VARCHAR, review_text TEXT, review_rating FLOAT, review_date DATETIME)',
+]
+
+# (name, sql, parameters) - the queries behind add_new_movie, movie_by_imdbID, get_user_movies, movie_info,
+# get_reviews_page
+QUERIES = [
+    ("add_new_movie (title)", 'SELECT movie_id FROM movies WHERE title = ?', ("Movie 4242",)),
+    ("movie_by_imdbID", 'SELECT movie_id FROM movies WHERE "imdbID" = ?', ("tt0004242",)),
+    ("get_user_movies", 'SELECT movies.*, user_movies.user_rating FROM movies JOIN user_movies '
+                        'ON movies.movie_id = user_movies.movie_id WHERE user_movies.user_id = ?', (77,)),
+    ("movie_info", 'SELECT movies.*, user_movies.user_rating FROM movies JOIN user_movies '
+                   'ON movies.movie_id = user_movies.movie_id WHERE user_movies.user_id = ? AND movies.movie_id = ?',
+     (77, 4242)),
+    ("get_reviews_page", 'SELECT review_id, review_title, review_text, review_rating, user_id, review_date '
+                         'FROM reviews WHERE movie_id = ? ORDER BY review_date DESC, review_id DESC LIMIT 21',
+     (4242,)),
+]
+
+
+def make_db(movies: int, user_movies: int, reviews: int):
+    """Create a temporary database with the original schema and synthetic rows, returns the engine"""
+    engine = create_engine("sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.sqlite"))
+    users = max(1, user_movies // 100)
+    rnd = random.Random(1)
+    with engine.begin() as conn:
+        for statement in BASE_SCHEMA:
+            conn.exec_driver_sql(statement)
+        conn.exec_driver_sql('INSERT INTO movies (movie_id, title, "imdbID", year, rating) VALUES (?, ?, ?, ?, ?)',
+                             [(i, f"Movie {i}", f"tt{i:07d}", str(1950 + i % 70), i % 100 / 10)
+                              for i in range(movies)])
+        # every user has 100 distinct movies
+        conn.exec_driver_sql('INSERT INTO user_movies (user_id, movie_id) VALUES (?, ?)',
+                             [(user, movie) for user in range(users) for movie in rnd.sample(range(movies), 100)])
+        conn.exec_driver_sql('INSERT INTO reviews (user_id, movie_id, review_rating, review_date) VALUES (?, ?, ?, ?)',
+                             [(rnd.randrange(users), rnd.randrange(movies), rnd.randrange(10),
+                               f"2023-{rnd.randrange(1, 13):02d}-{rnd.randrange(1, 29):02d}") for _ in range(reviews)])
+    return engine
+
+
+def report(engine, title: str, repeat: int = 20):
+    """Print the query plan and mean latency of every query"""
+    print(f"\n== {title} ==")
+    with engine.connect() as conn:
+        for name, sql, params in QUERIES:
+            plan = [row[-1] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql, params)]
+            start = time.perf_counter()
+            for _ in range(repeat):
+                conn.exec_driver_sql(sql, params).fetchall()
+            ms = (time.perf_counter() - start) / repeat * 1000
+            print(f"{name:<24} {ms:>9.3f} ms   " + " | ".join(plan))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--movies", type=int, default=100000)
+    parser.add_argument("--user-movies", type=int, default=1000000)
+    parser.add_argument("--reviews", type=int, default=200000)
+    args = parser.parse_args()
+    engine = make_db(args.movies, args.user_movies, args.reviews)
+    report(engine, "before migrations")
+    start = time.perf_counter()
+    migrate(engine)
+    print(f"\nmigrate(): {time.perf_counter() - start:.1f} s")
+    report(engine, "after migrations")
+
+
+if __name__ == '__main__':
+    main()
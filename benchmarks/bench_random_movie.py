@@ -0,0 +1,56 @@
+"""Benchmark: random movie for the index page, ORDER BY random() vs RandomMovieSampler.
+
+Usage:
+    python -m benchmarks.bench_random_movie [--sizes 1000 10000 100000 1000000]
+
+Builds a temporary movies table per size and prints the mean latency per call. The sampler's first call
+(loading the id array) is reported separately, it happens once per REFRESH_INTERVAL or after an add/delete.
+"""
+import argparse
+import os
+import tempfile
+import time
+from sqlalchemy import create_engine, func, insert
+from sqlalchemy.orm import sessionmaker
+from datamanager.database import Movie
+from datamanager.random_sampler import RandomMovieSampler
+
+
+def make_db(size: int):
+    """Create a temporary database with `size` movies, returns a session factory"""
+    path = os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+    engine = create_engine("sqlite:///" + path)
+    Movie.__table__.create(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(Movie), [{'title': f"Movie {i}", 'year': str(1950 + i % 70), 'rating': i % 100 / 10,
+                                      'imdbID': f"tt{i:07d}"} for i in range(size)])
+    return sessionmaker(bind=engine)
+
+
+def timed(function, repeat: int):
+    """Mean milliseconds per call"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    args = parser.parse_args()
+    print(f"{'movies':>10} {'order_by random() ms':>22} {'sampler ms':>12} {'sampler n=10 ms':>16} {'id load ms':>12}")
+    for size in args.sizes:
+        Session = make_db(size)
+        session = Session()
+        sampler = RandomMovieSampler()
+        order_by_random = timed(lambda: session.query(Movie).order_by(func.random()).first(), 5)
+        load = timed(lambda: sampler.sample(session), 1)
+        sampled = timed(lambda: sampler.sample(session), 500)
+        sampled_10 = timed(lambda: sampler.sample(session, 10), 500)
+        print(f"{size:>10} {order_by_random:>22.3f} {sampled:>12.3f} {sampled_10:>16.3f} {load:>12.3f}")
+        session.close()
+
+
+if __name__ == '__main__':
+    main()
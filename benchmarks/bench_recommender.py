@@ -0,0 +1,46 @@
+"""Benchmark: build time and query latency of the local item-item recommender (datamanager/recommender.py).
+
+Usage:
+    python -m benchmarks.bench_recommender [--movies 20000] [--user-movies 200000] [--repeat 1000]
+
+Every synthetic user has 100 random movies (see bench_indexes.make_db).
+"""
+import argparse
+import random
+import time
+from benchmarks.bench_indexes import make_db
+from datamanager.database import Movie
+from datamanager.migrations import migrate
+from datamanager.SQLite_data_manager import SQLiteDataManager
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--movies", type=int, default=20000)
+    parser.add_argument("--user-movies", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=1000)
+    args = parser.parse_args()
+    engine = make_db(movies=args.movies, user_movies=args.user_movies, reviews=args.user_movies // 10)
+    migrate(engine)
+    data_manager = SQLiteDataManager(str(engine.url), recommender='local')
+    recommender = data_manager.recommender
+
+    start = time.perf_counter()
+    recommender.similar(0)
+    print(f"build:     {(time.perf_counter() - start) * 1000:9.1f} ms "
+          f"({len(recommender._state[2])} co-occurrence entries)")
+
+    session = data_manager.Session()
+    movies = session.query(Movie).filter(Movie.id.in_(random.sample(range(args.movies), 100))).all()
+    start = time.perf_counter()
+    for i in range(args.repeat):
+        recommender.similar(movies[i % len(movies)].id)
+    print(f"similar:   {(time.perf_counter() - start) / args.repeat * 1000:9.3f} ms")
+    start = time.perf_counter()
+    for i in range(args.repeat):
+        recommender.recommend(session, movies[i % len(movies)])
+    print(f"recommend: {(time.perf_counter() - start) / args.repeat * 1000:9.3f} ms (with the imdbID lookup)")
+
+
+if __name__ == '__main__':
+    main()
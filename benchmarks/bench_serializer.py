@@ -0,0 +1,65 @@
+"""Benchmark: JSON of a 10k-movie library (all pages), ORM objects + SerializerMixin.to_dict() vs the column-only
+Core select + serializer.dumps (orjson when installed).
+
+Usage:
+    python -m benchmarks.bench_serializer [--movies 10000] [--repeat 5]
+
+The ORM path uses to_dict(rules=('-user_movies',)): the plain to_dict() follows Movie.user_movies ->
+UserMovie.user and fails on User, which has no SerializerMixin.
+"""
+import argparse
+import json
+import time
+from benchmarks.bench_indexes import make_db
+from datamanager.migrations import migrate
+from datamanager.serializer import dumps, orjson
+from datamanager.SQLite_data_manager import SQLiteDataManager, MAX_PAGE_SIZE
+
+
+def timed(function, repeat: int):
+    """Mean milliseconds per call"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--movies", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    # make_db gives every user 100 movies: one more user owning the whole catalog is the big library
+    engine = make_db(movies=args.movies, user_movies=100, reviews=1)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO user_movies (user_id, movie_id) SELECT 999, movie_id FROM movies")
+    migrate(engine)
+    data_manager = SQLiteDataManager(str(engine.url))
+
+    def orm_path():
+        """Every page of the library as ORM objects, serialized with to_dict()"""
+        bodies, cursor = [], None
+        while True:
+            movies, cursor = data_manager.get_user_movies_page(999, 0, cursor, MAX_PAGE_SIZE)
+            bodies.append(json.dumps(movies, default=lambda x: x.to_dict(rules=('-user_movies',))))
+            data_manager.close_session()
+            if cursor is None:
+                return bodies
+
+    def core_path():
+        """Every page of the library as column rows, serialized with dumps()"""
+        bodies, cursor = [], None
+        while True:
+            rows, cursor = data_manager.get_user_movies_rows(999, 0, cursor, MAX_PAGE_SIZE)
+            bodies.append(dumps(rows))
+            data_manager.close_session()
+            if cursor is None:
+                return bodies
+
+    print(f"{args.movies} movies in {len(core_path())} pages, orjson: {'yes' if orjson else 'no'}")
+    print(f"ORM + to_dict:      {timed(orm_path, args.repeat):9.1f} ms")
+    print(f"Core select + dumps: {timed(core_path, args.repeat):9.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
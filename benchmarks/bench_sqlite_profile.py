@@ -0,0 +1,80 @@
+"""Load test: read throughput of get_user_movies_page with 1..N reader processes while one process keeps writing,
+with SQLite defaults (rollback journal) vs the data manager's SQLiteProfile (WAL, read/write engine split).
+
+Usage:
+    python -m benchmarks.bench_sqlite_profile [--workers 1 2 4 8] [--seconds 3]
+"""
+import argparse
+import random
+import time
+from multiprocessing import Process, Queue
+from sqlalchemy.exc import OperationalError
+from benchmarks.bench_indexes import make_db
+from datamanager.migrations import migrate
+from datamanager.sqlite_profile import SQLiteProfile, DEFAULT_PROFILE
+from datamanager.SQLite_data_manager import SQLiteDataManager
+
+# Approximation of the settings before the profile: rollback journal, pysqlite's default timeout, no tuning
+DEFAULTS = SQLiteProfile(journal_mode='DELETE', synchronous='FULL', busy_timeout=5000, cache_size=-2000,
+                         mmap_size=0, temp_store='DEFAULT')
+USERS = 1000
+
+
+def reader(url: str, profile: SQLiteProfile, seconds: float, results: Queue):
+    data_manager = SQLiteDataManager(url, profile=profile)
+    reads = errors = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        try:
+            data_manager.get_user_movies_page(random.randrange(USERS), random.randrange(5))
+            reads += 1
+        except OperationalError:
+            errors += 1
+        data_manager.close_session()
+    results.put((reads, errors))
+
+
+def writer(url: str, profile: SQLiteProfile, seconds: float):
+    data_manager = SQLiteDataManager(url, profile=profile)
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        try:
+            data_manager.movie_update(random.randrange(USERS), random.randrange(1000), "7.5", "bench")
+        except OperationalError:
+            pass
+        data_manager.close_session()
+
+
+def run(url: str, profile: SQLiteProfile, workers: int, seconds: float):
+    """Returns (reads per second, locked errors)"""
+    results = Queue()
+    processes = [Process(target=reader, args=(url, profile, seconds, results)) for _ in range(workers)]
+    processes.append(Process(target=writer, args=(url, profile, seconds)))
+    for process in processes:
+        process.start()
+    counts = [results.get() for _ in range(workers)]
+    for process in processes:
+        process.join()
+    return sum(reads for reads, errors in counts) / seconds, sum(errors for reads, errors in counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--seconds", type=float, default=3)
+    args = parser.parse_args()
+    print(f"{'profile':<10} {'readers':>8} {'reads/s':>10} {'errors':>8}")
+    for name, profile in (("defaults", DEFAULTS), ("profile", DEFAULT_PROFILE)):
+        engine = make_db(movies=10000, user_movies=USERS * 100, reviews=1000)
+        migrate(engine)
+        url = str(engine.url)
+        engine.dispose()
+        # creates the data manager's own tables before the processes start
+        SQLiteDataManager(url, profile=profile)
+        for workers in args.workers:
+            reads, errors = run(url, profile, workers, args.seconds)
+            print(f"{name:<10} {workers:>8} {reads:>10.0f} {errors:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,81 +1,524 @@
-from sqlalchemy import create_engine, update, func
-from sqlalchemy.orm import sessionmaker
+import asyncio
+import base64
+import json
+import threading
+import random
+from sqlalchemy import update, func, tuple_, select, text, table, column, literal, type_coerce, String, case
+from sqlalchemy.exc import IntegrityError
+from openai.error import OpenAIError
+from sqlalchemy.dialects.sqlite import insert
+from flask import has_app_context, g
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm.attributes import set_committed_value
 from datamanager.data_manager_interface import DataManagerInterface, Status
 from datamanager.database import *
-from datamanager.omdb_url import omdb_url
-import requests
-from datamanager.gpt import gpt_recomendation, gpt_recomendation_new
+from datamanager.omdb import OmdbClient
+from datamanager.rate_limit import RateLimited, shared_limiter
+from datamanager.rec_queue import RecommendationQueue
+from datamanager.rec_cache import RecommendationCache
+from datamanager.random_sampler import RandomMovieSampler
+from datamanager.bulk_import import RateLimiter, ImportBudgetExceeded, is_imdb_id, IMPORT_WORKERS, BATCH_SIZE
+from datamanager.serializer import MOVIE_COLUMNS, user_movie_columns, row_to_dict
+from datamanager.sqlite_profile import DEFAULT_PROFILE, create_engines, RoutingSession
+from concurrent.futures import ThreadPoolExecutor
+from datamanager.recommender import GptRecommender, make_recommender
+from datamanager.content_index import ContentIndex, built_index
+from datamanager import search
+from datamanager.instrumentation import carry_timings
+from datamanager.review_stats import BUCKETS, bucket, ensure_table, rating_value
+
+# Max number of parallel OMDb requests when resolving recommended movies
+RESOLVE_WORKERS = 3
+# Movies per page of a user's library
+PAGE_SIZE = 60
+MAX_PAGE_SIZE = 500
+# Reviews per page of a movie
+REVIEWS_PAGE_SIZE = 20
+# Rows fetched at a time by exports
+EXPORT_BATCH = 1000
+# Library sort orders: sort -> (key expression, descending). Ties are broken by UserMovie.row_id in the
+# same direction. 0 = insertion order, newest first
+SORT_KEYS = {
+    0: (UserMovie.row_id, True),
+    1: (func.coalesce(Movie.year, ''), False),
+    2: (func.coalesce(Movie.rating, -1.0), True),
+    3: (func.coalesce(Movie.rating, -1.0), False),
+    4: (func.coalesce(Movie.title, ''), False),
+}
+
+# Full-text index of the movies (see migrations.py), joined on rowid = Movie.id
+MOVIES_FTS = table('movies_fts', column('rowid'))
+
+
+def _encode_cursor(values):
+    """Make an opaque page token from the sort key values of the last row of a page"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def _decode_cursor(cursor: str):
+    """Read a page token made by _encode_cursor: [sort key (str, number or null), row id (int)].
+    Raises ValueError if it isn't valid (the values go into the SQL comparison of the next page)"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid page token")
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError("Invalid page token")
+    key, row_id = values
+    if isinstance(key, bool) or not isinstance(key, (str, int, float, type(None))) \
+            or isinstance(row_id, bool) or not isinstance(row_id, int):
+        raise ValueError("Invalid page token")
+    return values
+
+
+def _session_scope():
+    """Scope of the data manager's sessions: the Flask app context (one session per request), the asyncio task
+    in an event loop (one session per request of asgi.py, whose requests share a thread), or the current thread
+    (workers, scripts)"""
+    if has_app_context():
+        return id(g._get_current_object())
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is not None:
+        return id(task)
+    return threading.get_ident()
 
 
 class SQLiteDataManager(DataManagerInterface):
-    def __init__(self, file_path):
-        """Initializes the SQLiteDataManager with a database file path."""
-        self.engine = create_engine(file_path)
-        self.Session = sessionmaker(bind=self.engine)
+    def __init__(self, file_path, omdb_client=None, rec_cache=None, profile=DEFAULT_PROFILE, recommender='gpt',
+                 content_index=None, rate_limiter=None):
+        """Initializes the SQLiteDataManager with a database file path.
+        omdb_client (OmdbClient): client used for OMDb lookups (default: cached OmdbClient)
+        rec_cache (RecommendationCache): cache of GPT recommendations (default: RecommendationCache())
+        profile (SQLiteProfile): SQLite settings (WAL, busy timeout, cache...). Reads use a pool of read-only
+        connections, writes a single serialized writer connection (see sqlite_profile.py)
+        recommender (str): source of recommendations, 'gpt' (default), 'local' (item-item collaborative filtering
+        over libraries and reviews, no network, chat-gpt only for movies nobody has yet - see recommender.py)
+        or 'content' (similar title/director/plot, from the content index)
+        content_index (ContentIndex): plot similarity index, new movies are added to it (default: a ContentIndex()
+        with recommender='content', otherwise the built index if there is one, whatever the recommender:
+        similar_movies uses it too)
+        rate_limiter (SharedRateLimiter): limits of the OMDb/OpenAI requests and budgets of the users, shared by
+        all processes (default: shared_limiter(), see rate_limit.py)"""
+        self.read_engine, self.engine = create_engines(file_path, profile)
+        self.session_factory = sessionmaker(class_=RoutingSession, read_engine=self.read_engine,
+                                            write_engine=self.engine)
+        # One session per request (see init_app), closed and rolled back by close_session()
+        self.Session = scoped_session(self.session_factory, scopefunc=_session_scope)
+        self.rate_limiter = rate_limiter if rate_limiter is not None else shared_limiter()
+        self.omdb = omdb_client if omdb_client is not None else OmdbClient(limiter=self.rate_limiter)
+        self.rec_queue = RecommendationQueue(self.engine, sessionmaker(bind=self.engine))
+        LibraryVersion.__table__.create(self.engine, checkfirst=True)
+        ensure_table(self.engine)
+        self.rec_cache = rec_cache if rec_cache is not None else RecommendationCache()
+        self.random_sampler = RandomMovieSampler()
+        if content_index is None:
+            content_index = ContentIndex() if recommender == 'content' else built_index()
+        self.content_index = content_index
+        self.recommender = make_recommender(recommender, self.read_engine, self.rec_cache, content_index,
+                                            self.session_factory)
+        # Full-text search index (schema migration 2), searches use LIKE without it
+        self.fts = search.has_fts(self.read_engine)
+        self.gpt_recommender = GptRecommender(self.rec_cache)
+
+    def init_app(self, app):
+        """Close the request's session when the Flask app context ends (after every request)"""
+        app.teardown_appcontext(self.close_session)
+
+    def close_session(self, exception=None):
+        """Roll back anything not committed and close the session of the current request/thread"""
+        self.Session.remove()
+
+    def pool_stats(self):
+        """Connection pool statistics of the read and write engines (to check that open connections stay bounded)"""
+        result = {}
+        for name, engine in (('read', self.read_engine), ('write', self.engine)):
+            pool = engine.pool
+            stats = {'pool': type(pool).__name__, 'status': pool.status()}
+            for attribute in ('size', 'checkedin', 'checkedout', 'overflow'):
+                if hasattr(pool, attribute):
+                    stats[attribute] = getattr(pool, attribute)()
+            result[name] = stats
+        return result
+
+    def upstream_usage(self, day: str = None, user_id: int = None):
+        """Requests and prompt/completion tokens of the OMDb/OpenAI requests of a day (default today), per upstream
+        and user (0: no user), counted by the rate limiter of all processes"""
+        return self.rate_limiter.usage(day, user_id=user_id)
 
     def get_user_movies(self, user_id: int, sort: int = 0):
         """Get the movies for a specific user, sorted based on the given sort parameter. Returns list of dictionaries
-        Returns list of Movie objects"""
+        Returns list of Movie objects. user_id = 0 returns a list of 1 random movie (see random_movies)"""
+        if user_id == 0:
+            return self.random_movies()
         session = self.Session()
         result = []
-        if user_id == 0:
-            result = [Movie.query.order_by(func.random()).first()]
+        query = session.query(Movie, UserMovie.user_rating, UserMovie.user_notes).join(
+            UserMovie, Movie.id == UserMovie.movie_id).filter(UserMovie.user_id == user_id)
+
+        if sort == 1:
+            query = query.order_by(Movie.year)
+        elif sort == 2:
+            query = query.order_by(Movie.rating.desc())
+        elif sort == 3:
+            query = query.order_by(Movie.rating)
+        elif sort == 4:
+            query = query.order_by(Movie.title)
+
+        user_movies = query.all()
+        for movie, user_rating, user_notes in user_movies:
+            # set without marking the Movie as changed, so a later commit in the request doesn't save it
+            if user_rating is not None:
+                set_committed_value(movie, 'rating', user_rating)
+            if user_notes is not None:
+                set_committed_value(movie, 'notes', user_notes)
+            result.append(movie)
+        return result
+
+    def get_user_movies_page(self, user_id: int, sort: int = 0, cursor: str = None, limit: int = PAGE_SIZE):
+        """Get one page of a user's movies, sorted in SQL (see SORT_KEYS) with keyset pagination.
+        Args: cursor (str): page token returned with the previous page (None for the first page).
+        limit (int): movies per page.
+        Returns: tuple (list of Movie objects with user rating/notes merged and the community rating of the reviews
+        in community_rating/review_count, next page token or None).
+        Raises ValueError for an invalid cursor."""
+        key, descending = SORT_KEYS.get(sort, SORT_KEYS[0])
+        session = self.Session()
+        query = session.query(Movie, UserMovie.user_rating, UserMovie.user_notes, ReviewStats.rating_mean,
+                              ReviewStats.review_count, key, UserMovie.row_id).join(
+            UserMovie, Movie.id == UserMovie.movie_id).outerjoin(
+            ReviewStats, ReviewStats.movie_id == Movie.id).filter(UserMovie.user_id == user_id)
+        rows, next_cursor = self._keyset_page(query, key, descending, cursor, limit, lambda rows: rows.all())
+
+        result = []
+        for movie, user_rating, user_notes, rating_mean, review_count, sort_key, row_id in rows:
+            # set without marking the Movie as changed, so a later commit in the request doesn't save it
+            if user_rating is not None:
+                set_committed_value(movie, 'rating', user_rating)
+            if user_notes is not None:
+                set_committed_value(movie, 'notes', user_notes)
+            # community rating from the review aggregates (not mapped columns, never saved)
+            movie.community_rating = rating_mean
+            movie.review_count = review_count or 0
+            result.append(movie)
+        return result, next_cursor
+
+    def get_user_movies_rows(self, user_id: int, sort: int = 0, cursor: str = None, limit: int = PAGE_SIZE):
+        """Same page as get_user_movies_page, read with a Core select of the movie columns only (no ORM objects,
+        no relationships), for the JSON API.
+        Returns: tuple (list of dicts, see serializer.MOVIE_COLUMNS, plus community_rating and review_count,
+        next page token or None)."""
+        key, descending = SORT_KEYS.get(sort, SORT_KEYS[0])
+        stmt = select(*user_movie_columns(), func.round(ReviewStats.rating_mean, 2).label('community_rating'),
+                      func.coalesce(ReviewStats.review_count, 0).label('review_count'),
+                      key.label('sort_key'), UserMovie.row_id).join(
+            UserMovie, Movie.id == UserMovie.movie_id).outerjoin(
+            ReviewStats, ReviewStats.movie_id == Movie.id).where(UserMovie.user_id == user_id)
+        session = self.Session()
+        rows, next_cursor = self._keyset_page(stmt, key, descending, cursor, limit,
+                                              lambda stmt: session.execute(stmt).all())
+        keys = [column.key for column in MOVIE_COLUMNS] + ['community_rating', 'review_count']
+        return [row_to_dict(row, keys) for row in rows], next_cursor
+
+    @staticmethod
+    def _keyset_page(query, key, descending, cursor, limit, fetch, tie=UserMovie.row_id):
+        """Apply keyset pagination to a query/select whose two last columns are the sort key and the unique tie
+        breaker (UserMovie.row_id by default). fetch(query) runs it. Returns (rows of the page, next page token
+        or None)"""
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        if cursor is not None:
+            last_key, last_row_id = _decode_cursor(cursor)
+            position = tuple_(key, tie)
+            query = query.filter(position < (last_key, last_row_id) if descending
+                                 else position > (last_key, last_row_id))
+        if descending:
+            query = query.order_by(key.desc(), tie.desc())
         else:
-            query = session.query(Movie, UserMovie.user_rating, UserMovie.user_notes).join(
-                UserMovie, Movie.id == UserMovie.movie_id).filter(UserMovie.user_id == user_id)
-
-            if sort == 1:
-                query = query.order_by(Movie.year)
-            elif sort == 2:
-                query = query.order_by(Movie.rating.desc())
-            elif sort == 3:
-                query = query.order_by(Movie.rating)
-            elif sort == 4:
-                query = query.order_by(Movie.title)
-
-            user_movies = query.all()
-            for movie, user_rating, user_notes in user_movies:
-                if user_rating is not None:
-                    movie.rating = user_rating
-                if user_notes is not None:
-                    movie.notes = user_notes
-                result.append(movie)
+            query = query.order_by(key, tie)
+        # one extra row tells if there is a next page
+        rows = fetch(query.limit(limit + 1))
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = _encode_cursor([rows[limit - 1][-2], rows[limit - 1][-1]])
+        return rows[:limit], next_cursor
+
+    def export_rows(self, kind: str, user_id: int = None):
+        """Stream rows for an export as dicts, reading through a server-side cursor (constant memory).
+        kind: 'library' (movies of user_id, user rating/notes merged as in get_user_movies), 'reviews' or 'movies'.
+        Generator: the read connection is released when it is exhausted or closed."""
+        if kind == 'library':
+            stmt = select(*user_movie_columns()).join(UserMovie, Movie.id == UserMovie.movie_id).where(
+                UserMovie.user_id == user_id).order_by(UserMovie.row_id)
+        elif kind == 'reviews':
+            stmt = select(Review.review_id, Review.user_id, User.username, Review.movie_id, Review.review_title,
+                          Review.review_text, Review.review_rating, Review.review_date).join(
+                User, User.id == Review.user_id, isouter=True).order_by(Review.review_id)
+        elif kind == 'movies':
+            stmt = select(*MOVIE_COLUMNS).order_by(Movie.id)
+        else:
+            raise ValueError("Unknown export: " + kind)
+        # same keys as the API (attribute names: 'id', not the 'movie_id' column name)
+        keys = stmt.selected_columns.keys()
+        with self.read_engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=EXPORT_BATCH).execute(stmt)
+            for row in result:
+                yield dict(zip(keys, row))
+
+    def random_movies(self, n: int = 1):
+        """Get n distinct random movies (index page and api). Uses the RandomMovieSampler, the cost doesn't
+        depend on the number of movies. Returns list of Movie objects"""
+        session = self.Session()
+        return self.random_sampler.sample(session, n)
+
+    def random_movies_rows(self, n: int = 1):
+        """Same as random_movies, read with a Core select of the movie columns only. Returns list of dicts"""
+        session = self.Session()
+        movie_ids = self.random_sampler.sample_ids(session, n)
+        rows = session.execute(select(*MOVIE_COLUMNS).where(Movie.id.in_(movie_ids))).all()
+        if len(rows) < len(movie_ids):
+            # Some movies were deleted since the ids were loaded
+            self.random_sampler.invalidate()
+            movie_ids = self.random_sampler.sample_ids(session, n)
+            rows = session.execute(select(*MOVIE_COLUMNS).where(Movie.id.in_(movie_ids))).all()
+        result = [row_to_dict(row) for row in rows]
+        random.shuffle(result)
         return result
 
     def add_new_movie(self, user_id: int, new_movie: str):
         """
         Add a new movie to a user's collection or the general Movie table if it doesn't exist.
+        The title is first looked up in the local catalog (full-text index, case and punctuation insensitive:
+        "the matrix" finds "The Matrix"), OMDb is only asked for movies that aren't there.
         UserMovie object requires onlu user_id + movie_id
-        Returns: Status (Enum object): The status of the operation (ALREADY_ADDED, OK, NOT_FOUND).
+        Returns: Status (Enum object): The status of the operation (ALREADY_ADDED, OK, NOT_FOUND, RATE_LIMITED).
         """
-        session = self.Session()
+        movie_ids = self._find_title(new_movie)
+        if not movie_ids:
+            return self.add_new_movie_to_db(new_movie, user_id)
+        return self._add_to_library(user_id, movie_ids)
 
-        # Check if the movie exists in the user's movies
-        user_movie_query = session.query(UserMovie).filter_by(user_id=user_id)
-        user_movie_query = user_movie_query.join(Movie, Movie.id == UserMovie.movie_id)
-        user_movie_query = user_movie_query.filter(Movie.title == new_movie)
+    async def add_new_movie_async(self, user_id: int, new_movie: str):
+        """add_new_movie for callers in an event loop (asgi.py): the OMDb lookup of a title that isn't in the
+        catalog is awaited. Database work stays synchronous (local SQLite).
+        Returns: Status (Enum object): The status of the operation (ALREADY_ADDED, OK, NOT_FOUND, RATE_LIMITED)."""
+        movie_ids = self._find_title(new_movie)
+        if not movie_ids:
+            return await self.add_new_movie_to_db_async(new_movie, user_id)
+        return self._add_to_library(user_id, movie_ids)
 
-        user_movie = user_movie_query.first()
+    def _add_to_library(self, user_id: int, movie_ids):
+        """Add the first of movie_ids (copies of one title in the catalog) to a user's library, unless the user
+        has one of them. Returns Status.OK or Status.ALREADY_ADDED"""
+        session = self.Session()
+        # Check if the movie exists in the user's movies
+        user_movie = session.query(UserMovie.row_id).filter(
+            UserMovie.user_id == user_id, UserMovie.movie_id.in_(movie_ids)).first()
         if user_movie:
-            session.close()
             return Status.ALREADY_ADDED
+        # Add the movie to the user's movies
+        session.add(UserMovie(user_id=user_id, movie_id=movie_ids[0]))
+        self._bump_library_version(session, user_id)
+        session.commit()
+        return Status.OK
 
-        # If not found in user's movies, check in the general Movie table
-        movie_query = session.query(Movie).filter_by(title=new_movie)
-        movie = movie_query.first()
+    def library_version(self, user_id: int):
+        """Get the version of a user's library: a counter increased by every add/update/delete of the library
+        (cached pages and ETags of the library are keyed by it)"""
+        session = self.Session()
+        version = session.execute(select(LibraryVersion.version).where(LibraryVersion.user_id == user_id)).scalar()
+        return version or 0
 
-        if movie:
-            # Add the movie to the user's movies
-            user_movie = UserMovie(user_id=user_id, movie_id=movie.id)
-            session.add(user_movie)
-            session.commit()
-            session.close()
-            return Status.OK
+    @staticmethod
+    def _bump_library_version(session, user_id: int):
+        """Increase the library version of a user, in the transaction of the change"""
+        stmt = insert(LibraryVersion).values(user_id=user_id, version=1)
+        session.execute(stmt.on_conflict_do_update(index_elements=[LibraryVersion.user_id],
+                                                   set_={'version': LibraryVersion.version + 1}))
+
+    def _find_title(self, title: str):
+        """Get the ids of the movies of the catalog with this title (up to case, spaces and punctuation)"""
+        session = self.Session()
+        if self.fts:
+            query = search.match_query(title, prefix=False)
+            if query is None:
+                return []
+            # every word of the title is in the movie title: candidates for the exact comparison, the shortest
+            # titles (best bm25) first so the limit doesn't leave out the same title among longer ones
+            rows = session.execute(
+                select(Movie.id, Movie.title).join(MOVIES_FTS, Movie.id == MOVIES_FTS.c.rowid).where(
+                    text("movies_fts MATCH :query").bindparams(query="title: (" + query + ")")).order_by(
+                    text("bm25(movies_fts)")).limit(100)).all()
         else:
-            return self.add_new_movie_to_db(new_movie, user_id)
+            rows = session.execute(select(Movie.id, Movie.title).where(
+                func.lower(Movie.title) == " ".join(title.lower().split()))).all()
+        return [movie_id for movie_id, movie_title in rows if search.same_title(title, movie_title)]
 
-        session.close()
-        return Status.NOT_FOUND
+    def search_movies(self, query: str, limit: int = 20, fuzzy: bool = True):
+        """
+        Search the catalog by title, director and plot.
+        Movies containing every word of the query (as a word prefix: "matr" finds "The Matrix") come first: the
+        exact title, then titles starting with the query, other title matches (shortest title first, "The Matrix"
+        before "The Matrix Revolutions"), then director and plot matches ranked by bm25. With fuzzy, the result is
+        completed with movies whose title is close to the query (typos: "the matirx").
+        Returns a list of movie dicts (MOVIE_COLUMNS), best first.
+        """
+        session = self.Session()
+        if not self.fts:
+            # no full-text index: title contains the query
+            rows = session.execute(select(*MOVIE_COLUMNS).where(
+                func.lower(Movie.title).contains(query.strip().lower(), autoescape=True)).order_by(
+                Movie.title).limit(limit))
+            return [row_to_dict(row) for row in rows]
+        match = search.match_query(query)
+        if match is None:
+            return []
+        rank = text("bm25(movies_fts, %s, %s, %s)" % search.COLUMN_WEIGHTS)
+        base = select(*MOVIE_COLUMNS).join(MOVIES_FTS, Movie.id == MOVIES_FTS.c.rowid)
+        # bm25 alone ranks a prefix match in a longer title (more occurrences) above the shorter one
+        title_match = Movie.id.in_(select(MOVIES_FTS.c.rowid).where(
+            text("movies_fts MATCH :title_query").bindparams(title_query="title: (" + match + ")")))
+        result = [row_to_dict(row) for row in session.execute(base.where(
+            text("movies_fts MATCH :query").bindparams(query=match)).order_by(
+            title_match.desc(), case((title_match, func.length(Movie.title)), else_=0), rank).limit(limit))]
+        # the movie with exactly this title first, then titles starting with the query
+        result.sort(key=lambda movie: (not search.same_title(query, movie['title']),
+                                       not search.starts_with(movie['title'], query)))
+        if fuzzy and len(result) < limit:
+            found = {movie['id'] for movie in result}
+            fuzzy_match = "title: (" + search.fuzzy_query(query) + ")"
+            candidates = session.execute(base.where(text("movies_fts MATCH :query").bindparams(
+                query=fuzzy_match)).order_by(rank).limit(search.FUZZY_CANDIDATES))
+            scored = []
+            for row in candidates:
+                movie = row_to_dict(row)
+                score = search.fuzzy_score(query, movie['title'])
+                if movie['id'] not in found and score >= search.FUZZY_CUTOFF:
+                    scored.append((score, movie))
+            scored.sort(key=lambda item: -item[0])
+            result.extend(movie for score, movie in scored[:limit - len(result)])
+        return result
+
+    def bulk_add_movies(self, user_id: int, items, rate_limiter=None):
+        """
+        Add many movies (titles or imdbIDs) to a user's library.
+        Movies already in the db are looked up first (titles as in add_new_movie), the missing ones are fetched
+        from OMDb concurrently (IMPORT_WORKERS threads, rate limited) and Movie/UserMovie rows are inserted in
+        batches of BATCH_SIZE.
+        Args: items (list of str): titles or imdbIDs (see bulk_import.parse_items).
+        Returns list of dicts {'item', 'status', 'movie_id', 'title'} in input order, status is
+        'added', 'already_added', 'not_found', 'duplicate' (same movie earlier in the list) or 'rate_limited'
+        (the shared OMDb limit was reached, see rate_limit.py).
+        Raises ImportBudgetExceeded, before any change, if the items missing from the catalog are more than the
+        OMDb lookups left in the user's daily budget.
+        """
+        rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        session = self.Session()
+        unique = list(dict.fromkeys(items))
+        imdb_ids = [item for item in unique if is_imdb_id(item)]
+        titles = [item for item in unique if not is_imdb_id(item)]
+
+        # the movies already in the db: one query by imdbID, titles matched as in add_new_movie (_find_title: up
+        # to case, spaces and punctuation), then one query for the titles of the matched ids
+        found = {}
+        if unique:
+            matches = {item: movie_ids[0] for item, movie_ids in
+                       ((title, self._find_title(title)) for title in titles) if movie_ids}
+            rows = session.query(Movie.id, Movie.title, Movie.imdbID).filter(
+                Movie.imdbID.in_(imdb_ids) | Movie.id.in_(list(set(matches.values())))).all()
+            by_imdb = {imdb_id: (movie_id, title) for movie_id, title, imdb_id in rows}
+            by_id = {movie_id: (movie_id, title) for movie_id, title, imdb_id in rows}
+            for item in unique:
+                match = by_imdb.get(item) if is_imdb_id(item) else by_id.get(matches.get(item))
+                if match is not None:
+                    found[item] = match
+
+        # fetch the others from OMDb
+        limited = set()
+
+        def fetch(item):
+            rate_limiter.wait()
+            try:
+                if is_imdb_id(item):
+                    return self.omdb.by_imdbID(item, user_id)
+                return self.omdb.by_title(item, user_id)
+            except RateLimited:
+                limited.add(item)
+                return None
+        missing = [item for item in unique if item not in found]
+        if missing and user_id:
+            available = self.rate_limiter.available('omdb', user_id, shared=False)
+            if available is not None and len(missing) > available:
+                raise ImportBudgetExceeded(len(missing), available)
+        fetched = {}
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(IMPORT_WORKERS, len(missing))) as pool:
+                fetched = {item: data for item, data in zip(missing, pool.map(carry_timings(fetch), missing))
+                           if data is not None}
+
+        # OMDb may return a movie that is in the db under another title
+        known = {}
+        fetched_ids = list({data['imdbID'] for data in fetched.values()})
+        for start in range(0, len(fetched_ids), BATCH_SIZE):
+            chunk = fetched_ids[start:start + BATCH_SIZE]
+            for movie_id, title, imdb_id in session.query(Movie.id, Movie.title, Movie.imdbID).filter(
+                    Movie.imdbID.in_(chunk)):
+                known[imdb_id] = (movie_id, title)
+        answers = {}
+        for data in fetched.values():
+            if data['imdbID'] not in known:
+                answers.setdefault(data['imdbID'], data)
+        pending = list(answers.items())
+        created = []
+        for start in range(0, len(pending), BATCH_SIZE):
+            batch = dict(pending[start:start + BATCH_SIZE])
+            inserted = self._insert_movies(session, batch)
+            created.extend(movie_id for imdb_id, movie_id, title in inserted)
+            known.update((imdb_id, (movie_id, title)) for imdb_id, movie_id, title in inserted)
+            # inserted by another request meantime
+            lost = [imdb_id for imdb_id in batch if imdb_id not in known]
+            if lost:
+                known.update((imdb_id, (movie_id, title)) for movie_id, imdb_id, title in session.query(
+                    Movie.id, Movie.imdbID, Movie.title).filter(Movie.imdbID.in_(lost)))
+        for item, data in fetched.items():
+            found[item] = known[data['imdbID']]
+
+        # add to the library what isn't there yet
+        movie_ids = list({movie_id for movie_id, title in found.values()})
+        in_library = set()
+        for start in range(0, len(movie_ids), BATCH_SIZE):
+            chunk = movie_ids[start:start + BATCH_SIZE]
+            in_library.update(movie_id for (movie_id,) in session.query(UserMovie.movie_id).filter(
+                UserMovie.user_id == user_id, UserMovie.movie_id.in_(chunk)))
+        report, seen, to_add = [], set(), []
+        for item in items:
+            match = found.get(item)
+            if match is None:
+                status = 'rate_limited' if item in limited else 'not_found'
+                report.append({'item': item, 'status': status, 'movie_id': None, 'title': None})
+                continue
+            movie_id, title = match
+            if movie_id in seen:
+                status = 'duplicate'
+            elif movie_id in in_library:
+                status = 'already_added'
+            else:
+                status = 'added'
+                to_add.append(UserMovie(user_id=user_id, movie_id=movie_id))
+            seen.add(movie_id)
+            report.append({'item': item, 'status': status, 'movie_id': movie_id, 'title': title})
+        for start in range(0, len(to_add), BATCH_SIZE):
+            session.add_all(to_add[start:start + BATCH_SIZE])
+            self._bump_library_version(session, user_id)
+            session.commit()
+
+        if created:
+            self.random_sampler.invalidate()
+            # Recommendations of the new movies are precomputed in the background, as for single adds
+            for movie_id in created:
+                self.rec_queue.enqueue(movie_id)
+        return report
 
     def add_from_rec(self, user_id: int, movie_id: int):
         """
@@ -84,14 +527,14 @@ class SQLiteDataManager(DataManagerInterface):
         Returns: Status (Enum Object)The status of the operation (ALREADY_ADDED, OK).
         """
         session = self.Session()
-        query = session.query(UserMovie).filter_by(movie_id=movie_id).first()
+        query = session.query(UserMovie).filter_by(user_id=user_id, movie_id=movie_id).first()
         if query:
             return Status.ALREADY_ADDED
         else:
             user_movie = UserMovie(user_id=user_id, movie_id=movie_id)
             session.add(user_movie)
+            self._bump_library_version(session, user_id)
             session.commit()
-            session.close()
             return Status.OK
 
     def delete_from_db(self, movie_id):
@@ -110,6 +553,7 @@ class SQLiteDataManager(DataManagerInterface):
             # Delete the row and return True
             session.delete(row)
             session.commit()
+            self.random_sampler.remove(movie_id)
             return True
         else:
             # Return False if the row doesn't exist
@@ -121,18 +565,77 @@ class SQLiteDataManager(DataManagerInterface):
         user_id (int): The ID of the user (default is 0).
         imdbID (str): The IMDb ID of the movie (default is None). Adding movies by imdbID used for recommendations
         by openai.
-        Returns: Status (Enum Object): The status of the operation (OK or NOT_FOUND).
+        One movie per imdbID: if OMDb answers with a movie of the catalog (another spelling of its title), that movie
+        is used instead of inserting a copy.
+        Returns: Status (Enum Object): The status of the operation (OK, NOT_FOUND, ALREADY_ADDED if the user
+        already has the movie, or RATE_LIMITED if the OMDb limit or the user's budget is reached).
                 """
-        session = self.Session()
-        url = omdb_url + "t="
-        request = requests.post(url + new_movie_title + "&plot=full")
-        # different url request for title/imdbID
-        if imdbID is not None:
-            url = omdb_url + "i="
-            request = requests.post(url + imdbID + "&plot=full")
-        api_data = request.json()
-        if "Error" in api_data:
+        # different OMDb request for title/imdbID, both cached by the client
+        try:
+            if imdbID is not None:
+                api_data = self.omdb.by_imdbID(imdbID, user_id or None)
+            else:
+                api_data = self.omdb.by_title(new_movie_title, user_id or None)
+        except RateLimited:
+            return Status.RATE_LIMITED
+        return self._add_omdb_movie(api_data, user_id)
+
+    async def add_new_movie_to_db_async(self, new_movie_title, user_id=0, imdbID=None):
+        """add_new_movie_to_db with an awaited OMDb request (see add_new_movie_async)"""
+        self._release_session()
+        try:
+            if imdbID is not None:
+                api_data = await self.omdb.by_imdbID_async(imdbID, user_id or None)
+            else:
+                api_data = await self.omdb.by_title_async(new_movie_title, user_id or None)
+        except RateLimited:
+            return Status.RATE_LIMITED
+        return self._add_omdb_movie(api_data, user_id)
+
+    def _add_omdb_movie(self, api_data, user_id=0):
+        """Store the movie of an OMDb answer (None: not found) and add it to the library of user_id (if not 0).
+        Returns: Status (Enum Object) of add_new_movie_to_db"""
+        if api_data is None:
             return Status.NOT_FOUND
+        session = self.Session()
+        movie_id = self._movie_id_by_imdbID(api_data['imdbID'])
+        created = movie_id is None
+        if created:
+            new_movie = self._movie_from_omdb(api_data)
+            session.add(new_movie)
+            try:
+                session.flush()
+            except IntegrityError:
+                # inserted by another request in the meantime (imdbID is unique)
+                session.rollback()
+                movie_id = self._movie_id_by_imdbID(api_data['imdbID'])
+                created = False
+            else:
+                movie_id = new_movie.id
+                indexed = [self._index_row(new_movie)]
+        # If func comes from user, so immediatly added to UserMovies
+        if user_id != 0:
+            if not created and session.query(UserMovie.row_id).filter_by(user_id=user_id, movie_id=movie_id).first():
+                return Status.ALREADY_ADDED
+            user_movie = UserMovie(user_id=user_id, movie_id=movie_id)
+            session.add(user_movie)
+            self._bump_library_version(session, user_id)
+        session.commit()
+        if created:
+            self.random_sampler.add(movie_id)
+            self._index_movies(indexed)
+            # Recommendations of the new movie are precomputed in the background
+            self.rec_queue.enqueue(movie_id)
+        return Status.OK
+
+    def _movie_id_by_imdbID(self, imdbID):
+        """Returns the id of the (canonical, lowest id) movie with this imdbID, None if there is none"""
+        row = self.Session().query(Movie.id).filter_by(imdbID=imdbID).order_by(Movie.id).first()
+        return row[0] if row is not None else None
+
+    @staticmethod
+    def _movie_from_omdb(api_data):
+        """Make a Movie object (not added to a session) from OMDb response data"""
         # some movies returned with no rating
         try:
             rating = float(api_data['imdbRating'])
@@ -153,15 +656,36 @@ class SQLiteDataManager(DataManagerInterface):
         # In case of image not availible - not availible image is added
         if new_movie.img == "N/A":
             new_movie.img = 'https://st4.depositphotos.com/14953852/22772/v/450/depositphotos_227725020-stock-illustration-image-available-icon-flat-vector.jpg'
-        session.add(new_movie)
-        session.flush()
-        # If func comes from user, so immediatly added to UserMovies
-        if user_id != 0:
-            user_movie = UserMovie(user_id=user_id, movie_id=new_movie.id)
-            session.add(user_movie)
-        session.commit()
-        session.close()
-        return Status.OK
+        return new_movie
+
+    @staticmethod
+    def _index_row(movie):
+        """Values of a flushed movie for the content index (read before commit expires them)"""
+        return movie.id, movie.title, movie.director, movie.plot
+
+    def _index_movies(self, rows):
+        """Add new movies (list of _index_row) to the content index, if there is one"""
+        if self.content_index is not None and rows:
+            self.content_index.add(rows)
+
+    def similar_movies(self, movie_id: int, k: int = 10):
+        """Get the k movies most similar to a movie by title/director/plot (content index).
+        Returns a list of movie dicts (MOVIE_COLUMNS + 'similarity'), best first, or Status.NOT_FOUND if there is no
+        content index or the movie isn't in it."""
+        if self.content_index is None:
+            return Status.NOT_FOUND
+        similar = self.content_index.similar(movie_id, k)
+        if not similar:
+            return Status.NOT_FOUND
+        session = self.Session()
+        rows = {row[0]: row_to_dict(row) for row in session.execute(
+            select(*MOVIE_COLUMNS).where(Movie.id.in_([similar_id for similar_id, _ in similar])))}
+        result = []
+        for similar_id, score in similar:
+            if similar_id in rows:
+                rows[similar_id]['similarity'] = round(score, 4)
+                result.append(rows[similar_id])
+        return result
 
     def movie_info(self, user_id: int, movie_id: int):
         """Get the information of a specific movie for a user.
@@ -180,10 +704,6 @@ class SQLiteDataManager(DataManagerInterface):
                 movie_info['rating'] = user_rating
             if user_notes is not None:
                 movie_info['notes'] = user_notes
-            session.close()
-            print("********")
-            print(movie_info)
-            print(type(movie_info))
             return movie_info
         else:
             return None
@@ -197,7 +717,6 @@ class SQLiteDataManager(DataManagerInterface):
 
         if query:
             movie_info = vars(query)
-            session.close()
             return movie_info
         else:
             return None
@@ -216,8 +735,8 @@ class SQLiteDataManager(DataManagerInterface):
             (UserMovie.movie_id == movie_id) & (UserMovie.user_id == user_id)
         ).values(user_rating=rating_upd, user_notes=notes_upd)
         session.execute(update_query)
+        self._bump_library_version(session, user_id)
         session.commit()
-        session.close()
         return Status.OK
 
     def delete_movie(self, user_id: int, movie_id: int):
@@ -234,27 +753,29 @@ class SQLiteDataManager(DataManagerInterface):
         if row:
             # Delete the row and return True
             session.delete(row)
+            self._bump_library_version(session, user_id)
             session.commit()
             return True
         else:
             # Return False if the row doesn't exist
             return False
 
-    def get_reviews(self, movie_id: int):
-        """Get reviews for a specific movie by id
-        Returns: A list of dictionaries representing reviews."""
+    def get_reviews_page(self, movie_id: int, cursor: str = None, limit: int = REVIEWS_PAGE_SIZE):
+        """Get one page of the reviews of a movie, newest first, with keyset pagination on (review_date, review_id)
+        (served by the ix_reviews_movie_date index, every page costs the same).
+        Args: cursor (str): page token returned with the previous page (None for the first page).
+        limit (int): reviews per page.
+        Returns: tuple (list of rows with review_title, review_text, review_rating, user_id, username,
+        review_date ('YYYY-MM-DD') and review_id, next page token or None).
+        Raises ValueError for an invalid cursor."""
+        # the date as stored (text): a plain JSON value in the page token
+        review_date = type_coerce(Review.review_date, String)
+        stmt = select(Review.review_title, Review.review_text, Review.review_rating, Review.user_id, User.username,
+                      review_date.label('review_date'), Review.review_id).join(
+            User, User.id == Review.user_id).where(Review.movie_id == movie_id)
         session = self.Session()
-        query = session.query(Review, Movie, User.username).join(
-            Movie, Movie.id == Review.movie_id).join(
-            User, User.id == Review.user_id).filter(Review.movie_id == movie_id).order_by(
-            Review.review_date.desc()).all()
-
-        reviews_by_movie = []
-        for review, movie_data, username in query:
-            review_dict = vars(review)
-            review_dict['username'] = username
-            reviews_by_movie.append(review_dict)
-        return reviews_by_movie
+        return self._keyset_page(stmt, review_date, True, cursor, limit, lambda stmt: session.execute(stmt).all(),
+                                 tie=Review.review_id)
 
     def add_review(self, new_review_dict):
         """Add a new review to the database (Review object).
@@ -264,9 +785,58 @@ class SQLiteDataManager(DataManagerInterface):
         session = self.Session()
         new_review = Review(**new_review_dict)
         session.add(new_review)
+        self._add_review_stats(session, new_review)
+        # the community rating shown in the libraries of the movie changed
+        self._bump_movie_libraries(session, new_review.movie_id)
         session.commit()
         return Status.OK
 
+    @staticmethod
+    def _add_review_stats(session, review):
+        """Add a new review to the aggregate of its movie (review_stats), in the transaction of the review"""
+        rating = rating_value(review.review_rating)
+        index = bucket(rating)
+        counts = [0] * BUCKETS
+        if index is not None:
+            counts[index] = 1
+        stmt = insert(ReviewStats).values(movie_id=review.movie_id, review_count=1, rating_count=int(index is not None),
+                                          rating_sum=rating or 0, rating_mean=rating, histogram=json.dumps(counts),
+                                          last_review_date=review.review_date)
+        new = stmt.excluded
+        set_ = {'review_count': ReviewStats.review_count + 1,
+                'rating_count': ReviewStats.rating_count + new.rating_count,
+                'rating_sum': ReviewStats.rating_sum + new.rating_sum,
+                'rating_mean': (ReviewStats.rating_sum + new.rating_sum) / func.nullif(
+                    ReviewStats.rating_count + new.rating_count, 0),
+                'last_review_date': func.max(func.coalesce(ReviewStats.last_review_date, new.last_review_date),
+                                             func.coalesce(new.last_review_date, ReviewStats.last_review_date))}
+        if index is not None:
+            path = f'$[{index}]'
+            set_['histogram'] = func.json_set(ReviewStats.histogram, path,
+                                              func.json_extract(ReviewStats.histogram, path) + 1)
+        session.execute(stmt.on_conflict_do_update(index_elements=[ReviewStats.movie_id], set_=set_))
+
+    @staticmethod
+    def _bump_movie_libraries(session, movie_id: int):
+        """Increase the library version of every user who has the movie"""
+        users = select(UserMovie.user_id, literal(1)).where(UserMovie.movie_id == movie_id,
+                                                            UserMovie.user_id.is_not(None))
+        stmt = insert(LibraryVersion).from_select(['user_id', 'version'], users)
+        session.execute(stmt.on_conflict_do_update(index_elements=[LibraryVersion.user_id],
+                                                   set_={'version': LibraryVersion.version + 1}))
+
+    def review_stats(self, movie_id: int):
+        """Get the review aggregate of a movie: dict with review_count, rating_count, rating_mean, histogram (list of
+        10 counts, ratings 1 to 10) and last_review_date. Movies without reviews get zero counts."""
+        session = self.Session()
+        row = session.execute(select(ReviewStats).where(ReviewStats.movie_id == movie_id)).scalar()
+        if row is None:
+            return {'review_count': 0, 'rating_count': 0, 'rating_mean': None, 'histogram': [0] * BUCKETS,
+                    'last_review_date': None}
+        return {'review_count': row.review_count, 'rating_count': row.rating_count,
+                'rating_mean': round(row.rating_mean, 2) if row.rating_mean is not None else None,
+                'histogram': json.loads(row.histogram), 'last_review_date': row.last_review_date}
+
     def movie_by_imdbID(self, imdbID):
         """Check if a movie with a given IMDb ID exists in the database and add it if not using add_new_movie_to_db
         (by imdbID).
@@ -282,103 +852,336 @@ class SQLiteDataManager(DataManagerInterface):
             else:
                 return Status.NOT_FOUND
 
-    def _update_recommendations(self, movie, recommend_function):
-        """ Update movie recommendations using the specified recommendation function
+    async def movie_by_imdbID_async(self, imdbID):
+        """movie_by_imdbID with an awaited OMDb request for a movie that isn't in the database.
+        Returns: Status (Enum Object): OK or NOT_FOUND."""
+        if self._movie_id_by_imdbID(imdbID) is not None:
+            return Status.OK
+        if await self.add_new_movie_to_db_async("", user_id=0, imdbID=imdbID) == Status.OK:
+            return Status.OK
+        return Status.NOT_FOUND
+
+    def _update_recommendations(self, session, movie, fresh=False, user_id=None):
+        """ Update movie recommendations using the recommender of the data manager
         Args:
             movie: The movie for which recommendations should be updated.
-            recommend_function: The recommendation function to use (recommend_movies / recommend_new_movies)..
-            This private method updates the recommendations for the given movie using the provided recommendation function.
-            It sets the movie's 'recomend1', 'recomend2', and 'recomend3' attributes with recommended movie IMDb IDs.
-
+            fresh (bool): get new recommendations (chat-gpt: 'gpt_recomendation_new', ignoring the cache).
+            user_id (int): user who asked for them, a chat-gpt request counts against their budget.
+            This private method sets the movie's 'recomend1', 'recomend2', and 'recomend3' attributes with recommended
+            movie IMDb IDs. A local recommender without result for the movie (cold start) falls back to chat-gpt.
+        Returns bool: True if the recommendations were set.
             """
-        rec1, rec2, rec3 = recommend_function(movie.title)
-        movie.recomend1 = rec1
-        movie.recomend2 = rec2
-        movie.recomend3 = rec3
+        recommendations = self.recommender.recommend(session, movie, fresh=fresh, user_id=user_id)
+        if recommendations is None and self.recommender.local:
+            recommendations = self.gpt_recommender.recommend(session, movie, fresh=fresh, user_id=user_id)
+        if recommendations is None:
+            return False
+        movie.recomend1, movie.recomend2, movie.recomend3 = recommendations
+        return True
+
+    async def _recommendations_async(self, session, movie, fresh=False, user_id=None):
+        """The recommendations _update_recommendations would set (tuple of 3 imdbIDs or None), with chat-gpt
+        requests awaited. The session is released before waiting: movie is detached afterwards"""
+        recommender = self.recommender
+        if recommender.local:
+            recommendations = recommender.recommend(session, movie, fresh=fresh, user_id=user_id)
+            if recommendations is not None:
+                return recommendations
+            recommender = self.gpt_recommender
+        self._release_session()
+        return await recommender.recommend_async(session, movie, fresh=fresh, user_id=user_id)
+
+    def _release_session(self):
+        """Close the session of the current request before awaiting an upstream request (OMDb, chat-gpt), so
+        requests waiting in the event loop hold no pooled connection. Objects loaded before are detached"""
+        self.Session().close()
 
     def _get_movie_statuses(self, imdb_ids):
         """Get the status of movies with the given IMDb IDs in the database.
         (If a reccomnded movie is in the db)
+        Movies already in the db are found with one IN (...) query. The missing ones are fetched from OMDb
+        concurrently (bounded thread pool) and inserted in one transaction.
         Args:
             imdb_ids: A list of IMDb IDs to check.
         Returns list: A list of Status values indicating the status of each movie.
             """
-        statuses = [self.movie_by_imdbID(imdb_id) for imdb_id in imdb_ids]
-        return statuses
+        existing, missing = self._existing_imdb_ids(imdb_ids)
+        fetched = {}
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(RESOLVE_WORKERS, len(missing))) as pool:
+                fetched = dict(zip(missing, pool.map(carry_timings(self.omdb.by_imdbID), missing)))
+        return self._store_fetched(imdb_ids, existing, fetched)
 
-    def recommended_movies(self, movie_id):
-        """
-        Get recommended movies based on a selected movie (using chat-gpt - gpt function).
-        Args: movie_id (int): The ID of the selected movie.
-        Returns list of dictionaries representing recommended movies.
+    async def _get_movie_statuses_async(self, imdb_ids):
+        """_get_movie_statuses with the OMDb requests of the missing movies awaited concurrently"""
+        existing, missing = self._existing_imdb_ids(imdb_ids)
+        fetched = {}
+        if missing:
+            self._release_session()
+            fetched = dict(zip(missing, await asyncio.gather(*(self.omdb.by_imdbID_async(imdb_id)
+                                                                for imdb_id in missing))))
+        return self._store_fetched(imdb_ids, existing, fetched)
 
-        This method retrieves recommended movies for a given movie by first checking if the movie has existing recommendations
-        ('recomend1', 'recomend2', 'recomend3'). If any of the recommendations are missing, it updates them using the 'gpt_recomendation'
-        function and commits the changes to the database.
+    def _existing_imdb_ids(self, imdb_ids):
+        """Returns (set of the imdb_ids in the db, list of the other ones without duplicates)"""
+        session = self.Session()
+        existing = {imdb_id for (imdb_id,) in
+                    session.query(Movie.imdbID).filter(Movie.imdbID.in_(imdb_ids)).all()}
+        return existing, [imdb_id for imdb_id in dict.fromkeys(imdb_ids) if imdb_id not in existing]
 
-        It then checks the status of recommended movies in the database using '_get_movie_statuses' and returns the data for the recommended
-        movies if all have a status of 'Status.OK'. If not, it resets the recommendations and returns 'Status.NOT_FOUND'.
+    def _insert_movies(self, session, answers):
+        """Insert the movies of OMDb answers (imdbID -> data) in one transaction and index them. Movies inserted by
+        another request or the worker meantime (imdbID is unique) are skipped.
+        Returns a list of (imdbID, movie_id, title) of the inserted movies"""
+        new_movies = [self._movie_from_omdb(api_data) for api_data in answers.values()]
+        session.add_all(new_movies)
+        try:
+            session.flush()
+        except IntegrityError:
+            session.rollback()
+            inserted, _ = self._existing_imdb_ids(list(answers))
+            new_movies = [self._movie_from_omdb(api_data) for imdb_id, api_data in answers.items()
+                          if imdb_id not in inserted]
+            session.add_all(new_movies)
+            session.flush()
+        # read the new ids before commit expires the objects
+        rows = [(movie.imdbID, movie.id, movie.title) for movie in new_movies]
+        indexed = [self._index_row(movie) for movie in new_movies]
+        session.commit()
+        self._index_movies(indexed)
+        return rows
+
+    def _store_fetched(self, imdb_ids, existing, fetched):
+        """Insert the movies fetched from OMDb (imdbID -> data or None) in one transaction.
+        Returns the list of Status of imdb_ids (see _get_movie_statuses)"""
+        if fetched:
+            answers = {api_data['imdbID']: api_data for api_data in fetched.values()
+                       if api_data is not None and api_data['imdbID'] not in existing}
+            if answers:
+                for imdbID, movie_id, title in self._insert_movies(self.Session(), answers):
+                    self.random_sampler.add(movie_id)
+        return [Status.OK if imdb_id in existing or fetched.get(imdb_id) is not None else Status.NOT_FOUND
+                for imdb_id in imdb_ids]
+
+    def compute_recommendations(self, movie_id, fresh=False, user_id=None):
+        """
+        Compute and store the recommendations of a movie. Used by the recommendation worker (recommend_worker.py),
+        never inside a web request.
+        Args: movie_id (int): The ID of the movie. fresh (bool): get new recommendations with 'gpt_recomendation_new'.
+        user_id (int): user who asked for them (job of recommend_new_movies), charged for the chat-gpt request.
+        Returns: Status (Enum Object): OK if all recommended movies are in the db, NOT_FOUND otherwise.
+
+        If any of the recommendations are missing (or fresh is True), it updates them using the recommendation function
+        and commits the changes to the database. It then checks the status of recommended movies using
+        '_get_movie_statuses' (adds missing ones to the db). If not all are found, it resets the recommendations.
         """
         session = self.Session()
         movie = session.query(Movie).filter_by(id=movie_id).first()
+        if movie is None:
+            return Status.NOT_FOUND
+        if fresh or any(recommendation is None for recommendation in
+                        [movie.recomend1, movie.recomend2, movie.recomend3]):
+            self._update_recommendations(session, movie, fresh=fresh, user_id=user_id)
+            session.commit()
 
-        if movie:
-            if any(recommendation is None for recommendation in [movie.recomend1, movie.recomend2, movie.recomend3]):
-                self._update_recommendations(movie, gpt_recomendation)
-                session.commit()
-                session.flush()
-
-            imdb_ids = [movie.recomend1, movie.recomend2, movie.recomend3]
-            statuses = self._get_movie_statuses(imdb_ids)
+        statuses = self._get_movie_statuses([movie.recomend1, movie.recomend2, movie.recomend3])
+        return self._check_recommendations(session, movie, statuses)
 
-            if all(status == Status.OK for status in statuses):
-                movies_query = session.query(Movie).filter(Movie.imdbID.in_(imdb_ids)).limit(3)
-                rec_movies_data = movies_query.all()
-                return rec_movies_data
-            else:
-                movie.recomend1 = None
-                movie.recomend2 = None
-                movie.recomend3 = None
-                session.commit()
+    async def compute_recommendations_async(self, movie_id, fresh=False, user_id=None):
+        """compute_recommendations with awaited chat-gpt and OMDb requests, so it can run inside a request of
+        asgi.py. Returns: Status (Enum Object): OK or NOT_FOUND."""
+        session = self.Session()
+        movie = session.query(Movie).filter_by(id=movie_id).first()
+        if movie is None:
+            return Status.NOT_FOUND
+        if fresh or any(recommendation is None for recommendation in
+                        [movie.recomend1, movie.recomend2, movie.recomend3]):
+            recommendations = await self._recommendations_async(session, movie, fresh=fresh, user_id=user_id)
+            # the session was released while waiting: load the movie again
+            movie = session.query(Movie).filter_by(id=movie_id).first()
+            if movie is None:
                 return Status.NOT_FOUND
-        else:
+            if recommendations is not None:
+                movie.recomend1, movie.recomend2, movie.recomend3 = recommendations
+                session.commit()
+
+        statuses = await self._get_movie_statuses_async([movie.recomend1, movie.recomend2, movie.recomend3])
+        movie = session.query(Movie).filter_by(id=movie_id).first()
+        if movie is None:
             return Status.NOT_FOUND
+        return self._check_recommendations(session, movie, statuses)
 
-    def recommend_new_movies(self, movie_id):
-        """
-            Get NEW recommended movies based on a selected movie (.
-            Returns a list of dictionaries representing newly recommended movies.
+    def _check_recommendations(self, session, movie, statuses):
+        """Keep the recommendations of a movie if all of them are in the db (statuses), reset them otherwise"""
+        if all(status == Status.OK for status in statuses):
+            return Status.OK
+        self.rec_cache.invalidate(movie.title)
+        movie.recomend1 = None
+        movie.recomend2 = None
+        movie.recomend3 = None
+        session.commit()
+        return Status.NOT_FOUND
 
-            This method retrieves newly recommended movies for a given movie by RESETTING the existing recommendations
-            ('recomend1', 'recomend2', 'recomend3') to None and then updating them using the 'gpt_recomendation_new' function.
-            gpt_recommendation_new uses a different request from gpt_recommendation
+    def movies_without_recommendations(self):
+        """Returns a list of (movie_id, title) of the movies that lack one of their recommendations"""
+        session = self.Session()
+        return session.query(Movie.id, Movie.title).filter(
+            (Movie.recomend1 == None) | (Movie.recomend2 == None) | (Movie.recomend3 == None)).all()
 
-            It checks the status of recommended movies in the database using '_get_movie_statuses' and returns the data for the recommended
-            movies if all have a status of 'Status.OK'. If not, it resets the recommendations and returns 'Status.NOT_FOUND'.
-            """
+    def save_recommendations(self, recommendations):
+        """Store recommendations of several movies in one transaction.
+        Args: recommendations (dict): movie_id -> tuple of 3 imdbIDs. Recommended movies are added to the db
+        (using '_get_movie_statuses'), movies whose recommendations were not all found are skipped.
+        Returns int: the number of movies updated."""
+        imdb_ids = list({imdb_id for ids in recommendations.values() for imdb_id in ids})
+        found = {imdb_id for imdb_id, status in zip(imdb_ids, self._get_movie_statuses(imdb_ids))
+                 if status == Status.OK}
+        values = [{'id': movie_id, 'recomend1': ids[0], 'recomend2': ids[1], 'recomend3': ids[2]}
+                  for movie_id, ids in recommendations.items() if all(imdb_id in found for imdb_id in ids)]
+        if values:
+            session = self.Session()
+            session.bulk_update_mappings(Movie, values)
+            session.commit()
+        return len(values)
+
+    def recommended_movies(self, movie_id):
+        """
+        Get recommended movies based on a selected movie. Recommendations are precomputed by the recommendation
+        worker (see recommend_worker.py), this method never calls chat-gpt.
+        Args: movie_id (int): The ID of the selected movie.
+        Returns list of Movie objects representing recommended movies, Status.PENDING if the recommendations are not
+        ready yet (a job is queued), Status.FAILED if the worker gave up on them (only recommend_new_movies tries
+        again), Status.NOT_FOUND if there is no such movie.
+        """
         session = self.Session()
         movie = session.query(Movie).filter_by(id=movie_id).first()
+        if movie is None:
+            return Status.NOT_FOUND
 
-        if movie:
-            # Reset recommendations to None (or NULL)
-            movie.recomend1 = None
-            movie.recomend2 = None
-            movie.recomend3 = None
-            session.commit()
+        imdb_ids = [movie.recomend1, movie.recomend2, movie.recomend3]
+        if all(imdb_id is not None for imdb_id in imdb_ids):
+            rec_movies_data = session.query(Movie).filter(Movie.imdbID.in_(imdb_ids)).limit(3).all()
+            if len(rec_movies_data) == len(set(imdb_ids)):
+                return rec_movies_data
+        # A local recommender answers right away (its recommendations are movies of the db)
+        if self.recommender.local:
+            imdb_ids = self.recommender.recommend(session, movie)
+            if imdb_ids is not None:
+                movie.recomend1, movie.recomend2, movie.recomend3 = imdb_ids
+                session.commit()
+                return session.query(Movie).filter(Movie.imdbID.in_(imdb_ids)).limit(3).all()
+        # No (complete) result yet: let the worker compute it
+        return self._queue_recommendations(movie_id)
 
-            self._update_recommendations(movie, gpt_recomendation_new)
-            session.commit()
-            session.flush()
+    def _queue_recommendations(self, movie_id):
+        """Status.PENDING after queueing a job for the movie (if it has none), Status.FAILED if its job failed"""
+        job_status = self.rec_queue.status(movie_id)
+        if job_status == 'failed':
+            return Status.FAILED
+        if job_status not in ('pending', 'running'):
+            self.rec_queue.enqueue(movie_id, retry_failed=False)
+        return Status.PENDING
 
-            imdb_ids = [movie.recomend1, movie.recomend2, movie.recomend3]
-            statuses = self._get_movie_statuses(imdb_ids)
+    def recommend_new_movies(self, movie_id, user_id: int = None):
+        """
+            Request NEW recommendations for a selected movie.
+            Returns Status.PENDING (the recommendation worker computes them with 'gpt_recomendation_new', which
+            uses a different request from gpt_recommendation) or Status.NOT_FOUND if there is no such movie.
+            With a local recommender the new recommendations are computed right away (Status.OK), the worker is only
+            used for movies it has no recommendations for.
+            The chat-gpt request of the job counts against the 'openai' budget of user_id: Status.RATE_LIMITED
+            (recommendations unchanged) when it is already spent.
+
+            The existing recommendations ('recomend1', 'recomend2', 'recomend3') are RESET to None, so the recommend
+            page shows the pending state until the new ones are ready.
+            """
+        session = self.Session()
+        movie = session.query(Movie).filter_by(id=movie_id).first()
 
-            if all(status == Status.OK for status in statuses):
-                movies_query = session.query(Movie).filter(Movie.imdbID.in_(imdb_ids)).limit(3)
-                rec_movies_data = movies_query.all()
+        if movie is None:
+            return Status.NOT_FOUND
+        if self.recommender.local:
+            imdb_ids = self.recommender.recommend(session, movie, fresh=True)
+            if imdb_ids is not None:
+                movie.recomend1, movie.recomend2, movie.recomend3 = imdb_ids
+                session.commit()
+                return Status.OK
+        # only checked here: the worker's chat-gpt request takes the token (and is counted) for the user
+        if user_id is not None and self.rate_limiter.try_acquire('openai', user_id, shared=False, take=False):
+            return Status.RATE_LIMITED
+        # Reset recommendations to None (or NULL)
+        movie.recomend1 = None
+        movie.recomend2 = None
+        movie.recomend3 = None
+        session.commit()
+        self.rec_queue.enqueue(movie_id, fresh=True, user_id=user_id)
+        return Status.PENDING
 
+    async def recommended_movies_async(self, movie_id):
+        """
+        recommended_movies for callers in an event loop (asgi.py): missing recommendations are computed inside the
+        request (chat-gpt and OMDb requests are awaited, the process serves other requests meanwhile) instead of
+        being left to the worker.
+        Returns list of Movie objects, Status.NOT_FOUND if there is no such movie, or Status.PENDING if chat-gpt
+        failed, a rate limit was reached or OMDb doesn't know the recommended movies (a job is queued to try again).
+        Movies with a queued job are left to the worker, Status.FAILED if it gave up on them.
+        """
+        session = self.Session()
+        movie = session.query(Movie).filter_by(id=movie_id).first()
+        if movie is None:
+            return Status.NOT_FOUND
+        imdb_ids = [movie.recomend1, movie.recomend2, movie.recomend3]
+        if all(imdb_id is not None for imdb_id in imdb_ids):
+            rec_movies_data = session.query(Movie).filter(Movie.imdbID.in_(imdb_ids)).limit(3).all()
+            if len(rec_movies_data) == len(set(imdb_ids)):
                 return rec_movies_data
-            else:
-                return Status.NOT_FOUND
-        else:
+        if self.rec_queue.status(movie_id) in ('pending', 'running', 'failed'):
+            return self._queue_recommendations(movie_id)
+        try:
+            status = await self.compute_recommendations_async(movie_id)
+        except (OpenAIError, RateLimited):
+            session.rollback()
+            status = Status.NOT_FOUND
+        if status == Status.OK:
+            imdb_ids = session.query(Movie.recomend1, Movie.recomend2, Movie.recomend3).filter_by(id=movie_id).first()
+            return session.query(Movie).filter(Movie.imdbID.in_(imdb_ids)).limit(3).all()
+        return self._queue_recommendations(movie_id)
+
+    async def recommend_new_movies_async(self, movie_id, user_id: int = None):
+        """
+        recommend_new_movies for callers in an event loop: the new recommendations are computed inside the request.
+        Returns Status.OK when they are ready, Status.NOT_FOUND if there is no such movie, Status.RATE_LIMITED if
+        the 'openai' budget of user_id is spent, or Status.PENDING (the recommendations are reset and the worker
+        tries again) if chat-gpt failed, is over its rate limit or its movies weren't found.
+        """
+        session = self.Session()
+        movie = session.query(Movie).filter_by(id=movie_id).first()
+        if movie is None:
             return Status.NOT_FOUND
+        # no pooled connection is held while waiting (compute_recommendations_async loads the movie again)
+        self._release_session()
+        if user_id is not None and await asyncio.to_thread(self.rate_limiter.try_acquire, 'openai', user_id,
+                                                            shared=False, take=False):
+            return Status.RATE_LIMITED
+        try:
+            status = await self.compute_recommendations_async(movie_id, fresh=True, user_id=user_id)
+        except RateLimited as error:
+            session.rollback()
+            if error.per_user:
+                # spent by concurrent requests of the user since the check: recommendations unchanged
+                return Status.RATE_LIMITED
+            status = Status.NOT_FOUND
+        except OpenAIError:
+            session.rollback()
+            status = Status.NOT_FOUND
+        if status == Status.OK:
+            return Status.OK
+        movie = session.query(Movie).filter_by(id=movie_id).first()
+        if movie is None:
+            return Status.NOT_FOUND
+        movie.recomend1 = None
+        movie.recomend2 = None
+        movie.recomend3 = None
+        session.commit()
+        self.rec_queue.enqueue(movie_id, fresh=True, user_id=user_id)
+        return Status.PENDING
@@ -0,0 +1,99 @@
+import csv
+import io
+import json
+import re
+import threading
+import time
+
+IMDB_ID = re.compile(r"^tt\d+$")
+# OMDb requests per second during an import, parallel requests, and rows per insert transaction
+RATE_LIMIT = 5
+IMPORT_WORKERS = 4
+BATCH_SIZE = 200
+# Items of an import from the command line, and of one import request: the API answers when it is done, so its
+# OMDb lookups (RATE_LIMIT per second) must fit well within the request timeout (30 s, gunicorn's default)
+MAX_ITEMS = 5000
+MAX_REQUEST_ITEMS = RATE_LIMIT * 20
+
+
+class TooManyItems(ValueError):
+    """Raised by parse_items when an import has more items than allowed"""
+
+
+class ImportBudgetExceeded(Exception):
+    """Raised before an import that needs more OMDb lookups than the user's daily budget has left
+
+    Attributes:
+        lookups (int): Items of the import that aren't in the catalog (at most one OMDb request each).
+        available (int): Requests left in the user's budget.
+    """
+
+    def __init__(self, lookups: int, available: int):
+        super().__init__(f"The import needs up to {lookups} OMDb lookups, {available} left in today's budget")
+        self.lookups = lookups
+        self.available = available
+
+
+class RateLimiter:
+    """Spaces calls to at most `rate` per second, shared by the threads of an import"""
+
+    def __init__(self, rate: float = RATE_LIMIT):
+        self.interval = 1 / rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def parse_items(data, content_type: str = "json", max_items: int = MAX_ITEMS):
+    """Read the titles/imdbIDs of an import.
+
+    JSON: a list of strings, a list of objects with "title" or "imdbID", or {"items": [...]} of those.
+    CSV: a column named title or imdbID (case insensitive), otherwise the first column of every row.
+    Returns a list of non-empty strings. Raises ValueError if the data can't be read, TooManyItems (a ValueError)
+    above max_items."""
+    if isinstance(data, bytes):
+        data = data.decode("utf-8-sig")
+    if content_type == "csv":
+        rows = list(csv.reader(io.StringIO(data)))
+        if not rows:
+            return []
+        header = [name.strip().lower() for name in rows[0]]
+        column = next((header.index(name) for name in ("imdbid", "title") if name in header), None)
+        if column is not None:
+            rows = rows[1:]
+        items = [row[column or 0] for row in rows if len(row) > (column or 0)]
+    else:
+        try:
+            items = json.loads(data)
+        except json.JSONDecodeError:
+            raise ValueError("Invalid JSON")
+        if isinstance(items, dict):
+            items = items.get("items")
+        if not isinstance(items, list):
+            raise ValueError("Expected a list of titles or imdbIDs")
+        items = [item.get("imdbID") or item.get("title") if isinstance(item, dict) else item for item in items]
+        if not all(isinstance(item, str) for item in items if item is not None):
+            raise ValueError("Expected a list of titles or imdbIDs")
+    items = [item.strip() for item in items if item and item.strip()]
+    if len(items) > max_items:
+        raise TooManyItems(f"Too many items (max {max_items})")
+    return items
+
+
+def is_imdb_id(item: str):
+    return IMDB_ID.match(item) is not None
+
+
+def summarize(report):
+    """Count the statuses of an import report"""
+    summary = {}
+    for entry in report:
+        summary[entry['status']] = summary.get(entry['status'], 0) + 1
+    return summary
@@ -0,0 +1,228 @@
+import json
+import math
+import os
+import re
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+from sqlalchemy import create_engine, select
+from datamanager.database import Movie
+
+# numpy is optional: the content index is only used when it is installed
+try:
+    import numpy as np
+except ImportError:
+    np = None
+# file lock between processes adding to the index (not available on Windows)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Default location of the index files, next to movies.sqlite
+INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "content_index")
+# Size of the hashed feature vectors, and rows allocated at once when the matrix grows
+DIM = 1024
+GROW_ROWS = 4096
+# Weight of a feature by field: a shared director or title word counts more than a plot word
+FIELD_WEIGHTS = {'title': 2.0, 'director': 3.0, 'plot': 1.0}
+TOKEN = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset(
+    "a an and are as at be by for from has he her his in is it its of on or she that the their them they this "
+    "to was were who with when where which while after into out up about over than".split())
+
+
+def features(title: str, director: str, plot: str):
+    """Hashed features of a movie: words of the title, director names and words + word pairs of the plot.
+    Returns a Counter of feature index (0..DIM-1) -> weighted count"""
+    counts = Counter()
+
+    def add(feature, weight):
+        counts[zlib.crc32(feature.encode()) % DIM] += weight
+
+    for word in TOKEN.findall((title or "").lower()):
+        add("t:" + word, FIELD_WEIGHTS['title'])
+    for name in (director or "").split(","):
+        name = " ".join(TOKEN.findall(name.lower()))
+        if name and name != "n a":
+            add("d:" + name, FIELD_WEIGHTS['director'])
+    words = [word for word in TOKEN.findall((plot or "").lower()) if word not in STOP_WORDS]
+    for word in words:
+        add("p:" + word, FIELD_WEIGHTS['plot'])
+    for first, second in zip(words, words[1:]):
+        add("p:" + first + " " + second, FIELD_WEIGHTS['plot'])
+    return counts
+
+
+def built_index(path: str = None):
+    """The ContentIndex at path (default INDEX_PATH) if it was built and numpy is installed, otherwise None"""
+    path = path if path is not None else INDEX_PATH
+    if np is None or not os.path.exists(path + ".json"):
+        return None
+    return ContentIndex(path)
+
+
+class ContentIndex:
+    """Content similarity of movies: TF-IDF of hashed title/director/plot features, one L2-normalized row per movie
+    in a memory-mapped float32 matrix, so lookups cost one matrix-vector product and nothing is loaded up front.
+
+    Files: {path}.vectors (rows), {path}.ids (movie id of each row), {path}.json (row count, document frequencies).
+    add() appends rows with the IDF of the moment (the weights of older rows drift a little as movies are added,
+    build() recomputes everything). Other processes see added rows on their next lookup.
+
+    Methods:
+        add(movies): Index new movies, a list of (movie_id, title, director, plot).
+        similar(movie_id, k): List of up to k (movie_id, cosine similarity), best first.
+        build(movies): Recompute the whole index.
+    """
+
+    def __init__(self, path: str = INDEX_PATH):
+        if np is None:
+            raise RuntimeError("The content index needs numpy (pip install numpy)")
+        self.path = path
+        self._meta = None
+        self._mtime = None
+        self._vectors = None
+        self._ids = None
+        self._rows = {}
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive lock of the index files while they are changed"""
+        with open(self.path + ".lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+        """(Re)open the files if they changed since the last call"""
+        try:
+            stat = os.stat(self.path + ".json")
+        except FileNotFoundError:
+            self._meta, self._mtime, self._vectors, self._ids, self._rows = None, None, None, None, {}
+            return
+        # the json file is replaced on every change: a new inode (or mtime) means new rows
+        mtime = (stat.st_ino, stat.st_mtime_ns)
+        if mtime == self._mtime:
+            return
+        with open(self.path + ".json") as file:
+            meta = json.load(file)
+        capacity = meta['capacity']
+        self._vectors = np.memmap(self.path + ".vectors", dtype=np.float32, mode="r", shape=(capacity, DIM))
+        self._ids = np.memmap(self.path + ".ids", dtype=np.int64, mode="r", shape=(capacity,))
+        self._rows = {int(movie_id): row for row, movie_id in enumerate(self._ids[:meta['count']])}
+        self._meta, self._mtime = meta, mtime
+
+    def _write_meta(self, meta):
+        """Replace the json file atomically (readers see the old or the new row count)"""
+        with open(self.path + ".json.tmp", "w") as file:
+            json.dump(meta, file)
+        os.replace(self.path + ".json.tmp", self.path + ".json")
+
+    @staticmethod
+    def _vector(counts, idf):
+        """L2-normalized TF-IDF row of a movie (sublinear tf)"""
+        vector = np.zeros(DIM, dtype=np.float32)
+        for feature, count in counts.items():
+            vector[feature] = (1 + math.log(count)) * idf[feature]
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    @staticmethod
+    def _idf(documents: int, df):
+        return np.log((1 + documents) / (1 + np.asarray(df, dtype=np.float64))) + 1
+
+    def build(self, movies):
+        """Recompute the index from an iterable of (movie_id, title, director, plot). Returns the number of movies"""
+        movies = [(movie_id, features(title, director, plot)) for movie_id, title, director, plot in movies]
+        df = np.zeros(DIM, dtype=np.int64)
+        for movie_id, counts in movies:
+            df[list(counts)] += 1
+        idf = self._idf(len(movies), df)
+        capacity = max(GROW_ROWS, len(movies))
+        with self._locked():
+            vectors = np.memmap(self.path + ".vectors.tmp", dtype=np.float32, mode="w+", shape=(capacity, DIM))
+            ids = np.memmap(self.path + ".ids.tmp", dtype=np.int64, mode="w+", shape=(capacity,))
+            for row, (movie_id, counts) in enumerate(movies):
+                vectors[row] = self._vector(counts, idf)
+                ids[row] = movie_id
+            vectors.flush()
+            ids.flush()
+            del vectors, ids
+            os.replace(self.path + ".vectors.tmp", self.path + ".vectors")
+            os.replace(self.path + ".ids.tmp", self.path + ".ids")
+            self._write_meta({'count': len(movies), 'capacity': capacity, 'documents': len(movies),
+                              'df': df.tolist()})
+        return len(movies)
+
+    def add(self, movies):
+        """Index new movies, a list of (movie_id, title, director, plot). A movie already indexed is replaced"""
+        if not movies:
+            return
+        with self._locked():
+            self._load()
+            if self._meta is None:
+                meta = {'count': 0, 'capacity': 0, 'documents': 0, 'df': [0] * DIM}
+            else:
+                meta = dict(self._meta)
+            rows = dict(self._rows)
+            df = np.asarray(meta['df'], dtype=np.int64)
+            new = {movie_id: features(title, director, plot) for movie_id, title, director, plot in movies}
+            for movie_id, counts in new.items():
+                if movie_id not in rows:
+                    df[list(counts)] += 1
+                    meta['documents'] += 1
+            count = meta['count'] + sum(1 for movie_id in new if movie_id not in rows)
+            if count > meta['capacity']:
+                # grow the files, the existing rows stay where they are
+                meta['capacity'] = max(count, meta['capacity'] + GROW_ROWS)
+                with open(self.path + ".vectors", "ab") as file:
+                    file.truncate(meta['capacity'] * DIM * 4)
+                with open(self.path + ".ids", "ab") as file:
+                    file.truncate(meta['capacity'] * 8)
+            vectors = np.memmap(self.path + ".vectors", dtype=np.float32, mode="r+", shape=(meta['capacity'], DIM))
+            ids = np.memmap(self.path + ".ids", dtype=np.int64, mode="r+", shape=(meta['capacity'],))
+            idf = self._idf(meta['documents'], df)
+            for movie_id, counts in new.items():
+                row = rows.get(movie_id)
+                if row is None:
+                    row = rows[movie_id] = meta['count']
+                    meta['count'] += 1
+                vectors[row] = self._vector(counts, idf)
+                ids[row] = movie_id
+            vectors.flush()
+            ids.flush()
+            meta['df'] = df.tolist()
+            self._write_meta(meta)
+
+    def similar(self, movie_id: int, k: int = 10):
+        """Get the k movies most similar to movie_id (cosine of their TF-IDF rows), as a list of (movie_id, score),
+        best first. Empty if the movie isn't indexed"""
+        self._load()
+        row = self._rows.get(movie_id)
+        if row is None:
+            return []
+        count = self._meta['count']
+        scores = self._vectors[:count] @ self._vectors[row]
+        scores[row] = -1
+        k = min(k, count - 1)
+        if k <= 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return [(int(self._ids[i]), float(scores[i])) for i in best if scores[i] > 0]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Build the content similarity index of the movies database")
+    parser.add_argument("db", help="database url, e.g. sqlite:///datamanager/movies.sqlite")
+    parser.add_argument("--path", default=INDEX_PATH, help="index files prefix")
+    args = parser.parse_args()
+    with create_engine(args.db).connect() as conn:
+        rows = conn.execute(select(Movie.id, Movie.title, Movie.director, Movie.plot).order_by(Movie.id)).all()
+    print(f"Indexed {ContentIndex(args.path).build(rows)} movies")
@@ -5,6 +5,9 @@ class Status(Enum):
     OK = 0
     NOT_FOUND = 1
     ALREADY_ADDED = 2
+    PENDING = 3
+    RATE_LIMITED = 4
+    FAILED = 5
 
 class DataManagerInterface(ABC):
     @abstractmethod
@@ -1,13 +1,18 @@
+from os import getenv
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from sqlalchemy_serializer import SerializerMixin
 import json
 
+# Database of the web app, the recommendation worker and the command line scripts: DATABASE_URL or this default
+DEFAULT_DATABASE_URL = \
+    "sqlite:////Users/anastasyabolshem/PycharmProjects/masterschool/movies_107.3/datamanager/movies.sqlite"
+DATABASE_URL = getenv("DATABASE_URL", default=DEFAULT_DATABASE_URL)
+
 # Create a Flask app instance
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = \
-    "sqlite:////Users/anastasyabolshem/PycharmProjects/masterschool/movies_107.3/datamanager/movies.sqlite"
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SECRET_KEY'] = 'the random string'
 db = SQLAlchemy()
 db.init_app(app)
@@ -31,8 +36,10 @@ class Movie(db.Model, SerializerMixin):
         recomend3 (str): IMDb ID of the third recommended movie.
         """
     __tablename__ = "movies"
+    # created in existing databases by datamanager/migrations.py: one movie per imdbID
+    __table_args__ = (db.Index('ux_movies_imdbID', 'imdbID', unique=True),)
     id = db.Column('movie_id', db.Integer, primary_key=True, autoincrement=True)
-    title = db.Column(db.String(50))
+    title = db.Column(db.String(50), index=True)
     director = db.Column(db.String)
     year = db.Column(db.String)
     rating = db.Column(db.Float)
@@ -62,6 +69,9 @@ class UserMovie(db.Model, SerializerMixin):
         user_rating (float): The user's rating for the movie.
         """
     __tablename__ = "user_movies"
+    # created in existing databases by datamanager/migrations.py
+    __table_args__ = (db.Index('ux_user_movies_user_movie', 'user_id', 'movie_id', unique=True),
+                      db.Index('ix_user_movies_movie', 'movie_id'))
     row_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user_data.user_id"))
     movie_id = db.Column(db.Integer, db.ForeignKey("movies.movie_id"))
@@ -135,6 +145,7 @@ class Review(db.Model):
             __init__(self, user_id, movie_id, review_title, review_text, review_rating, review_date): Initialize a new review instance.
         """
     __tablename__ = "reviews"
+    __table_args__ = (db.Index('ix_reviews_movie_date', 'movie_id', 'review_date'),)
     review_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user_data.user_id"))
     movie_id = db.Column(db.Integer, db.ForeignKey("movies.movie_id"))
@@ -150,3 +161,66 @@ class Review(db.Model):
         self.review_text = review_text
         self.review_rating = review_rating
         self.review_date = review_date
+
+
+class RecommendationJob(db.Model):
+    """RecommendationJob class representing the 'recommendation_jobs' table (queue of recommendations to precompute).
+
+        Attributes:
+            job_id (int): The primary key for the job record.
+            movie_id (int): The ID of the movie to compute recommendations for (one job per movie).
+            fresh (bool): True if new recommendations were requested (gpt_recomendation_new is used).
+            status (str): 'pending', 'running', 'done' or 'failed'.
+            attempts (int): How many times a worker took the job.
+            error (str): Last error message.
+            user_id (int): The user who asked for new recommendations (their chat-gpt budget is charged), or None.
+            run_after (float): A released job isn't taken before this Unix timestamp (None: at once).
+            created_at (float), updated_at (float): Unix timestamps.
+        """
+    __tablename__ = "recommendation_jobs"
+    job_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    movie_id = db.Column(db.Integer, db.ForeignKey("movies.movie_id"), unique=True)
+    fresh = db.Column(db.Boolean, default=False)
+    status = db.Column(db.String, default='pending', index=True)
+    attempts = db.Column(db.Integer, default=0)
+    error = db.Column(db.String)
+    user_id = db.Column(db.Integer)
+    run_after = db.Column(db.Float)
+    created_at = db.Column(db.Float)
+    updated_at = db.Column(db.Float)
+
+
+class LibraryVersion(db.Model):
+    """LibraryVersion class representing the 'library_versions' table: a counter per user, increased by every change
+    of the user's library. Rendered library pages and ETags are keyed by it.
+
+        Attributes:
+            user_id (int): The ID of the user (primary key).
+            version (int): Number of changes of the library.
+        """
+    __tablename__ = "library_versions"
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ReviewStats(db.Model):
+    """ReviewStats class representing the 'review_stats' table: aggregate of the reviews of a movie, updated by
+    add_review (datamanager/review_stats.py recomputes it).
+
+        Attributes:
+            movie_id (int): The ID of the movie (primary key).
+            review_count (int): Number of reviews.
+            rating_count (int): Number of reviews with a rating.
+            rating_sum (float): Sum of the ratings.
+            rating_mean (float): Mean rating (None without rated reviews).
+            histogram (str): JSON list of 10 counts, reviews rated 1 to 10 (ratings rounded).
+            last_review_date (date): Date of the latest review.
+        """
+    __tablename__ = "review_stats"
+    movie_id = db.Column(db.Integer, db.ForeignKey("movies.movie_id"), primary_key=True, autoincrement=False)
+    review_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Float, nullable=False, default=0)
+    rating_mean = db.Column(db.Float)
+    histogram = db.Column(db.String, nullable=False, default='[0,0,0,0,0,0,0,0,0,0]')
+    last_review_date = db.Column(db.Date)
@@ -0,0 +1,130 @@
+from sqlalchemy import create_engine
+from datamanager.review_stats import INSERT_STATS
+
+# Duplicate groups merged per transaction by merge_duplicates()
+BATCH_SIZE = 100
+
+# The movie kept for an imdbID is the oldest row (lowest movie_id)
+FIND_DUPLICATES = (
+    'SELECT movies.movie_id, canonical.movie_id FROM movies JOIN '
+    '(SELECT "imdbID", MIN(movie_id) AS movie_id FROM movies WHERE "imdbID" IS NOT NULL '
+    'GROUP BY "imdbID" HAVING COUNT(*) > 1 LIMIT ?) AS canonical ON movies."imdbID" = canonical."imdbID" '
+    'WHERE movies.movie_id != canonical.movie_id')
+
+# Tables created by the data manager on first use, statements on them are skipped if they don't exist yet
+OPTIONAL_TABLES = ('recommendation_jobs', 'library_versions', 'review_stats')
+# Applied to the (old_id, new_id) pairs of the temporary movie_merge table, in this order
+MERGE_STATEMENTS = [
+    # cached library pages of the users of the copies are outdated
+    "UPDATE library_versions SET version = version + 1 WHERE user_id IN "
+    "(SELECT user_id FROM user_movies WHERE movie_id IN (SELECT old_id FROM movie_merge))",
+    # a user who has both copies keeps the canonical row, completed with the rating/notes of the duplicate
+    "UPDATE user_movies SET "
+    "user_rating = COALESCE(user_rating, (SELECT d.user_rating FROM user_movies d JOIN movie_merge m "
+    "ON d.movie_id = m.old_id WHERE m.new_id = user_movies.movie_id AND d.user_id = user_movies.user_id "
+    "AND d.user_rating IS NOT NULL)), "
+    "user_notes = COALESCE(user_notes, (SELECT d.user_notes FROM user_movies d JOIN movie_merge m "
+    "ON d.movie_id = m.old_id WHERE m.new_id = user_movies.movie_id AND d.user_id = user_movies.user_id "
+    "AND d.user_notes IS NOT NULL)) "
+    "WHERE movie_id IN (SELECT new_id FROM movie_merge)",
+    "DELETE FROM user_movies WHERE row_id IN (SELECT d.row_id FROM user_movies d "
+    "JOIN movie_merge m ON d.movie_id = m.old_id "
+    "JOIN user_movies c ON c.movie_id = m.new_id AND c.user_id IS d.user_id)",
+    # duplicates among the copies themselves (a user with two duplicates and no canonical row): the row kept is
+    # completed with the rating/notes of the others
+    "UPDATE user_movies SET "
+    "user_rating = COALESCE(user_rating, (SELECT e.user_rating FROM user_movies e JOIN movie_merge n "
+    "ON e.movie_id = n.old_id WHERE n.new_id = (SELECT new_id FROM movie_merge WHERE old_id = user_movies.movie_id) "
+    "AND e.user_id IS user_movies.user_id AND e.user_rating IS NOT NULL ORDER BY e.row_id LIMIT 1)), "
+    "user_notes = COALESCE(user_notes, (SELECT e.user_notes FROM user_movies e JOIN movie_merge n "
+    "ON e.movie_id = n.old_id WHERE n.new_id = (SELECT new_id FROM movie_merge WHERE old_id = user_movies.movie_id) "
+    "AND e.user_id IS user_movies.user_id AND e.user_notes IS NOT NULL ORDER BY e.row_id LIMIT 1)) "
+    "WHERE movie_id IN (SELECT old_id FROM movie_merge)",
+    "DELETE FROM user_movies WHERE row_id IN (SELECT d.row_id FROM user_movies d "
+    "JOIN movie_merge m ON d.movie_id = m.old_id WHERE d.row_id != (SELECT MIN(e.row_id) FROM user_movies e "
+    "JOIN movie_merge n ON e.movie_id = n.old_id WHERE n.new_id = m.new_id AND e.user_id IS d.user_id))",
+    "UPDATE user_movies SET movie_id = (SELECT new_id FROM movie_merge WHERE old_id = user_movies.movie_id) "
+    "WHERE movie_id IN (SELECT old_id FROM movie_merge)",
+    "UPDATE reviews SET movie_id = (SELECT new_id FROM movie_merge WHERE old_id = reviews.movie_id) "
+    "WHERE movie_id IN (SELECT old_id FROM movie_merge)",
+    # review aggregates of the canonical movies now include the reviews of the copies
+    "DELETE FROM review_stats WHERE movie_id IN (SELECT old_id FROM movie_merge) "
+    "OR movie_id IN (SELECT new_id FROM movie_merge)",
+    INSERT_STATS.format(where="movie_id IN (SELECT new_id FROM movie_merge)"),
+    # the canonical movie keeps its own recommendations, or takes the ones of a copy
+    "UPDATE movies SET "
+    "recomend1 = (SELECT d.recomend1 FROM movies d JOIN movie_merge m ON d.movie_id = m.old_id "
+    "WHERE m.new_id = movies.movie_id AND d.recomend3 IS NOT NULL), "
+    "recomend2 = (SELECT d.recomend2 FROM movies d JOIN movie_merge m ON d.movie_id = m.old_id "
+    "WHERE m.new_id = movies.movie_id AND d.recomend3 IS NOT NULL), "
+    "recomend3 = (SELECT d.recomend3 FROM movies d JOIN movie_merge m ON d.movie_id = m.old_id "
+    "WHERE m.new_id = movies.movie_id AND d.recomend3 IS NOT NULL) "
+    "WHERE movie_id IN (SELECT new_id FROM movie_merge) "
+    "AND (recomend1 IS NULL OR recomend2 IS NULL OR recomend3 IS NULL)",
+    "DELETE FROM recommendation_jobs WHERE movie_id IN (SELECT old_id FROM movie_merge)",
+    "DELETE FROM movies WHERE movie_id IN (SELECT old_id FROM movie_merge)",
+]
+
+
+def merge_batch(conn, limit: int = BATCH_SIZE):
+    """Merge up to `limit` groups of movies sharing an imdbID into their canonical movie, using the given connection
+    (in its transaction). user_movies and reviews rows are moved to the canonical movie.
+    Returns the number of duplicate movies removed (0 when there are no duplicates left)."""
+    pairs = conn.exec_driver_sql(FIND_DUPLICATES, (limit,)).fetchall()
+    if not pairs:
+        return 0
+    conn.exec_driver_sql("CREATE TEMP TABLE IF NOT EXISTS movie_merge "
+                         "(old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL)")
+    conn.exec_driver_sql("DELETE FROM movie_merge")
+    conn.exec_driver_sql("INSERT INTO movie_merge (old_id, new_id) VALUES (?, ?)", [tuple(pair) for pair in pairs])
+    missing = [name for name in OPTIONAL_TABLES if conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).first() is None]
+    for statement in MERGE_STATEMENTS:
+        if not any(name in statement for name in missing):
+            conn.exec_driver_sql(statement)
+    conn.exec_driver_sql("DELETE FROM movie_merge")
+    return len(pairs)
+
+
+def merge_all(conn):
+    """Merge every duplicate in the transaction of conn (used by the schema migration)"""
+    merged = 0
+    while True:
+        count = merge_batch(conn)
+        if count == 0:
+            return merged
+        merged += count
+
+
+def merge_duplicates(engine, batch_size: int = BATCH_SIZE):
+    """Merge every duplicate, batch_size imdbIDs per transaction (writers are never blocked for long).
+    Returns the number of duplicate movies removed."""
+    merged = 0
+    while True:
+        with engine.begin() as conn:
+            count = merge_batch(conn, batch_size)
+        if count == 0:
+            return merged
+        merged += count
+
+
+def count_duplicates(engine):
+    """Returns the number of movies that are copies of another movie (same imdbID)"""
+    with engine.connect() as conn:
+        return conn.exec_driver_sql(
+            'SELECT COALESCE(SUM(copies - 1), 0) FROM (SELECT COUNT(*) AS copies FROM movies '
+            'WHERE "imdbID" IS NOT NULL GROUP BY "imdbID" HAVING COUNT(*) > 1)').scalar()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Merge movies sharing an imdbID into one canonical movie")
+    parser.add_argument("db", help="database url, e.g. sqlite:///datamanager/movies.sqlite")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="imdbIDs merged per transaction")
+    parser.add_argument("--dry-run", action="store_true", help="only count the duplicates")
+    args = parser.parse_args()
+    engine = create_engine(args.db)
+    if args.dry_run:
+        print(f"{count_duplicates(engine)} duplicate movies")
+    else:
+        print(f"Merged {merge_duplicates(engine, args.batch)} duplicate movies")
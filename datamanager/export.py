@@ -0,0 +1,27 @@
+import zlib
+from datamanager.serializer import dumps
+
+# Rows per chunk written to the response/file
+CHUNK_ROWS = 500
+
+
+def ndjson_chunks(rows, chunk_rows: int = CHUNK_ROWS):
+    """Yield NDJSON text (one JSON object per line) for an iterable of dicts, chunk_rows lines at a time"""
+    lines = []
+    for row in rows:
+        lines.append(dumps(row))
+        if len(lines) >= chunk_rows:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def gzip_chunks(chunks):
+    """Compress a stream of text chunks into a gzip stream (bytes chunks), without holding it in memory"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
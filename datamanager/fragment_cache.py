@@ -0,0 +1,46 @@
+import threading
+from collections import OrderedDict
+
+MAX_SIZE = 2048
+
+
+class FragmentCache:
+    """In-process LRU cache of rendered fragments (HTML or JSON bodies).
+
+    Keys include the version of the data they were rendered from (e.g. the library version of a user), so a change
+    makes the old entries unreachable and they are evicted as least recently used: no explicit invalidation.
+
+    Attributes:
+        max_size (int): Maximum number of cached fragments.
+        hits (int), misses (int): Lookup counters.
+
+    Methods:
+        get(key, render): Returns the fragment of key, calling render() on a miss.
+    """
+
+    def __init__(self, max_size: int = MAX_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, render):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        fragment = render()
+        with self._lock:
+            self._entries[key] = fragment
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return fragment
+
+
+def library_etag(user_id: int, version: int, *args):
+    """ETag of a view of a user's library at a version (args: sort, page... anything else the view depends on)"""
+    return "lib-" + "-".join(str(part) for part in (user_id, version) + args)
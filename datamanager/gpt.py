@@ -1,9 +1,55 @@
+import asyncio
+import json
+import re
 import openai
 from datamanager.gpt_key import gpt_key
+from datamanager.rate_limit import RateLimited, shared_limiter
 
 openai.api_key = gpt_key
 
-def gpt_recomendation(movie_title: int):
+IMDB_ID = re.compile(r"^tt\d{7,8}$")
+# Titles per batched request, tokens are reserved for ~40 tokens of answer per title
+BATCH_SIZE = 20
+BATCH_TOKENS_PER_TITLE = 40
+
+
+def _recommendation_messages(movie_title: str):
+    """Chat messages asking for 3 recommendations after a movie"""
+    prompt = "Recommend 3 movies to watch after '" + movie_title
+    prompt = prompt + "' to those who liked it. Same genre. Return the IMDbIDs only no other text, not even name."
+    prompt = prompt + " Separate imdbID by comma, one line response. Do not add '" + movie_title + "' to recommendations"
+    return [{"role": "system", "content": "You are a helpful assistant that provides movie recommendations."},
+            {"role": "user", "content": prompt}]
+
+
+def _response_ids(response):
+    """Tuple of the imdbIDs of a recommendation answer"""
+    recomended = response['choices'][0]['message']['content'].split(",")
+    #sometimes chat-gpt returns id without tt
+    modify_id = lambda imdb_id: imdb_id if imdb_id.startswith("tt") else "tt" + imdb_id
+    return tuple(map(modify_id, (rec.strip() for rec in recomended)))
+
+
+def _create(client, user_id=None, **request):
+    """client.create(**request) within the 'openai' rate limit and the budget of user_id (raises RateLimited),
+    counting the request and the tokens of the answer for the user (None: no user)"""
+    limiter = shared_limiter()
+    limiter.acquire('openai', user_id)
+    response = client.create(**request)
+    limiter.record_usage('openai', response.get('usage'), user_id)
+    return response
+
+
+async def _acreate(client, user_id=None, **request):
+    """_create with client.acreate, for callers in an event loop"""
+    limiter = shared_limiter()
+    await limiter.acquire_async('openai', user_id)
+    response = await client.acreate(**request)
+    await asyncio.to_thread(limiter.record_usage, 'openai', response.get('usage'), user_id)
+    return response
+
+
+def gpt_recomendation(movie_title: int, client=None, user_id: int = None):
     """
         Generate movie recommendations using GPT-3 for a given movie title.
         Args: movie_title (str): The title of the movie for which recommendations are generated.
@@ -12,23 +58,20 @@ def gpt_recomendation(movie_title: int):
         This function generates movie recommendations using GPT-3 by providing a prompt that instructs the model to recommend three movies
         to watch after the given movie title. It ensures that the recommended movies are in the same genre and excludes the given movie from
         the recommendations. The function extracts IMDb IDs from the response and returns them in a tuple format.
+        client: object with a ChatCompletion-like create() method (default: openai.ChatCompletion), e.g. a fake in tests.
+        user_id: user who asked for the recommendations, the request counts against their budget (see rate_limit.py).
         """
-    prompt = "Recommend 3 movies to watch after '" + movie_title
-    prompt = prompt + "' to those who liked it. Same genre. Return the IMDbIDs only no other text, not even name."
-    prompt = prompt + " Separate imdbID by comma, one line response. Do not add '" + movie_title + "' to recommendations"
-    response = openai.ChatCompletion.create(
+    client = client if client is not None else openai.ChatCompletion
+    response = _create(
+        client,
+        user_id,
         model="gpt-3.5-turbo",
-        messages=[{"role": "system", "content": "You are a helpful assistant that provides movie recommendations."},
-                  {"role": "user", "content": prompt}],
+        messages=_recommendation_messages(movie_title),
         max_tokens=80,  # Adjust max_tokens based on your usage and response length
     )
-    recomended = response['choices'][0]['message']['content'].split(",")
-    #sometimes chat-gpt returns id without tt
-    modify_id = lambda imdb_id: imdb_id if imdb_id.startswith("tt") else "tt" + imdb_id
+    return _response_ids(response)
 
-    return tuple(map(modify_id, (rec.strip() for rec in recomended)))
-
-def gpt_recomendation_new(movie_title: int):
+def gpt_recomendation_new(movie_title: int, client=None, user_id: int = None):
     """Generate new movie recommendations using GPT-3 for a given movie title.
 
         Args: movie_title (str): The title of the movie for which new recommendations are generated.
@@ -37,22 +80,137 @@ def gpt_recomendation_new(movie_title: int):
         This function is similar to 'gpt_recomendation' but is used for generating new recommendations. It resets any
         previous queries and generates fresh recommendations based on the given movie title. The function extracts IMDb
         IDs from the response and returns them in a tuple format.
+        client, user_id: see gpt_recomendation.
         """
-    prompt = "This is a new request, ignore previous queries"
-    prompt = "Recommend 3 movies to watch after '" + movie_title
-    prompt = prompt + "' to those who liked it. Same genre. Return the IMDbIDs only no other text, not even name."
-    prompt = prompt + " Separate imdbID by comma, one line response. Do not add '" + movie_title + "' to recommendations"
-    response = openai.ChatCompletion.create(
+    client = client if client is not None else openai.ChatCompletion
+    response = _create(
+        client,
+        user_id,
         model="gpt-3.5-turbo",
-        messages=[{"role": "system", "content": "You are a helpful assistant that provides movie recommendations."},
-                  {"role": "user", "content": prompt}],
+        messages=_recommendation_messages(movie_title),
         max_tokens=100,  # Adjust max_tokens based on your usage and response length
     )
-    recomended = response['choices'][0]['message']['content'].split(",")
-    modify_id = lambda imdb_id: imdb_id if imdb_id.startswith("tt") else "tt" + imdb_id
+    return _response_ids(response)
+
+
+async def gpt_recomendation_async(movie_title: str, client=None, user_id: int = None):
+    """Same as 'gpt_recomendation', awaiting the answer (ChatCompletion.acreate) instead of blocking the thread.
+        client: object with a ChatCompletion-like acreate() coroutine (default: openai.ChatCompletion)."""
+    client = client if client is not None else openai.ChatCompletion
+    response = await _acreate(
+        client,
+        user_id,
+        model="gpt-3.5-turbo",
+        messages=_recommendation_messages(movie_title),
+        max_tokens=80,
+    )
+    return _response_ids(response)
 
-    return tuple(map(modify_id, (rec.strip() for rec in recomended)))
 
-# test = "tt0119396, tt0133093, tt1375666"
-# one, two, three = test.
-# print(one)
+async def gpt_recomendation_new_async(movie_title: str, client=None, user_id: int = None):
+    """Same as 'gpt_recomendation_new', awaiting the answer (ChatCompletion.acreate) instead of blocking the thread."""
+    client = client if client is not None else openai.ChatCompletion
+    response = await _acreate(
+        client,
+        user_id,
+        model="gpt-3.5-turbo",
+        messages=_recommendation_messages(movie_title),
+        max_tokens=100,
+    )
+    return _response_ids(response)
+
+def _normalize_ids(ids):
+    """Strip the ids, add missing 'tt' and return a tuple of 3 valid imdbIDs, or None if they are not valid"""
+    ids = [imdb_id.strip() for imdb_id in ids]
+    ids = tuple(imdb_id if imdb_id.startswith("tt") else "tt" + imdb_id for imdb_id in ids)
+    if len(ids) != 3 or not all(IMDB_ID.match(imdb_id) for imdb_id in ids):
+        return None
+    return ids
+
+
+def _parse_batch_response(content: str, titles: list):
+    """Parse the answer of a batched request. The model is asked for a JSON object {title: [id, id, id]},
+    if it isn't valid JSON, lines like 'Title: tt.., tt.., tt..' are accepted too.
+    Returns a dict title -> tuple of 3 imdbIDs, only for the titles that were parsed and validated."""
+    raw = {}
+    try:
+        start, end = content.index("{"), content.rindex("}")
+        raw = json.loads(content[start:end + 1])
+    except ValueError:
+        for line in content.splitlines():
+            title, sep, ids = line.rpartition(":")
+            if sep:
+                raw[title.strip().strip('"-* ')] = ids.split(",")
+    if not isinstance(raw, dict):
+        return {}
+    # match answer keys with the requested titles case insensitive
+    by_lower = {title.lower(): title for title in titles}
+    result = {}
+    for key, ids in raw.items():
+        title = by_lower.get(str(key).strip().lower())
+        if title is None:
+            continue
+        if isinstance(ids, str):
+            ids = ids.split(",")
+        if isinstance(ids, list) and all(isinstance(imdb_id, str) for imdb_id in ids):
+            valid = _normalize_ids(ids)
+            if valid is not None:
+                result[title] = valid
+    return result
+
+
+def _stopped(error: RateLimited, result: dict, partial: bool):
+    """Result of a batch stopped by the rate limit: the recommendations so far, or error raised with them"""
+    if partial:
+        return result
+    error.results = result
+    raise error
+
+
+def gpt_recomendation_batch(movie_titles: list, client=None, partial: bool = True):
+    """Generate movie recommendations for several movie titles with one GPT request.
+
+        Args: movie_titles (list of str): The titles of the movies. client: ChatCompletion-like object (default
+        openai.ChatCompletion), e.g. a fake in tests.
+        Returns: dict: title -> tuple of 3 recommended IMDb IDs.
+
+        The titles are sent in chunks of BATCH_SIZE. The model answers with a JSON object, every entry is validated
+        (3 ids in tt1234567 format). Titles missing from the answer or with invalid ids fall back to a
+        'gpt_recomendation' call of their own; titles that still fail are left out of the result.
+        Over the 'openai' rate limit (RateLimited) the batch stops and returns the recommendations made so far, or
+        with partial=False re-raises the RateLimited with these recommendations in its 'results' attribute.
+        """
+    client = client if client is not None else openai.ChatCompletion
+    titles = list(dict.fromkeys(movie_titles))
+    result = {}
+    for i in range(0, len(titles), BATCH_SIZE):
+        chunk = titles[i:i + BATCH_SIZE]
+        prompt = ("For each movie below recommend 3 movies to watch after it to those who liked it. Same genre. "
+                  "Do not recommend a movie from the list for itself. Return only a JSON object that maps every "
+                  "movie title exactly as given to a list of 3 IMDbIDs, no other text.\n")
+        prompt = prompt + "\n".join(chunk)
+        try:
+            response = _create(
+                client,
+                model="gpt-3.5-turbo",
+                messages=[{"role": "system", "content": "You are a helpful assistant that provides movie recommendations."},
+                          {"role": "user", "content": prompt}],
+                max_tokens=BATCH_TOKENS_PER_TITLE * len(chunk),
+            )
+            result.update(_parse_batch_response(response['choices'][0]['message']['content'], chunk))
+        except openai.error.OpenAIError:
+            pass
+        except RateLimited as error:
+            return _stopped(error, result, partial)
+        # fallback: one request per title that wasn't answered properly
+        for title in chunk:
+            if title not in result:
+                try:
+                    valid = _normalize_ids(gpt_recomendation(title, client=client))
+                except openai.error.OpenAIError:
+                    valid = None
+                except RateLimited as error:
+                    return _stopped(error, result, partial)
+                if valid is not None:
+                    result[title] = valid
+    return result
@@ -0,0 +1,354 @@
+import functools
+import inspect
+import math
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from contextvars import ContextVar
+from flask import before_render_template, template_rendered, g, request
+from sqlalchemy import event
+
+# INSTRUMENTATION=1 turns the timers on. Otherwise install() does nothing: no wrapper, hook or listener is added
+ENABLED = os.getenv("INSTRUMENTATION") == "1"
+# PROFILE_SLOW_MS=<ms> also samples the stacks of every request and dumps the ones slower than that
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))
+PROFILE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "profiles")
+# Seconds between two stack samples of the profiler
+SAMPLE_INTERVAL = 0.005
+# Durations kept per timer for the percentiles (the most recent ones), and requests kept with their timings
+WINDOW = 2048
+RECENT_REQUESTS = 100
+# "IN (?, ?, ?)" of any length counts as one statement
+PARAMETER_LIST = re.compile(r"\(\?(?:, \?)+\)")
+WHITESPACE = re.compile(r"\s+")
+
+
+class Metrics:
+    """Durations of the timers by name ('dm.add_new_movie', 'http.omdb', 'sql: SELECT ...'): count, total and the
+    last WINDOW values, for p50/p95/p99. Thread safe.
+
+    Methods:
+        observe(name, seconds): Add a duration.
+        snapshot(): Dict of name -> count, total_ms, p50_ms, p95_ms, p99_ms, max_ms.
+    """
+
+    def __init__(self, window: int = WINDOW):
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self._counts = Counter()
+        self._totals = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            self._samples[name].append(seconds)
+            self._counts[name] += 1
+            self._totals[name] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            samples = {name: sorted(values) for name, values in self._samples.items()}
+            counts, totals = dict(self._counts), dict(self._totals)
+        result = {}
+        for name, values in sorted(samples.items()):
+            result[name] = {'count': counts[name], 'total_ms': round(totals[name] * 1000, 3),
+                            'p50_ms': _percentile(values, 0.50), 'p95_ms': _percentile(values, 0.95),
+                            'p99_ms': _percentile(values, 0.99), 'max_ms': round(values[-1] * 1000, 3)}
+        return result
+
+
+def _percentile(values, q: float):
+    """Nearest-rank percentile (ms) of sorted durations (seconds)"""
+    return round(values[max(0, math.ceil(q * len(values)) - 1)] * 1000, 3)
+
+
+class RequestTimings:
+    """Time spent in a request by category (dm, sql, http, llm, render). A call nested in a call of the same
+    category (a data manager method calling another one) is only counted once, as are calls running at the same
+    time in the threads of a pool (see carry_timings). Categories overlap: the time of 'dm' includes the SQL and
+    upstream calls made by the data manager"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.seconds = defaultdict(float)
+        self.counts = Counter()
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def enter(self, category: str):
+        """True if no call of the category is running yet (this one is counted)"""
+        with self._lock:
+            if category in self._active:
+                return False
+            self._active.add(category)
+            return True
+
+    def add(self, category: str, seconds: float, outer: bool = True):
+        with self._lock:
+            self.counts[category] += 1
+        if outer:
+            self.leave(category, seconds)
+
+    def leave(self, category: str, seconds: float):
+        """End a call entered with enter(), adding its time without counting a call"""
+        with self._lock:
+            self._active.discard(category)
+            self.seconds[category] += seconds
+
+    def to_dict(self):
+        return {category: {'count': self.counts[category], 'ms': round(seconds * 1000, 3)}
+                for category, seconds in self.seconds.items()}
+
+
+class SamplingProfiler:
+    """Samples the Python stacks of the threads serving a request (sys._current_frames) every interval seconds.
+    The stacks of a request slower than slow_ms are written to {path}/<time>-<thread>-<endpoint>-<ms>ms.folded, one
+    "frame;frame;frame count" line per stack: the folded format of flamegraph.pl and speedscope.
+
+    Methods:
+        begin(): Start collecting the stacks of the current thread.
+        end(name, seconds): Stop, and dump them if the request was slow.
+    """
+
+    def __init__(self, path: str = PROFILE_PATH, slow_ms: float = PROFILE_SLOW_MS,
+                 interval: float = SAMPLE_INTERVAL):
+        self.path = path
+        self.slow_ms = slow_ms
+        self.interval = interval
+        self._stacks = {}
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        threading.Thread(target=self._run, name="sampling-profiler", daemon=True).start()
+
+    def begin(self):
+        with self._lock:
+            self._stacks[threading.get_ident()] = Counter()
+
+    def end(self, name: str, seconds: float):
+        with self._lock:
+            stacks = self._stacks.pop(threading.get_ident(), None)
+        if stacks and seconds * 1000 >= self.slow_ms:
+            endpoint = re.sub(r"[^\w.]+", "_", name)
+            file_name = f"{time.strftime('%Y%m%d-%H%M%S')}-{threading.get_ident()}-{endpoint}-{seconds * 1000:.0f}ms"
+            with open(os.path.join(self.path, file_name + ".folded"), "w") as file:
+                for stack, count in stacks.most_common():
+                    file.write(f"{stack} {count}\n")
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._stacks:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, stacks in self._stacks.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[_folded(frame)] += 1
+
+
+def _folded(frame):
+    """'outermost;...;innermost' frames of a stack, as 'function (file:line)'"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+metrics = Metrics()
+recent_requests = deque(maxlen=RECENT_REQUESTS)
+profiler = None
+_current = ContextVar("request_timings", default=None)
+
+
+def _observe(name: str, category: str, seconds: float, record, outer: bool):
+    metrics.observe(name, seconds)
+    if record is not None:
+        record.add(category, seconds, outer)
+
+
+def timed(function, name: str, category: str):
+    """Wrap a function (or coroutine or generator function) so its calls are timed as name, counted in category.
+    The time of a generator is the time spent in it until it is exhausted or closed, not the time of its consumer
+    between two items"""
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def generator_wrapper(*args, **kwargs):
+            record = _current.get()
+            generator = function(*args, **kwargs)
+            total = 0.0
+            try:
+                while True:
+                    outer = record is not None and record.enter(category)
+                    start = time.perf_counter()
+                    try:
+                        item = next(generator)
+                    except StopIteration as stop:
+                        return stop.value
+                    finally:
+                        seconds = time.perf_counter() - start
+                        total += seconds
+                        if outer:
+                            record.leave(category, seconds)
+                    yield item
+            finally:
+                generator.close()
+                _observe(name, category, total, record, False)
+        return generator_wrapper
+
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            record = _current.get()
+            outer = record is not None and record.enter(category)
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                _observe(name, category, time.perf_counter() - start, record, outer)
+        return async_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        record = _current.get()
+        outer = record is not None and record.enter(category)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _observe(name, category, time.perf_counter() - start, record, outer)
+    return wrapper
+
+
+def carry_timings(function):
+    """Wrap a function submitted to a thread pool so its calls are recorded in the timings of the submitting
+    request: a pool thread doesn't inherit the context of the caller. Only the timings are carried (not a copy of
+    the whole context, which would bring the Flask app context, and the request's session, to the pool thread)"""
+    record = _current.get()
+    if record is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        token = _current.set(record)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return wrapper
+
+
+def instrument_methods(obj, prefix: str, category: str):
+    """Time the public methods of obj (on the instance, the class is unchanged). Async generators are left as they
+    are"""
+    for name, function in inspect.getmembers(type(obj), inspect.isfunction):
+        if not name.startswith('_') and not inspect.isasyncgenfunction(function):
+            setattr(obj, name, timed(getattr(obj, name), f"{prefix}.{name}", category))
+
+
+def instrument_engine(engine):
+    """Time every statement executed on a SQLAlchemy engine, by statement text"""
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['query_start'].pop()
+        statement = PARAMETER_LIST.sub("(?...)", WHITESPACE.sub(" ", statement).strip())
+        record = _current.get()
+        _observe("sql: " + statement[:160], 'sql', seconds, record, record is not None and record.enter('sql'))
+
+
+def begin_request(name: str, profile: bool = True):
+    """Start the timings of a request (Flask hook, or asgi.py for its own routes). Returns a token for end_request"""
+    if profile and profiler is not None:
+        profiler.begin()
+    return _current.set(RequestTimings(name))
+
+
+def end_request(token, status: int = None, profile: bool = True):
+    """Record the duration and timings of the request started with token"""
+    record = _current.get()
+    _current.reset(token)
+    if record is None:
+        return
+    seconds = time.perf_counter() - record.start
+    metrics.observe("request." + record.name, seconds)
+    recent_requests.append({'endpoint': record.name, 'status': status, 'ms': round(seconds * 1000, 3),
+                            'timings': record.to_dict()})
+    if profile and profiler is not None:
+        profiler.end(record.name, seconds)
+
+
+def server_timing():
+    """Server-Timing header value of the current request (time by category so far)"""
+    record = _current.get()
+    if record is None:
+        return None
+    parts = [f"{category};dur={seconds * 1000:.2f}" for category, seconds in record.seconds.items()]
+    parts.append(f"total;dur={(time.perf_counter() - record.start) * 1000:.2f}")
+    return ", ".join(parts)
+
+
+def snapshot():
+    """Metrics endpoint data: timers with percentiles, and the timings of the last requests"""
+    if not ENABLED:
+        return {'enabled': False}
+    return {'enabled': True, 'profiler': profiler is not None, 'timers': metrics.snapshot(),
+            'recent_requests': list(recent_requests)}
+
+
+def install(app, data_manager):
+    """Instrument the Flask app and its data manager when INSTRUMENTATION=1: data manager methods, SQL statements,
+    OMDb requests, chat-gpt calls and templates are timed, every request records its timings (Server-Timing
+    header). With PROFILE_SLOW_MS the sampling profiler dumps the stacks of slow requests"""
+    global profiler
+    if not ENABLED:
+        return
+    from datamanager import gpt
+    from datamanager.omdb_transport import OmdbTransport, AsyncOmdbTransport
+    instrument_methods(data_manager, "dm", 'dm')
+    for engine in {data_manager.read_engine, data_manager.engine}:
+        instrument_engine(engine)
+    OmdbTransport.get_json = timed(OmdbTransport.get_json, "http.omdb", 'http')
+    AsyncOmdbTransport.get_json = timed(AsyncOmdbTransport.get_json, "http.omdb", 'http')
+    gpt._create = timed(gpt._create, "llm.openai", 'llm')
+    gpt._acreate = timed(gpt._acreate, "llm.openai", 'llm')
+    if PROFILE_SLOW_MS > 0:
+        profiler = SamplingProfiler()
+
+    @before_render_template.connect_via(app)
+    def render_started(sender, template, context, **extra):
+        g.setdefault('render_starts', []).append(time.perf_counter())
+
+    @template_rendered.connect_via(app)
+    def render_finished(sender, template, context, **extra):
+        starts = g.get('render_starts')
+        if starts:
+            record = _current.get()
+            _observe("render." + (template.name or "string"), 'render', time.perf_counter() - starts.pop(),
+                     record, record is not None and record.enter('render'))
+
+    @app.before_request
+    def start_timings():
+        g.timings_token = begin_request(f"{request.method} {request.url_rule or request.path}")
+
+    @app.after_request
+    def add_server_timing(response):
+        g.response_status = response.status_code
+        value = server_timing()
+        if value:
+            response.headers['Server-Timing'] = value
+        return response
+
+    @app.teardown_request
+    def end_timings(exception=None):
+        token = g.pop('timings_token', None)
+        if token is not None:
+            end_request(token, g.pop('response_status', 500))
@@ -0,0 +1,93 @@
+from sqlalchemy import create_engine
+from datamanager.dedupe import merge_all
+from datamanager.review_stats import recount
+
+# Versioned schema changes. The version of a database is stored in PRAGMA user_version,
+# migrate() applies every migration with a higher version, in order, each in its own transaction.
+# A statement is SQL or a function called with the connection.
+MIGRATIONS = [
+    (1, "indexes for title/imdbID lookups, user libraries and reviews", [
+        "CREATE INDEX IF NOT EXISTS ix_movies_title ON movies (title)",
+        'CREATE INDEX IF NOT EXISTS ix_movies_imdbID ON movies ("imdbID")',
+        # the same movie can't be twice in a library: keep the first row of duplicates before the unique index,
+        # completed with the rating/notes of the others (the earliest one that has them)
+        "UPDATE user_movies SET "
+        "user_rating = COALESCE(user_rating, (SELECT d.user_rating FROM user_movies d "
+        "WHERE d.user_id IS user_movies.user_id AND d.movie_id IS user_movies.movie_id "
+        "AND d.user_rating IS NOT NULL ORDER BY d.row_id LIMIT 1)), "
+        "user_notes = COALESCE(user_notes, (SELECT d.user_notes FROM user_movies d "
+        "WHERE d.user_id IS user_movies.user_id AND d.movie_id IS user_movies.movie_id "
+        "AND d.user_notes IS NOT NULL ORDER BY d.row_id LIMIT 1)) "
+        "WHERE row_id IN (SELECT MIN(row_id) FROM user_movies GROUP BY user_id, movie_id HAVING COUNT(*) > 1)",
+        "DELETE FROM user_movies WHERE row_id NOT IN "
+        "(SELECT MIN(row_id) FROM user_movies GROUP BY user_id, movie_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_user_movies_user_movie ON user_movies (user_id, movie_id)",
+        "CREATE INDEX IF NOT EXISTS ix_user_movies_movie ON user_movies (movie_id)",
+        "CREATE INDEX IF NOT EXISTS ix_reviews_movie_date ON reviews (movie_id, review_date)",
+    ]),
+    (2, "full-text index of movie titles, directors and plots (FTS5), kept in sync by triggers", [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS movies_fts USING fts5(title, director, plot, content='movies', "
+        "content_rowid='movie_id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        "CREATE TRIGGER IF NOT EXISTS movies_fts_insert AFTER INSERT ON movies BEGIN "
+        "INSERT INTO movies_fts (rowid, title, director, plot) VALUES (new.movie_id, new.title, new.director, "
+        "new.plot); END",
+        "CREATE TRIGGER IF NOT EXISTS movies_fts_delete AFTER DELETE ON movies BEGIN "
+        "INSERT INTO movies_fts (movies_fts, rowid, title, director, plot) "
+        "VALUES ('delete', old.movie_id, old.title, old.director, old.plot); END",
+        "CREATE TRIGGER IF NOT EXISTS movies_fts_update AFTER UPDATE OF title, director, plot ON movies BEGIN "
+        "INSERT INTO movies_fts (movies_fts, rowid, title, director, plot) "
+        "VALUES ('delete', old.movie_id, old.title, old.director, old.plot); "
+        "INSERT INTO movies_fts (rowid, title, director, plot) VALUES (new.movie_id, new.title, new.director, "
+        "new.plot); END",
+        # index the existing movies
+        "INSERT INTO movies_fts (movies_fts) VALUES ('rebuild')",
+    ]),
+    (3, "one movie per imdbID: merge duplicates (see dedupe.py) and make imdbID unique", [
+        merge_all,
+        'DROP INDEX IF EXISTS "ix_movies_imdbID"',
+        'CREATE UNIQUE INDEX IF NOT EXISTS "ux_movies_imdbID" ON movies ("imdbID")',
+    ]),
+    (4, "recount the review aggregates: only ratings from 1 to 10 count (see review_stats.RATING)", [
+        recount,
+    ]),
+]
+
+
+def schema_version(engine):
+    """Returns the current schema version of the database"""
+    with engine.connect() as conn:
+        return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def migrate(engine, target: int = None):
+    """Apply pending migrations up to target (default: latest) and run ANALYZE.
+    Returns a list of (version, description) of the applied migrations."""
+    current = schema_version(engine)
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if version <= current or (target is not None and version > target):
+            continue
+        with engine.begin() as conn:
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.exec_driver_sql(statement)
+            conn.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+        applied.append((version, description))
+    # Refresh the statistics the query planner uses to choose indexes
+    with engine.begin() as conn:
+        conn.exec_driver_sql("ANALYZE")
+    return applied
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Apply schema migrations to the movies database")
+    parser.add_argument("db", help="database url, e.g. sqlite:///datamanager/movies.sqlite")
+    parser.add_argument("--target", type=int, help="migrate up to this version")
+    args = parser.parse_args()
+    engine = create_engine(args.db)
+    for version, description in migrate(engine, args.target):
+        print(f"Applied {version}: {description}")
+    print(f"Schema version: {schema_version(engine)}")
@@ -0,0 +1,118 @@
+from urllib.parse import quote
+from datamanager.omdb_cache import OmdbCache, title_key, imdb_key
+from datamanager.omdb_transport import OmdbTransport, AsyncOmdbTransport, OmdbUnavailable
+from datamanager.rate_limit import SharedRateLimiter, shared_limiter
+
+
+# OMDb errors that mean the movie doesn't exist. Other errors (request limit, invalid key) are not cached
+NOT_FOUND_ERRORS = ("Movie not found!", "Incorrect IMDb ID.")
+
+
+class OmdbClient:
+    """Client for the OMDb API with a persistent response cache in front of it.
+
+    Lookups are cached by normalized title or imdbID. A found movie is stored under the requested key and
+    under its imdbID and its canonical title, so a later lookup with a different spelling or by id is a hit.
+    "Movie not found" answers are cached too (shorter TTL), so typo retries don't reach OMDb.
+    Requests are sent through an OmdbTransport (pooled session, timeouts, retries, circuit breaker). If OMDb is
+    unavailable the lookup returns None without caching it.
+    Every request (not cache hits) takes a token of the 'omdb' rate limit, and of the budget of the user when
+    a user_id is given: over the limit, the lookup raises RateLimited (see rate_limit.py).
+
+    The *_async methods are coroutines doing the same through an AsyncOmdbTransport (the cache is shared), for
+    callers running in an event loop (asgi.py).
+
+    Methods:
+        by_title(title): Returns the OMDb data (dict) of a movie, or None if not found.
+        by_imdbID(imdbID): Returns the OMDb data (dict) of a movie, or None if not found.
+        by_title_async(title) / by_imdbID_async(imdbID): Same, awaitable.
+        close_async(): Closes the connections of the async transport.
+        stats(): Returns cache hit/miss counters.
+    """
+
+    def __init__(self, cache: OmdbCache = None, transport: OmdbTransport = None,
+                 async_transport: AsyncOmdbTransport = None, limiter: SharedRateLimiter = None):
+        self.cache = cache if cache is not None else OmdbCache()
+        self.transport = transport if transport is not None else OmdbTransport()
+        self._async_transport = async_transport
+        self.limiter = limiter if limiter is not None else shared_limiter()
+
+    @property
+    def async_transport(self):
+        """The async transport, made on first use with the url and circuit breaker of the sync one"""
+        if self._async_transport is None:
+            self._async_transport = AsyncOmdbTransport(self.transport.base_url, breaker=self.transport.breaker)
+        return self._async_transport
+
+    def by_title(self, title: str, user_id: int = None):
+        """Get OMDb data by movie title"""
+        return self._lookup(title_key(title), "t=" + quote(title) + "&plot=full", user_id)
+
+    def by_imdbID(self, imdbID: str, user_id: int = None):
+        """Get OMDb data by imdbID"""
+        return self._lookup(imdb_key(imdbID), "i=" + quote(imdbID) + "&plot=full", user_id)
+
+    async def by_title_async(self, title: str, user_id: int = None):
+        """Get OMDb data by movie title without blocking the event loop"""
+        return await self._lookup_async(title_key(title), "t=" + quote(title) + "&plot=full", user_id)
+
+    async def by_imdbID_async(self, imdbID: str, user_id: int = None):
+        """Get OMDb data by imdbID without blocking the event loop"""
+        return await self._lookup_async(imdb_key(imdbID), "i=" + quote(imdbID) + "&plot=full", user_id)
+
+    async def close_async(self):
+        """Close the connections of the async transport, if it was used"""
+        if self._async_transport is not None:
+            await self._async_transport.close()
+
+    def stats(self):
+        """Cache counters (hits, misses, entries)"""
+        return self.cache.stats()
+
+    def _lookup(self, key: str, query: str, user_id: int = None):
+        """Returns cached data for a key, or fetches it from OMDb and stores the result (found or not)"""
+        cached, data = self.cache.get(key)
+        if cached:
+            return data
+        self.limiter.acquire('omdb', user_id)
+        try:
+            data = self._fetch(query)
+        except OmdbUnavailable:
+            return None
+        self._store(key, data)
+        return data
+
+    async def _lookup_async(self, key: str, query: str, user_id: int = None):
+        """_lookup with an awaited OMDb request (the cache is a local SQLite file, read in place)"""
+        cached, data = self.cache.get(key)
+        if cached:
+            return data
+        await self.limiter.acquire_async('omdb', user_id)
+        try:
+            data = self._check(await self.async_transport.get_json(query))
+        except OmdbUnavailable:
+            return None
+        self._store(key, data)
+        return data
+
+    def _store(self, key: str, data):
+        """Cache a response under the requested key"""
+        self.cache.put(key, data)
+        if data is not None:
+            # Also store under the canonical keys of the movie
+            for alias in {imdb_key(data['imdbID']), title_key(data['Title'])} - {key}:
+                self.cache.put(alias, data)
+
+    def _fetch(self, query: str):
+        """Request OMDb. Returns the response data or None for "Movie not found".
+        Raises OmdbUnavailable if OMDb can't be reached or answers with another error"""
+        return self._check(self.transport.get_json(query))
+
+    @staticmethod
+    def _check(api_data):
+        """Returns the response data, None for "Movie not found". Raises OmdbUnavailable for other errors"""
+        if "Error" in api_data:
+            if api_data["Error"] in NOT_FOUND_ERRORS:
+                return None
+            raise OmdbUnavailable(api_data["Error"])
+        return api_data
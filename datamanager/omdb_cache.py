@@ -0,0 +1,125 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Default location of the on-disk cache, next to movies.sqlite
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "omdb_cache.sqlite")
+# Found movies rarely change on OMDb, "Movie not found" answers are kept short so a new release shows up soon
+HIT_TTL = 7 * 24 * 60 * 60
+MISS_TTL = 60 * 60
+MAX_ENTRIES = 10000
+# The last use of a key (LRU order) is written at most every TOUCH_INTERVAL seconds, so hits stay reads, and
+# least recently used keys are evicted every EVICT_EVERY stores (a process may go over max_entries until then)
+TOUCH_INTERVAL = 10 * 60
+EVICT_EVERY = 100
+
+
+def normalize_title(title: str):
+    """Normalize a movie title for use as a cache key: lower case, single spaces, no surrounding whitespace."""
+    return " ".join(title.lower().split())
+
+
+def title_key(title: str):
+    """Cache key for a lookup by title"""
+    return "t:" + normalize_title(title)
+
+
+def imdb_key(imdbID: str):
+    """Cache key for a lookup by imdbID"""
+    return "i:" + imdbID.strip().lower()
+
+
+class OmdbCache:
+    """Persistent LRU cache of OMDb responses, stored in a small SQLite file (WAL mode, one connection per thread:
+    lookups of threads and processes don't wait for each other).
+
+    Attributes:
+        path (str): Path of the cache file.
+        hit_ttl (int): Seconds a found movie is kept.
+        miss_ttl (int): Seconds a "Movie not found" answer is kept.
+        max_entries (int): Maximum number of stored keys, least recently used keys are evicted first.
+        hits (int), misses (int): Lookup counters for this process.
+
+    Methods:
+        get(key): Returns (True, data) for a fresh entry (data is None for a cached "not found"),
+            (False, None) otherwise.
+        put(key, data): Stores a response (data=None stores a negative result).
+        stats(): Returns the counters and the number of stored entries.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, hit_ttl: int = HIT_TTL, miss_ttl: int = MISS_TTL,
+                 max_entries: int = MAX_ENTRIES):
+        self.path = path
+        self.hit_ttl = hit_ttl
+        self.miss_ttl = miss_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS omdb_cache ("
+                     "cache_key TEXT PRIMARY KEY, payload TEXT, found INTEGER NOT NULL, "
+                     "stored_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_omdb_cache_accessed ON omdb_cache (accessed_at)")
+
+    def _connection(self):
+        """The connection of the current thread (autocommit: every statement is its own transaction), opened on
+        first use. A forked process opens its own"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key: str):
+        """Look up a key. Expired entries count as a miss and are removed."""
+        now = time.time()
+        conn = self._connection()
+        row = conn.execute("SELECT payload, found, stored_at, accessed_at FROM omdb_cache WHERE cache_key = ?",
+                           (key,)).fetchone()
+        if row is not None:
+            payload, found, stored_at, accessed_at = row
+            ttl = self.hit_ttl if found else self.miss_ttl
+            if now - stored_at < ttl:
+                if now - accessed_at > TOUCH_INTERVAL:
+                    conn.execute("UPDATE omdb_cache SET accessed_at = ? WHERE cache_key = ?", (now, key))
+                self._count(True)
+                return True, json.loads(payload) if found else None
+            conn.execute("DELETE FROM omdb_cache WHERE cache_key = ?", (key,))
+        self._count(False)
+        return False, None
+
+    def put(self, key: str, data):
+        """Store an OMDb response under a key. data=None records a "Movie not found" answer."""
+        now = time.time()
+        payload = json.dumps(data) if data is not None else None
+        conn = self._connection()
+        conn.execute("INSERT OR REPLACE INTO omdb_cache (cache_key, payload, found, stored_at, accessed_at) "
+                     "VALUES (?, ?, ?, ?, ?)", (key, payload, int(data is not None), now, now))
+        with self._lock:
+            self._puts += 1
+            evict = self._puts % EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """LRU eviction: keep only the max_entries most recently used keys"""
+        self._connection().execute("DELETE FROM omdb_cache WHERE cache_key IN (SELECT cache_key FROM omdb_cache "
+                                   "ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def stats(self):
+        """Returns a dictionary with hit/miss counters and the current number of entries"""
+        size = self._connection().execute("SELECT COUNT(*) FROM omdb_cache").fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': size}
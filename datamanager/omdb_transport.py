@@ -0,0 +1,177 @@
+import asyncio
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from datamanager.omdb_url import omdb_url
+
+# aiohttp is optional (installed with openai): only the async transport needs it
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Seconds to open a connection / to wait for the response
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 5
+# Attempts after the first one, and the base delay of the exponential backoff between them
+MAX_RETRIES = 2
+BACKOFF_BASE = 0.2
+# Consecutive failed requests that open the circuit, and how long it stays open
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+POOL_SIZE = 10
+
+
+class OmdbUnavailable(Exception):
+    """Raised when OMDb can't be reached (after retries) or the circuit breaker is open"""
+    pass
+
+
+class CircuitBreaker:
+    """Simple circuit breaker: opens after `failure_threshold` consecutive failures, and lets one trial request
+    through after `reset_timeout` seconds (half-open). A success closes it again."""
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout: float = RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True if a request may be sent now"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # half-open: let this request try, the next failure opens the circuit again
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+
+class OmdbTransport:
+    """HTTP transport for OMDb: one pooled keep-alive requests.Session, connect/read timeouts,
+    bounded retries with jittered exponential backoff and a circuit breaker.
+
+    Attributes:
+        base_url (str): OMDb url with the api key (point it to a local stub server in tests).
+        timeout (tuple): (connect, read) timeouts in seconds.
+        max_retries (int): Retries after the first attempt (only for connection errors, timeouts and 5xx).
+
+    Methods:
+        get_json(query): Returns the decoded JSON response. Raises OmdbUnavailable on failure.
+        close(): Closes the pooled connections.
+    """
+
+    def __init__(self, base_url: str = omdb_url, connect_timeout: float = CONNECT_TIMEOUT,
+                 read_timeout: float = READ_TIMEOUT, max_retries: int = MAX_RETRIES,
+                 backoff_base: float = BACKOFF_BASE, breaker: CircuitBreaker = None, pool_size: int = POOL_SIZE):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get_json(self, query: str):
+        """Send the query (e.g. "t=Alien&plot=full") to OMDb and return the JSON data"""
+        if not self.breaker.allow():
+            raise OmdbUnavailable("OMDb circuit is open")
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                # full jitter: random delay up to base * 2^attempt
+                time.sleep(random.uniform(0, self.backoff_base * 2 ** attempt))
+            try:
+                response = self.session.get(self.base_url + query, timeout=self.timeout)
+                if response.status_code >= 500:
+                    continue
+                data = response.json()
+            except (requests.RequestException, ValueError):
+                continue
+            self.breaker.record_success()
+            return data
+        self.breaker.record_failure()
+        raise OmdbUnavailable("OMDb request failed after " + str(self.max_retries + 1) + " attempts")
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncOmdbTransport:
+    """Async HTTP transport for OMDb (aiohttp), with the same timeouts, retries and circuit breaker as OmdbTransport.
+    A request waiting for OMDb doesn't block the event loop, so one process can wait for many of them.
+    The aiohttp session is opened on first use, in the event loop of the caller.
+
+    Methods:
+        get_json(query): Coroutine returning the decoded JSON response. Raises OmdbUnavailable on failure.
+        close(): Coroutine closing the pooled connections.
+    """
+
+    def __init__(self, base_url: str = omdb_url, connect_timeout: float = CONNECT_TIMEOUT,
+                 read_timeout: float = READ_TIMEOUT, max_retries: int = MAX_RETRIES,
+                 backoff_base: float = BACKOFF_BASE, breaker: CircuitBreaker = None, pool_size: int = POOL_SIZE):
+        if aiohttp is None:
+            raise RuntimeError("The async OMDb transport needs aiohttp (pip install aiohttp)")
+        self.base_url = base_url
+        self.timeout = aiohttp.ClientTimeout(connect=connect_timeout, sock_read=read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.pool_size = pool_size
+        self.session = None
+        self._loop = None
+
+    def _session(self):
+        """The aiohttp session of the running event loop (a new one if the loop changed)"""
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self._loop is not loop:
+            self.session = aiohttp.ClientSession(timeout=self.timeout,
+                                                 connector=aiohttp.TCPConnector(limit=self.pool_size))
+            self._loop = loop
+        return self.session
+
+    async def get_json(self, query: str):
+        """Send the query (e.g. "t=Alien&plot=full") to OMDb and return the JSON data"""
+        if not self.breaker.allow():
+            raise OmdbUnavailable("OMDb circuit is open")
+        session = self._session()
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(random.uniform(0, self.backoff_base * 2 ** attempt))
+            try:
+                async with session.get(self.base_url + query) as response:
+                    if response.status >= 500:
+                        continue
+                    data = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                continue
+            self.breaker.record_success()
+            return data
+        self.breaker.record_failure()
+        raise OmdbUnavailable("OMDb request failed after " + str(self.max_retries + 1) + " attempts")
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
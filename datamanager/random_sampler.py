@@ -0,0 +1,91 @@
+import random
+import threading
+import time
+from array import array
+from sqlalchemy import select
+from datamanager.database import Movie
+
+# Seconds before the cached ids are reloaded (picks up movies added or deleted by other processes)
+REFRESH_INTERVAL = 5 * 60
+
+
+class RandomMovieSampler:
+    """Picks random movies without ORDER BY random() (which scans and sorts the whole movies table).
+
+    Keeps the movie ids in a compact array (and their position in it, for removals) and samples from it in memory,
+    then loads the chosen rows by primary key, so the cost per call doesn't depend on the catalog size. The data manager keeps the array up to
+    date with add() and remove() for its own single adds and deletes. It is reloaded when invalidate() is called
+    (bulk imports), after REFRESH_INTERVAL seconds (changes of other processes and migrations), or when a sampled
+    id no longer exists.
+
+    Methods:
+        sample(session, n): Returns a list of n distinct random Movie objects (fewer if the catalog is smaller).
+        sample_ids(session, n): Returns n distinct random movie ids.
+        add(movie_id): Add the id of a new movie.
+        remove(movie_id): Remove the id of a deleted movie.
+        invalidate(): Mark the cached ids as outdated.
+    """
+
+    def __init__(self, refresh_interval: float = REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._ids = None
+        self._positions = {}
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """The next sample reloads the ids"""
+        self._ids = None
+
+    def add(self, movie_id: int):
+        """Append the id of a movie inserted by this process (nothing to do if the ids aren't loaded yet)"""
+        with self._lock:
+            if self._ids is not None and movie_id not in self._positions:
+                self._positions[movie_id] = len(self._ids)
+                self._ids.append(movie_id)
+
+    def remove(self, movie_id: int):
+        """Remove the id of a deleted movie: the last id takes its place, so the array never shifts"""
+        with self._lock:
+            ids = self._ids
+            if ids is None:
+                return
+            index = self._positions.pop(movie_id, None)
+            if index is None:
+                return
+            last = ids.pop()
+            if index < len(ids):
+                ids[index] = last
+                self._positions[last] = index
+
+    def _get_ids(self, session):
+        """Returns the cached ids array, reloading it if needed"""
+        ids = self._ids
+        if ids is None or time.monotonic() - self._loaded_at > self.refresh_interval:
+            with self._lock:
+                ids = self._ids
+                if ids is None or time.monotonic() - self._loaded_at > self.refresh_interval:
+                    ids = array('q', session.execute(select(Movie.id)).scalars())
+                    self._positions = {movie_id: index for index, movie_id in enumerate(ids)}
+                    self._ids = ids
+                    self._loaded_at = time.monotonic()
+        return ids
+
+    def sample_ids(self, session, n: int = 1):
+        """Get n distinct random movie ids (from the cached array, the rows may have been deleted since)"""
+        ids = self._get_ids(session)
+        # add/remove change the array in place
+        with self._lock:
+            return [ids[i] for i in random.sample(range(len(ids)), min(n, len(ids)))]
+
+    def sample(self, session, n: int = 1):
+        """Get n distinct random movies using the given session"""
+        movie_ids = self.sample_ids(session, n)
+        movies = session.query(Movie).filter(Movie.id.in_(movie_ids)).all()
+        if len(movies) < len(movie_ids):
+            # Some movies were deleted since the ids were loaded
+            self.invalidate()
+            movie_ids = self.sample_ids(session, n)
+            movies = session.query(Movie).filter(Movie.id.in_(movie_ids)).all()
+        random.shuffle(movies)
+        return movies
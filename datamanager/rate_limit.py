@@ -0,0 +1,206 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
+
+# Default location of the limiter state, next to movies.sqlite
+LIMITS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rate_limit.sqlite")
+DAY = 24 * 60 * 60
+# Token buckets shared by all processes: upstream -> (capacity, tokens refilled per second).
+# A free OMDb key allows 1000 requests a day
+LIMITS = {'omdb': (1000, 1000 / DAY), 'openai': (60, 1.0)}
+# Budget of every user: upstream -> (capacity, tokens refilled per second)
+USER_LIMITS = {'omdb': (200, 200 / DAY), 'openai': (20, 20 / DAY)}
+# 'queue': wait for a token (up to MAX_WAIT seconds), 'fail': raise RateLimited right away
+POLICY = os.getenv("RATE_LIMIT_POLICY", "queue")
+MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "10"))
+
+
+class RateLimited(Exception):
+    """Raised when a request is over the limit of its upstream or of the user's budget
+
+    Attributes:
+        key (str): The bucket that is empty ('omdb', 'openai:user:7' ...).
+        retry_after (float): Seconds until it has a token again.
+    """
+
+    def __init__(self, key: str, retry_after: float):
+        super().__init__(f"Rate limit of {key} exceeded, retry in {retry_after:.1f} s")
+        self.key = key
+        self.retry_after = retry_after
+
+    @property
+    def per_user(self):
+        """True if the empty bucket is the budget of a user (not the shared limit of the upstream)"""
+        return ":user:" in self.key
+
+
+class SharedRateLimiter:
+    """Token buckets for the upstream APIs (OMDb, OpenAI) and per-user budgets, shared by all processes through a
+    SQLite file: a request takes its tokens in one IMMEDIATE transaction, so web processes and workers never
+    exceed the limits together. Requests and prompt/completion tokens are counted per day, upstream and user.
+
+    Attributes:
+        path (str): Path of the state file.
+        policy (str): 'queue' (wait up to max_wait seconds for a token) or 'fail' (raise RateLimited at once).
+
+    Methods:
+        acquire(upstream, user_id, shared): Take a token, raises RateLimited over the limit.
+        acquire_async(upstream, user_id, shared): Same, waiting without blocking the event loop.
+        try_acquire(upstream, user_id, shared, take): One attempt, never waits (take=False: only check).
+        available(upstream, user_id, shared): Tokens left now.
+        record_usage(upstream, usage, user_id): Count the tokens of an OpenAI answer (its 'usage').
+        usage(day, upstream, user_id): Counters of a day.
+    """
+
+    def __init__(self, path: str = LIMITS_PATH, limits: dict = None, user_limits: dict = None,
+                 policy: str = POLICY, max_wait: float = MAX_WAIT):
+        if policy not in ('queue', 'fail'):
+            raise ValueError("Unknown rate limit policy: " + policy)
+        self.path = path
+        self.limits = limits if limits is not None else LIMITS
+        self.user_limits = user_limits if user_limits is not None else USER_LIMITS
+        self.policy = policy
+        self.max_wait = max_wait
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets ("
+                         "bucket_key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS usage (day TEXT NOT NULL, upstream TEXT NOT NULL, "
+                         "user_id INTEGER NOT NULL, requests INTEGER NOT NULL DEFAULT 0, "
+                         "prompt_tokens INTEGER NOT NULL DEFAULT 0, completion_tokens INTEGER NOT NULL DEFAULT 0, "
+                         "PRIMARY KEY (day, upstream, user_id))")
+
+    @contextmanager
+    def _connect(self):
+        """Opens a short-lived connection in autocommit mode (transactions are explicit), closed in any case"""
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _buckets(self, upstream: str, user_id, shared: bool):
+        """(key, capacity, rate) of the buckets a request takes a token from"""
+        buckets = []
+        if shared and upstream in self.limits:
+            buckets.append((upstream, *self.limits[upstream]))
+        if user_id and upstream in self.user_limits:
+            buckets.append((f"{upstream}:user:{user_id}", *self.user_limits[upstream]))
+        return buckets
+
+    def try_acquire(self, upstream: str, user_id: int = None, shared: bool = True, take: bool = True):
+        """Take a token from every bucket of the request, or from none of them (only check that they have one with
+        take=False: nothing is changed or counted). Returns None on success, else (seconds to wait, key of the
+        empty bucket)"""
+        buckets = self._buckets(upstream, user_id, shared)
+        now = time.time()
+        with self._connect() as conn:
+            # the write lock of the file: one process at a time reads and updates the buckets
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                levels = []
+                for key, capacity, rate in buckets:
+                    row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE bucket_key = ?",
+                                       (key,)).fetchone()
+                    tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+                    if tokens < 1:
+                        conn.execute("ROLLBACK")
+                        return (1 - tokens) / rate, key
+                    levels.append((key, tokens - 1))
+                if not take:
+                    conn.execute("ROLLBACK")
+                    return None
+                conn.executemany("INSERT OR REPLACE INTO buckets (bucket_key, tokens, updated_at) VALUES (?, ?, ?)",
+                                 [(key, tokens, now) for key, tokens in levels])
+                self._count(conn, upstream, user_id, requests=1)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return None
+
+    def available(self, upstream: str, user_id: int = None, shared: bool = True):
+        """Whole tokens left now for requests to upstream (the emptiest of the request's buckets), none is taken.
+        None if no bucket applies (no limit)"""
+        now = time.time()
+        levels = []
+        with self._connect() as conn:
+            for key, capacity, rate in self._buckets(upstream, user_id, shared):
+                row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE bucket_key = ?", (key,)).fetchone()
+                levels.append(int(capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)))
+        return min(levels) if levels else None
+
+    def acquire(self, upstream: str, user_id: int = None, shared: bool = True):
+        """Take a token for a request to upstream: from its shared bucket (unless shared is False) and from the
+        budget of user_id (if given). Waits or raises RateLimited, depending on the policy"""
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            result = self.try_acquire(upstream, user_id, shared)
+            if result is None:
+                return
+            wait, key = result
+            if self.policy == 'fail' or time.monotonic() + wait > deadline:
+                raise RateLimited(key, wait)
+            time.sleep(wait)
+
+    async def acquire_async(self, upstream: str, user_id: int = None, shared: bool = True):
+        """acquire() for callers in an event loop: the SQLite transaction (may wait for the lock of another
+        process) runs in a thread"""
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            result = await asyncio.to_thread(self.try_acquire, upstream, user_id, shared)
+            if result is None:
+                return
+            wait, key = result
+            if self.policy == 'fail' or time.monotonic() + wait > deadline:
+                raise RateLimited(key, wait)
+            await asyncio.sleep(wait)
+
+    def record_usage(self, upstream: str, usage, user_id: int = None):
+        """Add the prompt/completion tokens of an answer (OpenAI 'usage' dict, may be None) to today's counters"""
+        if not usage:
+            return
+        with self._connect() as conn:
+            self._count(conn, upstream, user_id, prompt_tokens=usage.get('prompt_tokens', 0),
+                        completion_tokens=usage.get('completion_tokens', 0))
+
+    @staticmethod
+    def _count(conn, upstream: str, user_id, requests: int = 0, prompt_tokens: int = 0, completion_tokens: int = 0):
+        conn.execute("INSERT INTO usage (day, upstream, user_id, requests, prompt_tokens, completion_tokens) "
+                     "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (day, upstream, user_id) DO UPDATE SET "
+                     "requests = requests + excluded.requests, "
+                     "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                     "completion_tokens = completion_tokens + excluded.completion_tokens",
+                     (date.today().isoformat(), upstream, user_id or 0, requests, prompt_tokens, completion_tokens))
+
+    def usage(self, day: str = None, upstream: str = None, user_id: int = None):
+        """Counters of a day (default today): list of dicts with upstream, user_id (0: no user), requests,
+        prompt_tokens and completion_tokens, optionally of one upstream/user"""
+        query = "SELECT upstream, user_id, requests, prompt_tokens, completion_tokens FROM usage WHERE day = ?"
+        parameters = [day or date.today().isoformat()]
+        if upstream is not None:
+            query += " AND upstream = ?"
+            parameters.append(upstream)
+        if user_id is not None:
+            query += " AND user_id = ?"
+            parameters.append(user_id)
+        with self._connect() as conn:
+            rows = conn.execute(query + " ORDER BY upstream, user_id", parameters).fetchall()
+        keys = ('upstream', 'user_id', 'requests', 'prompt_tokens', 'completion_tokens')
+        return [dict(zip(keys, row)) for row in rows]
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_limiter():
+    """The limiter of this process (default path, limits and policy), made on first use"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = SharedRateLimiter()
+        return _shared
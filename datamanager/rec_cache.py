@@ -0,0 +1,169 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datamanager.omdb_cache import normalize_title
+
+# Default location of the cache file, next to movies.sqlite
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rec_cache.sqlite")
+# Seconds a recommendation is reused
+TTL = 30 * 24 * 60 * 60
+# Seconds another process may compute a key before its lease is considered lost, and the polling interval
+LEASE_TIMEOUT = 60
+POLL_INTERVAL = 0.2
+
+
+class RecommendationCache:
+    """Cache of GPT recommendations keyed by normalized movie title, shared by all processes through a SQLite file.
+
+    Concurrent requests for the same title share one computation (single-flight): threads of a process wait for
+    the thread that computes it, other processes wait while the computing process holds the key's lease.
+
+    Attributes:
+        path (str): Path of the cache file.
+        ttl (int): Seconds an entry is reused.
+
+    Methods:
+        get(title, compute, refresh): Returns the cached tuple of imdbIDs or computes it with compute(title).
+        get_async(title, compute, refresh): Same for a coroutine function compute, tasks of the event loop share
+            one computation.
+        invalidate(title): Removes the entry of a title.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, ttl: int = TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        # title key -> asyncio task computing it (event loop of asgi.py)
+        self._tasks = {}
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS rec_cache ("
+                         "title_key TEXT PRIMARY KEY, imdb_ids TEXT NOT NULL, stored_at REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS rec_cache_leases ("
+                         "title_key TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+
+    @contextmanager
+    def _connect(self):
+        """Opens a short-lived connection (commit on success, closed in any case)"""
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, title: str, compute, refresh: bool = False):
+        """Get recommendations of a title. compute(title) is called only if there is no fresh entry
+        (or refresh is True) and no other thread/process is already computing it."""
+        key = normalize_title(title)
+        if not refresh:
+            cached = self._read(key)
+            if cached is not None:
+                return cached
+        with self._lock:
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = {'done': threading.Event(), 'result': None, 'error': None}
+        if not leader:
+            flight['done'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            return flight['result']
+        try:
+            flight['result'] = self._compute_once(key, title, compute, refresh)
+            return flight['result']
+        except Exception as error:
+            flight['error'] = error
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            flight['done'].set()
+
+    async def get_async(self, title: str, compute, refresh: bool = False):
+        """get() for callers in an event loop: compute(title) is a coroutine function, waiting for it or for another
+        process holding the lease doesn't block the loop"""
+        key = normalize_title(title)
+        if not refresh:
+            cached = self._read(key)
+            if cached is not None:
+                return cached
+        task = self._tasks.get(key)
+        if task is None or task.done():
+            task = self._tasks[key] = asyncio.ensure_future(self._compute_once_async(key, title, compute, refresh))
+            task.add_done_callback(lambda done: self._tasks.pop(key, None) if self._tasks.get(key) is done else None)
+        # a cancelled caller doesn't cancel the computation the other callers wait for
+        return await asyncio.shield(task)
+
+    async def _compute_once_async(self, key: str, title: str, compute, refresh: bool):
+        """_compute_once with an awaited compute and lease polling"""
+        started = time.time()
+        while not self._acquire_lease(key):
+            cached = self._read(key, newer_than=started if refresh else None)
+            if cached is not None:
+                return cached
+            await asyncio.sleep(POLL_INTERVAL)
+        try:
+            cached = self._read(key, newer_than=started if refresh else None)
+            if cached is not None:
+                return cached
+            result = tuple(await compute(title))
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO rec_cache (title_key, imdb_ids, stored_at) VALUES (?, ?, ?)",
+                             (key, json.dumps(result), time.time()))
+            return result
+        finally:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM rec_cache_leases WHERE title_key = ?", (key,))
+
+    def invalidate(self, title: str):
+        """Remove the cached recommendations of a title (e.g. when they couldn't be found on OMDb)"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM rec_cache WHERE title_key = ?", (normalize_title(title),))
+
+    def _compute_once(self, key: str, title: str, compute, refresh: bool):
+        """Compute a key holding its lease. If another process holds the lease, wait for its result"""
+        started = time.time()
+        while not self._acquire_lease(key):
+            cached = self._read(key, newer_than=started if refresh else None)
+            if cached is not None:
+                return cached
+            time.sleep(POLL_INTERVAL)
+        try:
+            # The previous lease holder may have stored the result meanwhile
+            cached = self._read(key, newer_than=started if refresh else None)
+            if cached is not None:
+                return cached
+            result = tuple(compute(title))
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO rec_cache (title_key, imdb_ids, stored_at) VALUES (?, ?, ?)",
+                             (key, json.dumps(result), time.time()))
+            return result
+        finally:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM rec_cache_leases WHERE title_key = ?", (key,))
+
+    def _acquire_lease(self, key: str):
+        """True if this process got the lease of the key (a free or expired one)"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM rec_cache_leases WHERE title_key = ? AND expires_at < ?", (key, now))
+            cursor = conn.execute("INSERT OR IGNORE INTO rec_cache_leases (title_key, expires_at) VALUES (?, ?)",
+                                  (key, now + LEASE_TIMEOUT))
+            return cursor.rowcount == 1
+
+    def _read(self, key: str, newer_than: float = None):
+        """Returns the cached tuple of a key if it is fresh (and stored after newer_than), else None"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT imdb_ids, stored_at FROM rec_cache WHERE title_key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        imdb_ids, stored_at = row
+        if time.time() - stored_at >= self.ttl or (newer_than is not None and stored_at < newer_than):
+            return None
+        return tuple(json.loads(imdb_ids))
@@ -0,0 +1,132 @@
+import time
+from sqlalchemy import update, select, or_, and_, func, inspect
+from sqlalchemy.dialects.sqlite import insert
+from datamanager.database import Movie, RecommendationJob
+
+# A job is retried up to MAX_ATTEMPTS times, a 'running' job older than STALE_AFTER seconds
+# (worker crashed or was killed) can be taken by another worker
+MAX_ATTEMPTS = 3
+STALE_AFTER = 10 * 60
+
+
+class RecommendationQueue:
+    """Queue of movies whose recommendations (recomend1..3) should be precomputed by recommend_worker.py.
+    Backed by the 'recommendation_jobs' table of the movies database, so web processes and workers share it.
+
+    Methods:
+        enqueue(movie_id, fresh, retry_failed, user_id): Add (or re-activate) the job of a movie.
+        enqueue_missing(): Add jobs for all movies without recommendations.
+        status(movie_id): Status of the job of a movie ('pending', 'running', 'done', 'failed') or None.
+        is_pending(movie_id): True if the movie has a pending or running job.
+        claim(): Take the oldest pending job that is due, returns (job_id, movie_id, fresh, user_id) or None.
+        complete(job_id) / fail(job_id, error): Finish a claimed job.
+        release(job_id, delay): Put a claimed job back without counting the attempt (rate limited), due again
+            after delay seconds.
+    """
+
+    def __init__(self, engine, Session):
+        self.Session = Session
+        RecommendationJob.__table__.create(engine, checkfirst=True)
+        # queues created before jobs had a user or a due time
+        columns = {column['name'] for column in inspect(engine).get_columns('recommendation_jobs')}
+        for name, column_type in (('user_id', 'INTEGER'), ('run_after', 'FLOAT')):
+            if name not in columns:
+                with engine.begin() as conn:
+                    conn.exec_driver_sql(f"ALTER TABLE recommendation_jobs ADD COLUMN {name} {column_type}")
+
+    def enqueue(self, movie_id: int, fresh: bool = False, retry_failed: bool = True, user_id: int = None):
+        """Add a job for a movie. An existing done job of the movie becomes pending again, a failed one too unless
+        retry_failed is False (page views: only an explicit request retries a movie that failed MAX_ATTEMPTS times).
+        user_id: the user who asked for it, the chat-gpt request of the job counts against their budget"""
+        now = time.time()
+        stmt = insert(RecommendationJob).values(movie_id=movie_id, fresh=fresh, status='pending', attempts=0,
+                                                user_id=user_id, created_at=now, updated_at=now)
+        if retry_failed:
+            active = RecommendationJob.status != 'running'
+        else:
+            active = RecommendationJob.status == 'done'
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[RecommendationJob.movie_id],
+            set_={'status': 'pending', 'attempts': 0, 'error': None, 'updated_at': now, 'run_after': None,
+                  'fresh': or_(RecommendationJob.fresh, stmt.excluded.fresh),
+                  'user_id': func.coalesce(stmt.excluded.user_id, RecommendationJob.user_id)},
+            where=active)
+        session = self.Session()
+        try:
+            session.execute(stmt)
+            session.commit()
+        finally:
+            session.close()
+
+    def enqueue_missing(self):
+        """Add jobs for every movie that lacks one of its recommendations. Returns the number of movies"""
+        session = self.Session()
+        try:
+            movie_ids = session.scalars(select(Movie.id).where(or_(
+                Movie.recomend1.is_(None), Movie.recomend2.is_(None), Movie.recomend3.is_(None)))).all()
+        finally:
+            session.close()
+        for movie_id in movie_ids:
+            self.enqueue(movie_id)
+        return len(movie_ids)
+
+    def status(self, movie_id: int):
+        """Status of the job of the movie ('pending', 'running', 'done' or 'failed'), None if it has no job"""
+        session = self.Session()
+        try:
+            return session.scalar(select(RecommendationJob.status).where(RecommendationJob.movie_id == movie_id))
+        finally:
+            session.close()
+
+    def is_pending(self, movie_id: int):
+        """True if there is a pending or running job for the movie"""
+        return self.status(movie_id) in ('pending', 'running')
+
+    def claim(self):
+        """Atomically mark the oldest available job as running and return (job_id, movie_id, fresh, user_id), or None.
+        A released job is available when its run_after time has come"""
+        now = time.time()
+        available = select(RecommendationJob.job_id).where(or_(
+            and_(RecommendationJob.status == 'pending',
+                 or_(RecommendationJob.run_after.is_(None), RecommendationJob.run_after <= now)),
+            and_(RecommendationJob.status == 'running', RecommendationJob.updated_at < now - STALE_AFTER))
+        ).order_by(RecommendationJob.job_id).limit(1).scalar_subquery()
+        stmt = update(RecommendationJob).where(RecommendationJob.job_id == available).values(
+            status='running', attempts=RecommendationJob.attempts + 1, updated_at=now).returning(
+            RecommendationJob.job_id, RecommendationJob.movie_id, RecommendationJob.fresh, RecommendationJob.user_id)
+        session = self.Session()
+        try:
+            row = session.execute(stmt).first()
+            session.commit()
+        finally:
+            session.close()
+        return tuple(row) if row else None
+
+    def complete(self, job_id: int):
+        """Mark a job as done"""
+        self._finish(job_id, status='done', fresh=False, error=None)
+
+    def fail(self, job_id: int, error: str):
+        """Put a failed job back to the queue, or mark it failed after MAX_ATTEMPTS attempts"""
+        session = self.Session()
+        try:
+            attempts = session.scalar(select(RecommendationJob.attempts).where(RecommendationJob.job_id == job_id))
+        finally:
+            session.close()
+        status = 'failed' if attempts is None or attempts >= MAX_ATTEMPTS else 'pending'
+        self._finish(job_id, status=status, error=error)
+
+    def release(self, job_id: int, delay: float = 0):
+        """Put a claimed job back to the queue as it was before claim() (the upstream or the budget of the job's user
+        was over its limit). With delay, no worker takes it before delay seconds"""
+        self._finish(job_id, status='pending', attempts=RecommendationJob.attempts - 1,
+                     run_after=time.time() + delay if delay > 0 else None)
+
+    def _finish(self, job_id: int, **values):
+        session = self.Session()
+        try:
+            session.execute(update(RecommendationJob).where(RecommendationJob.job_id == job_id).values(
+                updated_at=time.time(), **values))
+            session.commit()
+        finally:
+            session.close()
@@ -0,0 +1,321 @@
+import functools
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from sqlalchemy import select, event
+from datamanager.database import Movie, UserMovie, Review
+from datamanager.gpt import (gpt_recomendation, gpt_recomendation_new, gpt_recomendation_async,
+                             gpt_recomendation_new_async)
+from datamanager.content_index import ContentIndex
+
+# numpy is optional: only the local recommender needs it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Seconds before the co-occurrence matrix is rebuilt from the db (picks up changes of other processes)
+REFRESH_INTERVAL = 30 * 60
+# Incremental changes kept next to the matrix before it is rebuilt
+MAX_DELTA = 10000
+# Minimum number of users having both movies for a recommendation
+MIN_CO_OCCURRENCE = 2
+# Libraries bigger than this only count their first MAX_USER_ITEMS movies (pairs grow with the square of the size)
+MAX_USER_ITEMS = 500
+
+
+class Recommender(ABC):
+    """Source of the recommendations of a movie: a tuple of 3 imdbIDs.
+
+    Attributes:
+        local (bool): True if recommend() needs no network call (fast enough to run inside a request).
+    """
+    local = False
+
+    @abstractmethod
+    def recommend(self, session, movie, fresh: bool = False, user_id: int = None):
+        """Returns a tuple of 3 imdbIDs recommended for movie, or None if there is no recommendation.
+        fresh (bool): other recommendations than the current ones (recomend1..3)
+        user_id (int): user who asked for them (upstream requests count against their budget), None: no user"""
+        pass
+
+    async def recommend_async(self, session, movie, fresh: bool = False, user_id: int = None):
+        """recommend() for callers in an event loop. Local recommenders answer right away"""
+        return self.recommend(session, movie, fresh, user_id)
+
+    def invalidate(self, movie):
+        """Forget what was computed for movie (its recommendations turned out to be wrong)"""
+        pass
+
+
+class GptRecommender(Recommender):
+    """Recommendations by chat-gpt (gpt_recomendation / gpt_recomendation_new), through the recommendation cache"""
+
+    def __init__(self, rec_cache):
+        self.rec_cache = rec_cache
+
+    def recommend(self, session, movie, fresh: bool = False, user_id: int = None):
+        recommend_function = gpt_recomendation_new if fresh else gpt_recomendation
+        return self.rec_cache.get(movie.title, functools.partial(recommend_function, user_id=user_id),
+                                  refresh=fresh)
+
+    async def recommend_async(self, session, movie, fresh: bool = False, user_id: int = None):
+        recommend_function = gpt_recomendation_new_async if fresh else gpt_recomendation_async
+        return await self.rec_cache.get_async(movie.title, functools.partial(recommend_function, user_id=user_id),
+                                              refresh=fresh)
+
+    def invalidate(self, movie):
+        self.rec_cache.invalidate(movie.title)
+
+
+class ItemItemRecommender(Recommender):
+    """Local item-item collaborative filtering: movies that are often in the libraries (user_movies) or reviews
+    of the same users are recommended together. Needs numpy, no network.
+
+    The co-occurrence counts of every pair of movies are kept as a sparse CSR matrix (numpy arrays), the score of
+    a pair is count / sqrt(users(a) * users(b)) (cosine). Library changes made in this process are applied
+    incrementally (see watch()) next to the matrix, which is rebuilt in a background thread after
+    REFRESH_INTERVAL seconds or MAX_DELTA changes. Movies with less than 3 neighbours of MIN_CO_OCCURRENCE
+    common users (cold start) get None, the data manager then falls back to chat-gpt.
+
+    Methods:
+        recommend(session, movie, fresh): Tuple of 3 imdbIDs or None.
+        similar(movie_id, k, exclude): List of up to k (movie_id, score), best first.
+        watch(session_factory): Apply the UserMovie inserts/deletes of the data manager's sessions to the matrix.
+    """
+    local = True
+
+    def __init__(self, engine, refresh_interval: float = REFRESH_INTERVAL):
+        if np is None:
+            raise RuntimeError("The local recommender needs numpy (pip install numpy)")
+        self.engine = engine
+        self.refresh_interval = refresh_interval
+        self._state = None
+        self._built_at = 0
+        self._lock = threading.Lock()
+        self._rebuilding = False
+        self._reset_delta()
+
+    def _reset_delta(self):
+        # movie_id -> {movie_id: change of co-occurrence count}, movie_id -> change of number of users, and the
+        # committed changes they hold, in order (a rebuild applies again the ones it didn't read)
+        self._delta = defaultdict(lambda: defaultdict(int))
+        self._users_delta = defaultdict(int)
+        self._changes = 0
+        self._log = []
+
+    def _build(self):
+        """Read the (user, movie) interactions and compute the co-occurrence matrix.
+        Returns (movie_ids, indptr, neighbours, counts, users): movie_ids is sorted, the neighbours of
+        movie_ids[i] are neighbours[indptr[i]:indptr[i + 1]] (indexes in movie_ids) with their counts"""
+        pairs = select(UserMovie.user_id, UserMovie.movie_id).where(
+            UserMovie.user_id.is_not(None), UserMovie.movie_id.is_not(None)).union(
+            select(Review.user_id, Review.movie_id).where(Review.user_id.is_not(None), Review.movie_id.is_not(None)))
+        with self.engine.connect() as conn:
+            rows = np.array(conn.execute(pairs).all(), dtype=np.int64).reshape(-1, 2)
+        movie_ids, items = np.unique(rows[:, 1], return_inverse=True)
+        n = len(movie_ids)
+        order = np.argsort(rows[:, 0], kind='stable')
+        items = items.reshape(-1)[order]
+        bounds = np.flatnonzero(np.diff(rows[order, 0])) + 1
+        keys = [np.zeros(0, dtype=np.int64)]
+        for library in np.split(items, bounds):
+            library = library[:MAX_USER_ITEMS]
+            if len(library) > 1:
+                a = np.repeat(library, len(library))
+                b = np.tile(library, len(library))
+                mask = a != b
+                keys.append(a[mask] * n + b[mask])
+        keys, counts = np.unique(np.concatenate(keys), return_counts=True)
+        indptr = np.searchsorted(keys // max(n, 1), np.arange(n + 1))
+        users = np.bincount(items, minlength=n)
+        return movie_ids, indptr, keys % max(n, 1), counts, users
+
+    def _get_state(self):
+        """Returns the current matrix, building it on first use and rebuilding it in the background when outdated"""
+        if self._state is None:
+            with self._lock:
+                if self._state is None:
+                    self._state = self._build()
+                    self._built_at = time.monotonic()
+        elif (time.monotonic() - self._built_at > self.refresh_interval or self._changes > MAX_DELTA) \
+                and not self._rebuilding:
+            self._rebuilding = True
+            threading.Thread(target=self._rebuild, daemon=True).start()
+        return self._state
+
+    def _rebuild(self):
+        try:
+            with self._lock:
+                mark = len(self._log)
+            state = self._build()
+            with self._lock:
+                # the changes committed since the mark are kept. The build may have read the few committed between
+                # the mark and the start of its read: counted twice until the next rebuild
+                later = self._log[mark:]
+                self._state = state
+                self._built_at = time.monotonic()
+                self._reset_delta()
+                for change in later:
+                    self._add_change(*change)
+        finally:
+            self._rebuilding = False
+
+    def _users(self, state, users_delta, movie_ids):
+        """Number of users of each movie id (array), with the changes of users_delta"""
+        known_ids, users = state[0], state[4]
+        result = np.zeros(len(movie_ids), dtype=np.int64)
+        if len(known_ids):
+            positions = np.searchsorted(known_ids, movie_ids).clip(max=len(known_ids) - 1)
+            found = known_ids[positions] == movie_ids
+            result[found] = users[positions[found]]
+        if users_delta:
+            result = result + np.array([users_delta.get(int(movie_id), 0) for movie_id in movie_ids],
+                                       dtype=np.int64)
+        return result
+
+    def similar(self, movie_id: int, k: int = 3, exclude=()):
+        """Get the k movies most similar to movie_id, as a list of (movie_id, score), best first"""
+        self._get_state()
+        # the matrix and its changes as of one moment: a rebuild replaces both, watch() changes the deltas
+        with self._lock:
+            state = self._state
+            delta = dict(self._delta.get(movie_id, ()))
+            users_delta = dict(self._users_delta)
+        movie_ids, indptr, neighbours, counts = state[:4]
+        position = np.searchsorted(movie_ids, movie_id)
+        if position < len(movie_ids) and movie_ids[position] == movie_id:
+            candidates = movie_ids[neighbours[indptr[position]:indptr[position + 1]]]
+            co_counts = counts[indptr[position]:indptr[position + 1]]
+        else:
+            candidates = co_counts = np.zeros(0, dtype=np.int64)
+        if delta:
+            candidates = np.concatenate([candidates, np.fromiter(delta.keys(), dtype=np.int64, count=len(delta))])
+            co_counts = np.concatenate([co_counts, np.fromiter(delta.values(), dtype=np.int64, count=len(delta))])
+            candidates, inverse = np.unique(candidates, return_inverse=True)
+            co_counts = np.bincount(inverse.reshape(-1), weights=co_counts).astype(np.int64)
+        mask = co_counts >= MIN_CO_OCCURRENCE
+        if exclude:
+            mask &= ~np.isin(candidates, list(exclude))
+        candidates, co_counts = candidates[mask], co_counts[mask]
+        if len(candidates) == 0:
+            return []
+        users = self._users(state, users_delta, np.append(candidates, movie_id))
+        scores = co_counts / np.sqrt(np.maximum(users[:-1] * users[-1], 1))
+        best = np.argsort(-scores, kind='stable')[:k]
+        return [(int(candidates[i]), float(scores[i])) for i in best]
+
+    def recommend(self, session, movie, fresh: bool = False, user_id: int = None):
+        """Returns the imdbIDs of the 3 most similar movies, None if there are less than 3 (cold start).
+        With fresh, the current recommendations of the movie are skipped"""
+        skip = {movie.imdbID}
+        if fresh:
+            skip.update([movie.recomend1, movie.recomend2, movie.recomend3])
+        return _top_imdb_ids(session, self.similar(movie.id, k=3 + len(skip), exclude={movie.id}), skip)
+
+    def watch(self, session_factory):
+        """Apply the UserMovie rows inserted/deleted through the sessions of session_factory (the data manager's)
+        to the co-occurrence counts when their transaction commits (this process only, other processes see them
+        after their next rebuild)"""
+        event.listen(session_factory, 'after_flush', self._collect)
+        event.listen(session_factory, 'after_commit', self._commit)
+        event.listen(session_factory, 'after_soft_rollback', self._discard)
+
+    def _collect(self, session, flush_context):
+        """Keep the changes of a flush in session.info until the commit, with the libraries and reviews of their
+        users read in two queries"""
+        if self._state is None:
+            return
+        inserted, deleted = defaultdict(set), defaultdict(set)
+        for changes, objects in ((inserted, session.new), (deleted, session.deleted)):
+            for row in objects:
+                if isinstance(row, UserMovie) and row.user_id is not None and row.movie_id is not None:
+                    changes[row.user_id].add(row.movie_id)
+        if not inserted and not deleted:
+            return
+        users = set(inserted) | set(deleted)
+        # the connection of the flush: its rows are already there (inserted) or gone (deleted)
+        connection = session.connection()
+        libraries, reviews = defaultdict(set), defaultdict(set)
+        for movies, table in ((libraries, UserMovie), (reviews, Review)):
+            for user_id, movie_id in connection.execute(select(table.user_id, table.movie_id).where(
+                    table.user_id.in_(users), table.movie_id.is_not(None))):
+                movies[user_id].add(movie_id)
+        pending = session.info.setdefault('item_item_changes', [])
+        for user_id in users:
+            reviewed = reviews[user_id]
+            for sign, movies in ((1, inserted[user_id]), (-1, deleted[user_id])):
+                # movies the user also has through a review don't change
+                changed = movies - reviewed
+                items = libraries[user_id] | reviewed | changed
+                if changed and len(items) <= MAX_USER_ITEMS:
+                    pending.append((sign, changed, items))
+
+    def _commit(self, session):
+        """Count (or uncount) every changed movie together with the other movies of its user"""
+        pending = session.info.pop('item_item_changes', None)
+        if not pending:
+            return
+        with self._lock:
+            for change in pending:
+                self._add_change(*change)
+
+    def _add_change(self, sign: int, changed, items):
+        """Add a committed change to the deltas (lock held)"""
+        for movie_id in changed:
+            for other in items - {movie_id}:
+                self._delta[movie_id][other] += sign
+                # a pair of two changed movies is counted once from each side
+                if other not in changed:
+                    self._delta[other][movie_id] += sign
+            self._users_delta[movie_id] += sign
+            self._changes += len(items)
+        self._log.append((sign, changed, items))
+
+    @staticmethod
+    def _discard(session, previous_transaction):
+        session.info.pop('item_item_changes', None)
+
+
+class ContentRecommender(Recommender):
+    """Recommends the movies with the most similar title/director/plot (see content_index.py). No network.
+    Movies missing from the index get None, the data manager then falls back to chat-gpt."""
+    local = True
+
+    def __init__(self, index: ContentIndex):
+        self.index = index
+
+    def recommend(self, session, movie, fresh: bool = False, user_id: int = None):
+        skip = {movie.imdbID}
+        if fresh:
+            skip.update([movie.recomend1, movie.recomend2, movie.recomend3])
+        return _top_imdb_ids(session, self.index.similar(movie.id, k=3 + len(skip)), skip)
+
+
+def _top_imdb_ids(session, similar, skip):
+    """imdbIDs of the 3 best (movie_id, score) of similar, without the ones in skip. None if there are less than 3"""
+    imdb_ids = dict(session.execute(
+        select(Movie.id, Movie.imdbID).where(Movie.id.in_([movie_id for movie_id, _ in similar]))).all())
+    result = []
+    for movie_id, _ in similar:
+        imdb_id = imdb_ids.get(movie_id)
+        if imdb_id is not None and imdb_id not in skip and imdb_id not in result:
+            result.append(imdb_id)
+    return tuple(result[:3]) if len(result) >= 3 else None
+
+
+def make_recommender(name: str, engine, rec_cache, content_index: ContentIndex = None, session_factory=None):
+    """Recommender of a deployment by name: 'gpt' (default), 'local' (item-item, kept up to date with the changes
+    made through session_factory) or 'content' (plot similarity, uses content_index). The local ones fall back to
+    gpt"""
+    if name == 'gpt':
+        return GptRecommender(rec_cache)
+    if name == 'local':
+        recommender = ItemItemRecommender(engine)
+        if session_factory is not None:
+            recommender.watch(session_factory)
+        return recommender
+    if name == 'content':
+        return ContentRecommender(content_index if content_index is not None else ContentIndex())
+    raise ValueError("Unknown recommender: " + name)
@@ -0,0 +1,63 @@
+import math
+from sqlalchemy import create_engine, inspect
+from datamanager.database import ReviewStats
+
+# Ratings go from 1 to 10: histogram[i] counts the reviews whose rounded rating is i + 1
+BUCKETS = 10
+# The one rule of both paths (rating_value for a new review, the SQL of a rebuild): a rating counts if it is a number
+# from 1 to BUCKETS. Other values (text that isn't a number, 0, 42) only count as a review
+RATING = f"CASE WHEN typeof(review_rating) IN ('integer', 'real') AND review_rating BETWEEN 1 AND {BUCKETS} " \
+         f"THEN review_rating END"
+BUCKET = f"CAST(ROUND({RATING}) AS INTEGER)"
+# Aggregate of the reviews of every movie matching {where}, in the columns order of review_stats
+STATS_SELECT = (
+    f"SELECT movie_id, COUNT(*), COUNT({RATING}), COALESCE(SUM({RATING}), 0), AVG({RATING}), "
+    "json_array(" + ", ".join(f"COALESCE(SUM({BUCKET} = {bucket}), 0)" for bucket in range(1, BUCKETS + 1)) + "), "
+    "MAX(review_date) FROM reviews WHERE movie_id IS NOT NULL AND ({where}) GROUP BY movie_id")
+INSERT_STATS = ("INSERT INTO review_stats (movie_id, review_count, rating_count, rating_sum, rating_mean, histogram, "
+                "last_review_date) " + STATS_SELECT)
+
+
+def rating_value(rating):
+    """The rating of a review as counted in the aggregates (see RATING): a float from 1 to BUCKETS, else None"""
+    try:
+        value = float(rating)
+    except (TypeError, ValueError):
+        return None
+    return value if 1 <= value <= BUCKETS else None
+
+
+def bucket(rating):
+    """Histogram index of a counted rating (rounded half up, as ROUND in SQLite), None for reviews without one"""
+    value = rating_value(rating)
+    if value is None:
+        return None
+    return int(math.floor(value + 0.5)) - 1
+
+
+def recount(conn):
+    """Recompute the aggregates of every movie from the reviews table, on a connection (migration 4)"""
+    ReviewStats.__table__.create(conn, checkfirst=True)
+    conn.exec_driver_sql("DELETE FROM review_stats")
+    conn.exec_driver_sql(INSERT_STATS.format(where="1"))
+
+
+def rebuild(engine):
+    """Recompute the aggregates of every movie from the reviews table. Returns the number of movies with reviews"""
+    with engine.begin() as conn:
+        recount(conn)
+        return conn.exec_driver_sql("SELECT COUNT(*) FROM review_stats").scalar()
+
+
+def ensure_table(engine):
+    """Create review_stats if the database doesn't have it yet, filled from the existing reviews"""
+    if not inspect(engine).has_table(ReviewStats.__tablename__):
+        rebuild(engine)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Recompute the review aggregates (review_stats) of every movie")
+    parser.add_argument("db", help="database url, e.g. sqlite:///datamanager/movies.sqlite")
+    args = parser.parse_args()
+    print(f"Review stats of {rebuild(create_engine(args.db))} movies")
@@ -0,0 +1,62 @@
+import difflib
+import re
+from sqlalchemy import text
+
+TOKEN = re.compile(r"\w+")
+# bm25 weights of the movies_fts columns (title, director, plot): a title match ranks first
+COLUMN_WEIGHTS = (10.0, 3.0, 1.0)
+# Fuzzy search: candidates read from the index, and minimum similarity (0..1) of their title to the query
+FUZZY_CANDIDATES = 200
+FUZZY_CUTOFF = 0.6
+FUZZY_PREFIX = 3
+# Leading words skipped when a title is compared to the start of a query ("matr" starts "The Matrix")
+ARTICLES = frozenset(("the", "a", "an"))
+
+
+def tokens(title: str):
+    """Lower case words of a title, as the FTS5 unicode61 tokenizer splits it"""
+    return TOKEN.findall((title or "").lower())
+
+
+def same_title(first: str, second: str):
+    """Titles equal up to case, spaces and punctuation ("the matrix" == "The Matrix", "spider man" == "Spider-Man")"""
+    return tokens(first) == tokens(second)
+
+
+def starts_with(title: str, query: str):
+    """True if the title (leading article skipped) starts with the words of the query, its last word as a prefix:
+    "The Matrix" starts with "matr" and "the matrix", "Robot Chicken: Star Wars" doesn't start with "star wars"."""
+    title_words, words = tokens(title), tokens(query)
+    if title_words[:1] and title_words[0] in ARTICLES and words[:1] != title_words[:1]:
+        title_words = title_words[1:]
+    if not words or len(title_words) < len(words):
+        return False
+    return title_words[:len(words) - 1] == words[:-1] and title_words[len(words) - 1].startswith(words[-1])
+
+
+def match_query(query: str, prefix: bool = True):
+    """FTS5 MATCH expression of a user query: every word must appear (as a prefix of a word with prefix=True).
+    Words are quoted, so the query can't use FTS5 syntax. Returns None if there is no word"""
+    words = tokens(query)
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' if prefix else f'"{word}"' for word in words)
+
+
+def fuzzy_query(query: str):
+    """FTS5 MATCH expression for typo tolerant search: any word starting like one of the query words"""
+    words = tokens(query)
+    if not words:
+        return None
+    return " OR ".join(f'"{word[:FUZZY_PREFIX]}"*' for word in words)
+
+
+def fuzzy_score(query: str, title: str):
+    """Similarity (0..1) of a title to the query"""
+    return difflib.SequenceMatcher(None, " ".join(tokens(query)), " ".join(tokens(title))).ratio()
+
+
+def has_fts(engine):
+    """True if the database has the movies_fts index (schema migration 2)"""
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'movies_fts'")).first() is not None
@@ -0,0 +1,51 @@
+import json
+from datetime import date, datetime
+from sqlalchemy import func
+from datamanager.database import Movie, UserMovie
+
+# orjson is optional: it is used for the API responses when installed, the standard json module otherwise
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Columns of a movie in API responses (same keys as Movie.to_dict(), without relationships)
+MOVIE_COLUMNS = [Movie.id, Movie.title, Movie.director, Movie.year, Movie.rating, Movie.img, Movie.imdbID,
+                 Movie.plot, Movie.notes, Movie.recomend1, Movie.recomend2, Movie.recomend3]
+
+
+def user_movie_columns():
+    """Movie columns for a user's library: rating and notes are the user's ones when set (as in get_user_movies)"""
+    columns = []
+    for column in MOVIE_COLUMNS:
+        if column is Movie.rating:
+            column = func.coalesce(UserMovie.user_rating, Movie.rating).label('rating')
+        elif column is Movie.notes:
+            column = func.coalesce(UserMovie.user_notes, Movie.notes).label('notes')
+        columns.append(column)
+    return columns
+
+
+def row_to_dict(row, keys=None):
+    """Convert a Core result row to a dict of the given keys (default: all columns of the row)"""
+    mapping = row._mapping
+    # column names can be str subclasses (quoted_name), which orjson refuses as keys
+    return {str(key): mapping[key] for key in (keys if keys is not None else mapping.keys())}
+
+
+def movie_to_dict(movie):
+    """Convert a Movie object to a dict of the MOVIE_COLUMNS keys (no relationships)"""
+    return {column.key: getattr(movie, column.key) for column in MOVIE_COLUMNS}
+
+
+def _default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(data):
+    """Serialize to JSON (str) with orjson if available"""
+    if orjson is not None:
+        return orjson.dumps(data, default=_default).decode()
+    return json.dumps(data, default=_default)
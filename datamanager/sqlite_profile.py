@@ -0,0 +1,93 @@
+from sqlalchemy import create_engine, event, Insert, Update, Delete
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+
+
+class SQLiteProfile:
+    """SQLite performance settings applied to every connection of the data manager.
+
+    Attributes:
+        journal_mode (str): 'WAL' lets readers work while a write is in progress (None keeps the file's mode).
+        synchronous (str): 'NORMAL' is safe with WAL and much faster than 'FULL'.
+        busy_timeout (int): Milliseconds to wait for a lock instead of failing with "database is locked".
+        cache_size (int): Page cache per connection, negative values are KiB.
+        mmap_size (int): Bytes of the file read through memory mapping (0 disables it).
+        temp_store (str): 'MEMORY' keeps temporary tables and sort b-trees in memory.
+        read_pool_size (int): Pooled read-only connections per process.
+    """
+
+    def __init__(self, journal_mode: str = 'WAL', synchronous: str = 'NORMAL', busy_timeout: int = 5000,
+                 cache_size: int = -16000, mmap_size: int = 256 * 1024 * 1024, temp_store: str = 'MEMORY',
+                 read_pool_size: int = 5):
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.busy_timeout = busy_timeout
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.temp_store = temp_store
+        self.read_pool_size = read_pool_size
+
+    def apply(self, dbapi_connection, writer: bool):
+        """Set the PRAGMAs on a new connection. Only the writer changes the journal mode (it is stored in the file)"""
+        cursor = dbapi_connection.cursor()
+        if writer and self.journal_mode:
+            cursor.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+        cursor.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+        cursor.execute(f"PRAGMA synchronous = {self.synchronous}")
+        cursor.execute(f"PRAGMA cache_size = {int(self.cache_size)}")
+        cursor.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        cursor.execute(f"PRAGMA temp_store = {self.temp_store}")
+        if not writer:
+            cursor.execute("PRAGMA query_only = ON")
+        cursor.close()
+
+
+DEFAULT_PROFILE = SQLiteProfile()
+
+
+def create_engines(file_path: str, profile: SQLiteProfile = DEFAULT_PROFILE):
+    """Create the (read engine, write engine) pair of a SQLite database url.
+
+    The write engine has a single connection (pool of 1, no overflow), so the writes of a process are serialized,
+    and starts its transactions with BEGIN IMMEDIATE, so concurrent writers wait (busy_timeout) instead of failing
+    when a read lock is upgraded. The read engine is a pool of read-only connections.
+    An in-memory database can't be shared by two engines: the same engine is returned twice."""
+    write_engine = create_engine(file_path, poolclass=QueuePool, pool_size=1, max_overflow=0)
+
+    @event.listens_for(write_engine, "connect")
+    def connect_writer(dbapi_connection, connection_record):
+        # transactions are started explicitly in begin_writer
+        dbapi_connection.isolation_level = None
+        profile.apply(dbapi_connection, writer=True)
+
+    @event.listens_for(write_engine, "begin")
+    def begin_writer(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    database = make_url(file_path).database
+    if not database or database == ':memory:' or database.startswith('file:'):
+        return write_engine, write_engine
+    read_url = make_url(file_path).set(database="file:" + database, query={'mode': 'ro', 'uri': 'true'})
+    read_engine = create_engine(read_url, poolclass=QueuePool, pool_size=profile.read_pool_size, max_overflow=10)
+
+    @event.listens_for(read_engine, "connect")
+    def connect_reader(dbapi_connection, connection_record):
+        profile.apply(dbapi_connection, writer=False)
+
+    return read_engine, write_engine
+
+
+class RoutingSession(Session):
+    """Session that sends reads to the read engine and flushes/INSERT/UPDATE/DELETE statements to the write engine.
+    Create it with sessionmaker(class_=RoutingSession, read_engine=..., write_engine=...)."""
+
+    def __init__(self, read_engine=None, write_engine=None, **kwargs):
+        super().__init__(**kwargs)
+        self.read_engine = read_engine
+        self.write_engine = write_engine
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or isinstance(clause, (Insert, Update, Delete)):
+            return self.write_engine
+        return self.read_engine
@@ -0,0 +1,171 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from itertools import chain
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+# Default location of the shared invalidation log, next to movies.sqlite
+LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "user_cache.sqlite")
+MAX_SIZE = 1024
+TTL = 5 * 60
+# Seconds between two reads of the shared invalidation log, and how long its rows are kept
+CHECK_INTERVAL = 1
+LOG_RETENTION = 60 * 60
+
+
+class SQLiteInvalidationLog:
+    """Shared backend of UserCache: a log of invalidated user ids in a small SQLite file, so every worker process
+    evicts a changed user within CHECK_INTERVAL seconds.
+
+    Methods:
+        publish(user_id): Append an invalidation.
+        since(seq): Returns (last seq, list of user ids invalidated after seq).
+    """
+
+    def __init__(self, path: str = LOG_PATH):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS user_cache_invalidations ("
+                         "seq INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, created_at REAL NOT NULL)")
+
+    @contextmanager
+    def _connect(self):
+        """Opens a short-lived connection (commit on success, closed in any case)"""
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def publish(self, user_id: int):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT INTO user_cache_invalidations (user_id, created_at) VALUES (?, ?)", (user_id, now))
+            conn.execute("DELETE FROM user_cache_invalidations WHERE created_at < ?", (now - LOG_RETENTION,))
+
+    def since(self, seq: int):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT seq, user_id FROM user_cache_invalidations WHERE seq > ? ORDER BY seq",
+                                (seq,)).fetchall()
+            if not rows and seq == 0:
+                # first read: start after the existing log
+                last = conn.execute("SELECT MAX(seq) FROM user_cache_invalidations").fetchone()[0]
+                return last or 0, []
+        if not rows:
+            return seq, []
+        return rows[-1][0], [user_id for _, user_id in rows]
+
+
+class UserCache:
+    """In-process LRU cache (with TTL) of users for the Flask-Login user_loader.
+
+    Stores the column values of a user, not the ORM object, and returns a new detached User built from them,
+    so a cached user is never bound to the session of an old request.
+
+    Attributes:
+        max_size (int): Maximum number of cached users.
+        ttl (float): Seconds a user is kept.
+        backend (SQLiteInvalidationLog): Optional shared log, invalidations are seen by every process.
+        hits (int), misses (int): Lookup counters.
+
+    Methods:
+        get(user_id, loader): Returns the user, calling loader(user_id) on a miss.
+        invalidate(user_id): Evict a user (here and, with a backend, in every process).
+        watch(model): Invalidate automatically when a row of the model is inserted, updated or deleted.
+
+    Every invalidation increases the version of the user: a user loaded while it was invalidated (the loader may
+    have read the old row) is returned but not cached.
+    """
+
+    def __init__(self, max_size: int = MAX_SIZE, ttl: float = TTL, backend: SQLiteInvalidationLog = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._checked_at = 0
+        self._versions = Counter()
+
+    def get(self, user_id: int, loader):
+        """Get a user by id from the cache or from loader(user_id). None results are not cached"""
+        self._sync()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and now - entry[2] < self.ttl:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                model, values = entry[0], entry[1]
+                return self._build(model, values)
+            self.misses += 1
+            version = self._versions[user_id]
+        user = loader(user_id)
+        if user is not None:
+            mapper = inspect(type(user))
+            values = {attr.key: getattr(user, attr.key) for attr in mapper.column_attrs}
+            with self._lock:
+                if self._versions[user_id] != version:
+                    return user
+                self._entries[user_id] = (type(user), values, now)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id: int):
+        """Evict a user from this process and publish the invalidation to the other processes"""
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._versions[user_id] += 1
+        if self.backend is not None:
+            self.backend.publish(user_id)
+
+    def watch(self, model):
+        """Invalidate the cached user whenever a row of the model is inserted, updated or deleted: the ids are
+        collected when a session flushes and invalidated when its transaction commits (a user loaded before the
+        commit would read the old row again)"""
+        key = ('user_cache', id(self))
+
+        def collect(session, flush_context):
+            changed = {row.id for row in chain(session.new, session.dirty, session.deleted) if isinstance(row, model)}
+            if changed:
+                session.info.setdefault(key, set()).update(changed)
+
+        def committed(session):
+            for user_id in session.info.pop(key, ()):
+                self.invalidate(user_id)
+
+        def rolled_back(session, previous_transaction):
+            session.info.pop(key, None)
+        event.listen(Session, 'after_flush', collect)
+        event.listen(Session, 'after_commit', committed)
+        event.listen(Session, 'after_soft_rollback', rolled_back)
+
+    def _sync(self):
+        """Apply the invalidations published by other processes, at most every CHECK_INTERVAL seconds"""
+        if self.backend is None or time.monotonic() - self._checked_at < CHECK_INTERVAL:
+            return
+        self._checked_at = time.monotonic()
+        self._seq, user_ids = self.backend.since(self._seq)
+        if user_ids:
+            with self._lock:
+                for user_id in user_ids:
+                    self._entries.pop(user_id, None)
+                    self._versions[user_id] += 1
+
+    @staticmethod
+    def _build(model, values):
+        """Make a new (detached) instance of model with the cached column values"""
+        user = inspect(model).class_manager.new_instance()
+        for key, value in values.items():
+            set_committed_value(user, key, value)
+        return user
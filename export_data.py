@@ -0,0 +1,38 @@
+"""Export a user's library, all reviews or the whole movies table to an NDJSON file (constant memory).
+
+Usage:
+    python export_data.py movies movies.ndjson.gz
+    python export_data.py reviews reviews.ndjson
+    python export_data.py library user_1.ndjson --user 1
+
+The file is gzip compressed when its name ends with .gz.
+"""
+import argparse
+from datamanager.SQLite_data_manager import SQLiteDataManager
+from datamanager.export import ndjson_chunks, gzip_chunks
+from datamanager.database import DATABASE_URL
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export data as NDJSON")
+    parser.add_argument("kind", choices=["library", "reviews", "movies"])
+    parser.add_argument("file")
+    parser.add_argument("--user", type=int, help="user id (library export)")
+    parser.add_argument("--db", default=DATABASE_URL, help="database url")
+    args = parser.parse_args()
+    if args.kind == "library" and args.user is None:
+        parser.error("--user is required for a library export")
+
+    chunks = ndjson_chunks(SQLiteDataManager(args.db).export_rows(args.kind, args.user))
+    if args.file.endswith(".gz"):
+        with open(args.file, "wb") as file:
+            for data in gzip_chunks(chunks):
+                file.write(data)
+    else:
+        with open(args.file, "w") as file:
+            for chunk in chunks:
+                file.write(chunk)
+
+
+if __name__ == '__main__':
+    main()
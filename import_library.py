@@ -0,0 +1,40 @@
+"""Import a whole library into a user's movies from a CSV or JSON file of titles or imdbIDs.
+
+Usage:
+    python import_library.py USER_ID movies.csv [--db sqlite:///...] [--report report.json]
+
+CSV: a column named title or imdbID, otherwise the first column. JSON: see bulk_import.parse_items.
+Prints a summary, and the status of every item with --report.
+"""
+import argparse
+import json
+from datamanager.SQLite_data_manager import SQLiteDataManager
+from datamanager.bulk_import import ImportBudgetExceeded, parse_items, summarize
+from datamanager.database import DATABASE_URL
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import titles or imdbIDs into a user's library")
+    parser.add_argument("user_id", type=int)
+    parser.add_argument("file", help="CSV or JSON file")
+    parser.add_argument("--db", default=DATABASE_URL, help="database url")
+    parser.add_argument("--report", help="write the status of every item to this JSON file")
+    args = parser.parse_args()
+
+    with open(args.file, "rb") as file:
+        items = parse_items(file.read(), "csv" if args.file.lower().endswith(".csv") else "json")
+    data_manager = SQLiteDataManager(args.db)
+    try:
+        report = data_manager.bulk_add_movies(args.user_id, items)
+    except ImportBudgetExceeded as error:
+        raise SystemExit(str(error))
+    finally:
+        data_manager.close_session()
+    print(f"{len(items)} items: {summarize(report)}")
+    if args.report:
+        with open(args.report, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Recommendation worker: precomputes movie recommendations (recomend1..3) queued in the 'recommendation_jobs' table,
+so the web app never waits for chat-gpt.
+
+Usage:
+    python recommend_worker.py [--workers 2] [--backfill] [--once] [--recommender gpt|local|content]
+
+--backfill queues every movie without recommendations before starting, --once exits when the queue is empty.
+"""
+import argparse
+import time
+from os import getenv
+import traceback
+from multiprocessing import Process
+from datamanager.SQLite_data_manager import SQLiteDataManager
+from datamanager.database import DATABASE_URL
+from datamanager.data_manager_interface import Status
+from datamanager.rate_limit import RateLimited
+
+# Seconds to sleep when the queue is empty
+POLL_INTERVAL = 1
+# Longest sleep of a worker when chat-gpt/OMDb are over their rate limit
+MAX_BACKOFF = 60
+
+
+def run_worker(db_path: str, once: bool = False, recommender: str = 'gpt'):
+    """Take jobs from the queue and compute them one by one. Each worker process has its own data manager"""
+    data_manager = SQLiteDataManager(db_path, recommender=recommender)
+    queue = data_manager.rec_queue
+    while True:
+        job = queue.claim()
+        if job is None:
+            if once:
+                return
+            time.sleep(POLL_INTERVAL)
+            continue
+        job_id, movie_id, fresh, user_id = job
+        try:
+            status = data_manager.compute_recommendations(movie_id, fresh=fresh, user_id=user_id)
+        except RateLimited as error:
+            if error.per_user:
+                # the budget of the user who asked for the job is spent: the job waits until it has a token again
+                # (the page stays pending), the other jobs go on
+                queue.release(job_id, error.retry_after)
+                continue
+            # not the job's fault: back to the queue, wait for the limit
+            queue.release(job_id)
+            time.sleep(min(error.retry_after, MAX_BACKOFF))
+            continue
+        except Exception:
+            queue.fail(job_id, traceback.format_exc(limit=3))
+            continue
+        finally:
+            data_manager.close_session()
+        if status == Status.OK:
+            queue.complete(job_id)
+        else:
+            queue.fail(job_id, "recommended movies not found")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute movie recommendations")
+    parser.add_argument("--workers", type=int, default=2, help="number of worker processes")
+    parser.add_argument("--backfill", action="store_true", help="queue all movies without recommendations")
+    parser.add_argument("--once", action="store_true", help="exit when the queue is empty")
+    parser.add_argument("--db", default=DATABASE_URL, help="database url")
+    parser.add_argument("--recommender", choices=["gpt", "local", "content"], default=getenv("RECOMMENDER", "gpt"),
+                        help="source of recommendations (default: RECOMMENDER environment variable or gpt)")
+    args = parser.parse_args()
+
+    if args.backfill:
+        queued = SQLiteDataManager(args.db).rec_queue.enqueue_missing()
+        print(f"Queued {queued} movies")
+    workers = [Process(target=run_worker, args=(args.db, args.once, args.recommender)) for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Fixtures shared by the tests: migrated copies of datamanager/movies.sqlite, limiters and caches in temporary files"""
+import os
+import shutil
+import tempfile
+
+import pytest
+from sqlalchemy import create_engine
+
+SAMPLE_DATABASE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "datamanager",
+                               "movies.sqlite")
+
+
+def migrated_copy(directory: str):
+    """Database url of a copy of the sample database in directory, at the latest schema version"""
+    path = os.path.join(directory, "movies.sqlite")
+    shutil.copyfile(SAMPLE_DATABASE, path)
+    url = "sqlite:///" + path
+    from datamanager.migrations import migrate
+    engine = create_engine(url)
+    migrate(engine)
+    engine.dispose()
+    return url
+
+
+# datamanager/database.py reads DATABASE_URL at import and app.py (imported by api.py and asgi.py) opens it: a copy
+# of its own for the test run, set before anything imports them
+_directory = tempfile.mkdtemp(prefix="movies-tests-")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(_directory, "movies.sqlite")
+migrated_copy(_directory)
+
+
+@pytest.fixture
+def database_url(tmp_path):
+    return migrated_copy(str(tmp_path))
+
+
+@pytest.fixture
+def limiter(tmp_path):
+    from datamanager.rate_limit import SharedRateLimiter
+    return SharedRateLimiter(str(tmp_path / "rate_limit.sqlite"), policy='fail')
+
+
+@pytest.fixture
+def make_data_manager(database_url, limiter, tmp_path):
+    """Factory of data managers on the test's database (keyword arguments of SQLiteDataManager), with no shared
+    file: OMDb cache, recommendation cache and limiter in tmp_path"""
+    from datamanager.SQLite_data_manager import SQLiteDataManager
+    from datamanager.omdb import OmdbClient
+    from datamanager.omdb_cache import OmdbCache
+    from datamanager.rec_cache import RecommendationCache
+    managers = []
+
+    def make(**options):
+        options.setdefault('rate_limiter', limiter)
+        options.setdefault('omdb_client', OmdbClient(cache=OmdbCache(str(tmp_path / "omdb_cache.sqlite")),
+                                                     limiter=limiter))
+        options.setdefault('rec_cache', RecommendationCache(str(tmp_path / "rec_cache.sqlite")))
+        managers.append(SQLiteDataManager(database_url, **options))
+        return managers[-1]
+    yield make
+    for manager in managers:
+        manager.close_session()
+        manager.read_engine.dispose()
+        manager.engine.dispose()
+
+
+@pytest.fixture
+def data_manager(make_data_manager):
+    return make_data_manager()
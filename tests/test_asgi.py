@@ -0,0 +1,56 @@
+"""Routes of asgi.py, called as an ASGI server would (no chat-gpt request: the budget is spent before)"""
+import asyncio
+import json
+
+import pytest
+
+asgi = pytest.importorskip("asgi")
+
+
+def call(path: str, method: str = "GET", cookie: str = None):
+    """Run one request through asgi.application, returns (status, JSON body)"""
+    headers = [(b"cookie", f"session={cookie}".encode())] if cookie else []
+    scope = {'type': 'http', 'method': method, 'path': path, 'headers': headers, 'query_string': b''}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    async def run():
+        try:
+            await asgi.application(scope, receive, send)
+        finally:
+            asgi.data_manager.close_session()
+
+    asyncio.run(run())
+    body = b"".join(message.get('body', b'') for message in messages if message['type'] == 'http.response.body')
+    return messages[0]['status'], json.loads(body)
+
+
+def session_cookie(user_id: int):
+    """Value of the session cookie of a logged in user"""
+    client = asgi.app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    return client.get_cookie('session').value
+
+
+@pytest.fixture
+def spent_budget(limiter, monkeypatch):
+    """User 1 with no 'openai' token left"""
+    monkeypatch.setattr(asgi.data_manager, "rate_limiter", limiter)
+    limiter.user_limits = {'openai': (1, 1e-9)}
+    assert limiter.try_acquire('openai', 1, shared=False) is None
+    return 1
+
+
+def test_new_recommendations_charge_the_logged_in_user(spent_budget):
+    movie_id = asgi.data_manager.random_movies(1)[0].id
+    asgi.data_manager.close_session()
+    status, body = call(f"/api/movie/{movie_id}/recommendations", "POST", session_cookie(spent_budget))
+    assert status == 429
+    assert body == {'Status': 'Error. Too many requests'}
@@ -0,0 +1,69 @@
+"""bulk_import.parse_items and SQLiteDataManager.bulk_add_movies (no OMDb request: the budget refuses them)"""
+import pytest
+from sqlalchemy import text
+
+from datamanager.bulk_import import ImportBudgetExceeded, TooManyItems, parse_items, summarize
+
+
+def test_parse_json_and_csv():
+    assert parse_items('["Alien", {"imdbID": "tt0078748"}, {"title": " Heat "}, ""]') == \
+        ["Alien", "tt0078748", "Heat"]
+    assert parse_items('{"items": ["Alien"]}') == ["Alien"]
+    assert parse_items(b"\xef\xbb\xbfyear,Title\n1979,Alien\n1995,Heat\n", "csv") == ["Alien", "Heat"]
+    assert parse_items("Alien\nHeat\n", "csv") == ["Alien", "Heat"]
+
+
+def test_parse_errors():
+    with pytest.raises(ValueError):
+        parse_items("{")
+    with pytest.raises(ValueError):
+        parse_items('[1, 2]')
+    with pytest.raises(TooManyItems):
+        parse_items('["a", "b", "c"]', max_items=2)
+
+
+@pytest.fixture
+def spent_user(data_manager, limiter):
+    """A user with no OMDb lookup left today: an import that needs one is refused"""
+    limiter.user_limits = {'omdb': (1, 1e-9)}
+    assert limiter.try_acquire('omdb', 1, shared=False) is None
+    return 1
+
+
+def catalog_movie(data_manager, user_id):
+    """(id, title) of a movie of the catalog that isn't in the user's library"""
+    with data_manager.engine.connect() as conn:
+        return tuple(conn.execute(text(
+            "SELECT movie_id, title FROM movies WHERE title LIKE '% %' AND movie_id NOT IN "
+            "(SELECT movie_id FROM user_movies WHERE user_id = :user AND movie_id IS NOT NULL) ORDER BY movie_id "
+            "LIMIT 1"),
+            {'user': user_id}).one())
+
+
+def test_titles_match_as_in_single_adds(data_manager, spent_user):
+    movie_id, title = catalog_movie(data_manager, spent_user)
+    spaced = "  " + title.upper().replace(" ", "   ") + "!"
+    report = data_manager.bulk_add_movies(spent_user, [title.lower(), spaced])
+    assert [(entry['status'], entry['movie_id']) for entry in report] == [('added', movie_id),
+                                                                          ('duplicate', movie_id)]
+    report = data_manager.bulk_add_movies(spent_user, [spaced])
+    assert summarize(report) == {'already_added': 1}
+
+
+def test_refused_over_the_budget(data_manager, spent_user):
+    with data_manager.engine.connect() as conn:
+        before = conn.execute(text("SELECT COUNT(*) FROM user_movies")).scalar()
+    movie_id, title = catalog_movie(data_manager, spent_user)
+    with pytest.raises(ImportBudgetExceeded) as error:
+        data_manager.bulk_add_movies(spent_user, [title, "tt0000001", "No Such Movie 1234"])
+    assert (error.value.lookups, error.value.available) == (2, 0)
+    data_manager.close_session()
+    with data_manager.engine.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM user_movies")).scalar() == before
+
+
+def test_import_request_cap():
+    api = pytest.importorskip("api")
+    items = [f"tt{number:07d}" for number in range(api.MAX_REQUEST_ITEMS + 1)]
+    response = api.app.test_client().post('/api/user/1/import', json=items)
+    assert response.status_code == 413
@@ -0,0 +1,32 @@
+"""The content index of a data manager: used and kept up to date whatever the recommender"""
+import pytest
+from sqlalchemy import select
+
+from datamanager.database import Movie
+
+pytest.importorskip("numpy")
+
+OMDB_ANSWER = {'Title': "The Space Station", 'Director': "Nobody Known", 'Year': "2031", 'Poster': "N/A",
+               'imdbID': "tt9999991", 'Plot': "Astronauts fight an alien aboard a space station.",
+               'imdbRating': "6.1"}
+
+
+def test_built_index_is_kept_up_to_date_by_any_recommender(data_manager, make_data_manager, tmp_path, monkeypatch):
+    from datamanager import content_index
+    path = str(tmp_path / "content_index")
+    with data_manager.engine.connect() as conn:
+        content_index.ContentIndex(path).build(conn.execute(select(Movie.id, Movie.title, Movie.director,
+                                                                   Movie.plot)).all())
+    monkeypatch.setattr(content_index, "INDEX_PATH", path)
+    manager = make_data_manager(recommender='gpt')
+    assert manager.content_index is not None
+    manager._add_omdb_movie(OMDB_ANSWER)
+    movie_id = manager._movie_id_by_imdbID(OMDB_ANSWER['imdbID'])
+    manager.close_session()
+    assert manager.similar_movies(movie_id, 3) != []
+
+
+def test_no_index_before_it_is_built(make_data_manager, tmp_path, monkeypatch):
+    from datamanager import content_index
+    monkeypatch.setattr(content_index, "INDEX_PATH", str(tmp_path / "content_index"))
+    assert make_data_manager(recommender='gpt').content_index is None
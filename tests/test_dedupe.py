@@ -0,0 +1,43 @@
+"""dedupe.merge_duplicates: library rows of the copies keep their ratings and notes in the canonical movie"""
+from sqlalchemy import create_engine, text
+
+from datamanager.dedupe import count_duplicates, merge_duplicates
+
+IMDB_ID = "tt7777777"
+
+
+def test_merge_keeps_ratings_and_notes(database_url):
+    engine = create_engine(database_url)
+    with engine.begin() as conn:
+        conn.execute(text('DROP INDEX "ux_movies_imdbID"'))
+        conn.execute(text('INSERT INTO movies (title, "imdbID") VALUES (:title, :imdb)'),
+                     [{'title': title, 'imdb': IMDB_ID} for title in ("Original", "Copy", "Other copy")])
+        canonical, copy, other = conn.execute(text('SELECT movie_id FROM movies WHERE "imdbID" = :imdb '
+                                                   'ORDER BY movie_id'), {'imdb': IMDB_ID}).scalars()
+        conn.execute(text("INSERT INTO user_movies (user_id, movie_id, user_rating, user_notes) "
+                          "VALUES (:user, :movie, :rating, :notes)"), [
+            # canonical row without rating/notes, completed by the copy
+            {'user': 1, 'movie': canonical, 'rating': None, 'notes': None},
+            {'user': 1, 'movie': copy, 'rating': 8, 'notes': "from the copy"},
+            # the canonical rating wins, the notes of the copy fill the gap
+            {'user': 2, 'movie': canonical, 'rating': 6, 'notes': None},
+            {'user': 2, 'movie': copy, 'rating': 9, 'notes': "copy notes"},
+            # only a copy: moved to the canonical movie
+            {'user': 3, 'movie': other, 'rating': 4, 'notes': "only copy"},
+            # two copies and no canonical row: one row with the rating of one and the notes of the other
+            {'user': 4, 'movie': copy, 'rating': None, 'notes': "first copy"},
+            {'user': 4, 'movie': other, 'rating': 7, 'notes': None}])
+        conn.execute(text("INSERT INTO reviews (user_id, movie_id, review_title, review_rating) "
+                          "VALUES (5, :movie, 'copy review', 9)"), {'movie': other})
+    assert count_duplicates(engine) == 2
+    assert merge_duplicates(engine) == 2
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT user_id, movie_id, user_rating, user_notes FROM user_movies "
+                                 "WHERE user_id <= 4 AND movie_id IN (:canonical, :copy, :other) ORDER BY user_id"),
+                            {'canonical': canonical, 'copy': copy, 'other': other}).all()
+        reviews = conn.execute(text("SELECT movie_id FROM reviews WHERE review_title = 'copy review'")).scalars()
+        assert list(reviews) == [canonical]
+    assert [tuple(row) for row in rows] == [(1, canonical, 8.0, "from the copy"), (2, canonical, 6.0, "copy notes"),
+                                            (3, canonical, 4.0, "only copy"), (4, canonical, 7.0, "first copy")]
+    assert count_duplicates(engine) == 0
+    engine.dispose()
@@ -0,0 +1,129 @@
+"""gpt_recomendation_batch with a fake ChatCompletion client (no OpenAI request)"""
+import json
+
+import pytest
+
+from datamanager import gpt, rate_limit
+from datamanager.rate_limit import SharedRateLimiter
+
+IDS = {"Alien": ["tt0090605", "tt0103644", "tt0118583"],
+       "Heat": ["tt0113277", "tt0114814", "tt0407887"],
+       "Up": ["tt0266543", "tt0317219", "tt0910970"]}
+SINGLE_ANSWER = "tt0000001, 0000002, tt0000003"
+
+
+class FakeChatCompletion:
+    """Answers the batched prompt with batch_answer and a single-title prompt with single_answer, records the
+    prompts"""
+
+    def __init__(self, batch_answer, single_answer=SINGLE_ANSWER):
+        self.batch_answer = batch_answer
+        self.single_answer = single_answer
+        self.prompts = []
+
+    def create(self, **request):
+        prompt = request['messages'][-1]['content']
+        self.prompts.append(prompt)
+        content = self.batch_answer if "JSON object" in prompt else self.single_answer
+        return {'choices': [{'message': {'content': content}}],
+                'usage': {'prompt_tokens': 10, 'completion_tokens': 5}}
+
+    @property
+    def single_requests(self):
+        return [prompt for prompt in self.prompts if "JSON object" not in prompt]
+
+
+@pytest.fixture(autouse=True)
+def limiter(tmp_path, monkeypatch):
+    """A limiter of its own for every test, in a temporary file"""
+    limiter = SharedRateLimiter(str(tmp_path / "rate_limit.sqlite"), policy='fail')
+    monkeypatch.setattr(rate_limit, "_shared", limiter)
+    return limiter
+
+
+def test_valid_json():
+    client = FakeChatCompletion("Here you go:\n" + json.dumps(IDS))
+    result = gpt.gpt_recomendation_batch(list(IDS), client=client)
+    assert result == {title: tuple(ids) for title, ids in IDS.items()}
+    assert len(client.prompts) == 1
+
+
+def test_title_per_line_answer():
+    answer = "\n".join(f"- {title.upper()}: {', '.join(ids)}" for title, ids in IDS.items())
+    result = gpt.gpt_recomendation_batch(list(IDS), client=FakeChatCompletion(answer))
+    assert result == {title: tuple(ids) for title, ids in IDS.items()}
+
+
+def test_malformed_answer_falls_back_to_single_requests():
+    client = FakeChatCompletion("Sorry, I can't help with that")
+    result = gpt.gpt_recomendation_batch(["Alien", "Heat"], client=client)
+    expected = ("tt0000001", "tt0000002", "tt0000003")
+    assert result == {"Alien": expected, "Heat": expected}
+    assert len(client.single_requests) == 2
+
+
+def test_missing_title_falls_back():
+    client = FakeChatCompletion(json.dumps({"Alien": IDS["Alien"], "Heat": IDS["Heat"]}))
+    result = gpt.gpt_recomendation_batch(list(IDS), client=client)
+    assert result["Alien"] == tuple(IDS["Alien"])
+    assert result["Up"] == ("tt0000001", "tt0000002", "tt0000003")
+    assert len(client.single_requests) == 1
+    assert "'Up'" in client.single_requests[0]
+
+
+def test_invalid_ids_are_left_out():
+    answer = json.dumps({"Alien": ["tt0090605", "tt0103644"], "Heat": ["tt01", "x", "tt0407887"],
+                         "Up": IDS["Up"]})
+    client = FakeChatCompletion(answer, single_answer="I don't know")
+    result = gpt.gpt_recomendation_batch(list(IDS), client=client)
+    assert result == {"Up": tuple(IDS["Up"])}
+    assert len(client.single_requests) == 2
+
+
+def test_rate_limited_returns_results_so_far(monkeypatch):
+    monkeypatch.setattr(gpt, "BATCH_SIZE", 1)
+    limiter = SharedRateLimiter(rate_limit._shared.path, limits={'openai': (2, 1e-9)}, policy='fail')
+    monkeypatch.setattr(rate_limit, "_shared", limiter)
+    client = FakeChatCompletion(json.dumps(IDS))
+    result = gpt.gpt_recomendation_batch(list(IDS), client=client)
+    assert result == {"Alien": tuple(IDS["Alien"]), "Heat": tuple(IDS["Heat"])}
+    assert len(client.prompts) == 2
+
+
+class FakeDataManager:
+    """movies_without_recommendations/save_recommendations of a catalog of the IDS titles, without OMDb lookup"""
+
+    def __init__(self):
+        self.saved = {}
+
+    def movies_without_recommendations(self):
+        return [(movie_id, title) for movie_id, title in enumerate(IDS, 1) if movie_id not in self.saved]
+
+    def save_recommendations(self, recommendations):
+        self.saved.update(recommendations)
+        return len(recommendations)
+
+    def close_session(self):
+        pass
+
+
+def test_backfill_stops_over_the_rate_limit(monkeypatch):
+    backfill_recommendations = pytest.importorskip("backfill_recommendations")
+    limiter = SharedRateLimiter(rate_limit._shared.path, limits={'openai': (2, 1e-9)}, policy='fail')
+    monkeypatch.setattr(rate_limit, "_shared", limiter)
+    data_manager = FakeDataManager()
+    assert backfill_recommendations.backfill(data_manager, batch_size=1, client=FakeChatCompletion(
+        json.dumps(IDS))) == 2
+    assert [title for movie_id, title in data_manager.movies_without_recommendations()] == ["Up"]
+
+
+def test_backfill_waits_for_the_rate_limit(monkeypatch):
+    backfill_recommendations = pytest.importorskip("backfill_recommendations")
+    monkeypatch.setattr(gpt, "BATCH_SIZE", 1)
+    limiter = SharedRateLimiter(rate_limit._shared.path, limits={'openai': (1, 20)}, policy='fail')
+    monkeypatch.setattr(rate_limit, "_shared", limiter)
+    data_manager = FakeDataManager()
+    client = FakeChatCompletion(json.dumps(IDS))
+    assert backfill_recommendations.backfill(data_manager, batch_size=3, client=client) == 3
+    assert data_manager.movies_without_recommendations() == []
+    assert len(client.prompts) == 3
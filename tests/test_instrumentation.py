@@ -0,0 +1,20 @@
+"""instrumentation: timings of the calls made by the threads of a pool for a request"""
+from concurrent.futures import ThreadPoolExecutor
+
+from datamanager import instrumentation
+from datamanager.instrumentation import begin_request, carry_timings, end_request, timed
+
+
+def test_pool_calls_are_recorded_in_the_request(monkeypatch):
+    monkeypatch.setattr(instrumentation, "recent_requests", type(instrumentation.recent_requests)(maxlen=1))
+    fetch = timed(lambda item: item * 2, "http.fake", 'http')
+    token = begin_request("GET /import", profile=False)
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        assert list(pool.map(carry_timings(fetch), range(6))) == [0, 2, 4, 6, 8, 10]
+    end_request(token, 200, profile=False)
+    assert instrumentation.recent_requests[-1]['timings']['http']['count'] == 6
+
+
+def test_nothing_to_carry_outside_a_request():
+    function = timed(lambda: None, "http.fake", 'http')
+    assert carry_timings(function) is function
@@ -0,0 +1,72 @@
+"""ItemItemRecommender: the deltas of library changes give the same similarities as a matrix built from scratch"""
+import pytest
+from sqlalchemy import text
+
+pytest.importorskip("numpy")
+from datamanager.database import UserMovie
+from datamanager.recommender import ItemItemRecommender
+
+
+@pytest.fixture
+def manager(make_data_manager):
+    manager = make_data_manager(recommender='local')
+    with manager.engine.connect() as conn:
+        manager.test_movies = conn.execute(text("SELECT movie_id FROM movies ORDER BY movie_id LIMIT 8")).scalars()
+        manager.test_movies = manager.test_movies.all()
+        manager.test_users = conn.execute(text("SELECT user_id FROM user_data ORDER BY user_id LIMIT 3")).scalars()
+        manager.test_users = manager.test_users.all()
+    # the matrix exists before the changes: they go to the deltas
+    manager.recommender.similar(manager.test_movies[0])
+    return manager
+
+
+def assert_same_as_fresh_build(manager):
+    fresh = ItemItemRecommender(manager.read_engine)
+    for movie_id in manager.test_movies:
+        assert sorted(manager.recommender.similar(movie_id, k=50)) == sorted(fresh.similar(movie_id, k=50))
+
+
+def add_rows(manager, rows):
+    """Add (user_id, movie_id) rows missing from the libraries in one flush"""
+    session = manager.Session()
+    for user_id, movie_id in rows:
+        if not session.query(UserMovie).filter_by(user_id=user_id, movie_id=movie_id).first():
+            session.add(UserMovie(user_id=user_id, movie_id=movie_id))
+    session.commit()
+    manager.close_session()
+
+
+def test_deltas_match_a_fresh_build(manager):
+    movies, users = manager.test_movies, manager.test_users
+    add_rows(manager, [(user_id, movie_id) for user_id in users[:2] for movie_id in movies[:4]])
+    # rolled back: not counted
+    session = manager.Session()
+    session.add(UserMovie(user_id=users[2], movie_id=movies[5]))
+    session.flush()
+    session.rollback()
+    manager.close_session()
+    manager.add_from_rec(users[2], movies[0])
+    manager.close_session()
+    manager.add_from_rec(users[2], movies[1])
+    manager.close_session()
+    manager.delete_movie(users[0], movies[3])
+    manager.close_session()
+    assert manager.recommender._changes > 0
+    assert_same_as_fresh_build(manager)
+
+
+def test_changes_committed_during_a_rebuild_are_kept(manager, monkeypatch):
+    recommender = manager.recommender
+    movies, users = manager.test_movies, manager.test_users
+    build = recommender._build
+
+    def build_then_change():
+        state = build()
+        # committed after the build read its rows
+        add_rows(manager, [(users[1], movies[6]), (users[2], movies[6]), (users[1], movies[7])])
+        return state
+    monkeypatch.setattr(recommender, "_build", build_then_change)
+    recommender._rebuild()
+    monkeypatch.undo()
+    assert recommender._changes > 0
+    assert_same_as_fresh_build(manager)
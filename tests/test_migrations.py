@@ -0,0 +1,29 @@
+"""Schema migrations on a copy of the sample database at version 0"""
+import os
+import shutil
+import sqlite3
+
+from sqlalchemy import create_engine
+
+from datamanager.migrations import MIGRATIONS, migrate, schema_version
+
+SAMPLE_DATABASE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "datamanager",
+                               "movies.sqlite")
+
+
+def test_duplicate_library_rows_keep_ratings_and_notes(tmp_path):
+    path = str(tmp_path / "movies.sqlite")
+    shutil.copyfile(SAMPLE_DATABASE, path)
+    with sqlite3.connect(path) as conn:
+        conn.execute("DELETE FROM user_movies WHERE user_id = 1 AND movie_id IN (1, 2)")
+        conn.executemany("INSERT INTO user_movies (user_id, movie_id, user_rating, user_notes) VALUES (?, ?, ?, ?)",
+                         [(1, 1, None, None), (1, 1, 7.5, None), (1, 1, 3, "good"),
+                          (1, 2, 5, None), (1, 2, None, "seen twice")])
+    engine = create_engine("sqlite:///" + path)
+    migrate(engine)
+    assert schema_version(engine) == MIGRATIONS[-1][0]
+    engine.dispose()
+    with sqlite3.connect(path) as conn:
+        rows = conn.execute("SELECT movie_id, user_rating, user_notes FROM user_movies "
+                            "WHERE user_id = 1 AND movie_id IN (1, 2) ORDER BY movie_id").fetchall()
+    assert rows == [(1, 7.5, "good"), (2, 5.0, "seen twice")]
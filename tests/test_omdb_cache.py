@@ -0,0 +1,64 @@
+"""OmdbCache: TTLs, throttled LRU touches and eviction"""
+import sqlite3
+import threading
+
+from datamanager import omdb_cache
+from datamanager.omdb_cache import OmdbCache
+
+
+def accessed_at(cache, key):
+    with sqlite3.connect(cache.path) as conn:
+        return conn.execute("SELECT accessed_at FROM omdb_cache WHERE cache_key = ?", (key,)).fetchone()[0]
+
+
+def test_hits_misses_and_ttl(tmp_path):
+    cache = OmdbCache(str(tmp_path / "cache.sqlite"), miss_ttl=0)
+    cache.put("i:tt1", {"Title": "Alien"})
+    cache.put("t:nothing", None)
+    assert cache.get("i:tt1") == (True, {"Title": "Alien"})
+    # the negative entry expired at once and is removed
+    assert cache.get("t:nothing") == (False, None)
+    assert cache.get("t:other") == (False, None)
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'entries': 1}
+
+
+def test_hits_touch_only_old_entries(tmp_path, monkeypatch):
+    cache = OmdbCache(str(tmp_path / "cache.sqlite"))
+    cache.put("i:tt1", {"Title": "Alien"})
+    stored = accessed_at(cache, "i:tt1")
+    cache.get("i:tt1")
+    assert accessed_at(cache, "i:tt1") == stored
+    monkeypatch.setattr(omdb_cache, "TOUCH_INTERVAL", -1)
+    cache.get("i:tt1")
+    assert accessed_at(cache, "i:tt1") > stored
+
+
+def test_eviction_every_n_puts(tmp_path, monkeypatch):
+    monkeypatch.setattr(omdb_cache, "EVICT_EVERY", 5)
+    cache = OmdbCache(str(tmp_path / "cache.sqlite"), max_entries=3)
+    for number in range(4):
+        cache.put(f"i:tt{number}", {"n": number})
+    assert cache.stats()['entries'] == 4
+    cache.put("i:tt4", {"n": 4})
+    assert cache.stats()['entries'] == 3
+    assert cache.get("i:tt0") == (False, None)
+    assert cache.get("i:tt4") == (True, {"n": 4})
+
+
+def test_threads_use_their_own_connection(tmp_path):
+    cache = OmdbCache(str(tmp_path / "cache.sqlite"))
+    cache.put("i:tt1", {"Title": "Alien"})
+    results, connections = [], []
+    barrier = threading.Barrier(4)
+
+    def lookup():
+        connections.append(cache._connection())
+        results.append(cache.get("i:tt1"))
+        barrier.wait()
+    threads = [threading.Thread(target=lookup) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [(True, {"Title": "Alien"})] * 4
+    assert len({id(conn) for conn in connections + [cache._connection()]}) == 5
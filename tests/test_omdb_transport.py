@@ -0,0 +1,144 @@
+"""OmdbTransport and OmdbClient against a local stub of OMDb (stdlib http.server, no network)"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from datamanager.omdb import OmdbClient
+from datamanager.omdb_cache import OmdbCache
+from datamanager.omdb_transport import CircuitBreaker, OmdbTransport, OmdbUnavailable
+from datamanager.rate_limit import SharedRateLimiter
+
+ALIEN = {"Title": "Alien", "imdbID": "tt0078748", "Year": "1979", "Response": "True"}
+NOT_FOUND = {"Response": "False", "Error": "Movie not found!"}
+LIMIT_REACHED = {"Response": "False", "Error": "Request limit reached!"}
+
+
+class StubOmdb:
+    """OMDb stub: answers the requests with the scripted responses in order (the last one is repeated).
+    A response is an HTTP status (int), ('sleep', seconds) or a dict sent as JSON"""
+
+    def __init__(self):
+        self.responses = [ALIEN]
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests.append(self.path)
+                index = min(len(stub.requests), len(stub.responses)) - 1
+                response = stub.responses[index]
+                if isinstance(response, tuple):
+                    time.sleep(response[1])
+                    response = ALIEN
+                if isinstance(response, int):
+                    self.send_response(response)
+                    self.end_headers()
+                    return
+                body = json.dumps(response).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/?apikey=test&"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    server = StubOmdb()
+    yield server
+    server.close()
+
+
+def make_transport(stub, **options):
+    options = {'max_retries': 2, 'backoff_base': 0, 'read_timeout': 1, **options}
+    return OmdbTransport(stub.url, **options)
+
+
+def make_client(stub, tmp_path, **options):
+    limiter = SharedRateLimiter(str(tmp_path / "rate_limit.sqlite"))
+    return OmdbClient(cache=OmdbCache(str(tmp_path / "omdb_cache.sqlite")), transport=make_transport(stub, **options),
+                      limiter=limiter)
+
+
+def test_retries_server_errors(stub):
+    stub.responses = [503, 500, ALIEN]
+    assert make_transport(stub).get_json("t=Alien") == ALIEN
+    assert len(stub.requests) == 3
+
+
+def test_gives_up_after_max_retries(stub):
+    stub.responses = [500]
+    transport = make_transport(stub)
+    with pytest.raises(OmdbUnavailable):
+        transport.get_json("t=Alien")
+    assert len(stub.requests) == 3
+    assert transport.breaker.failures == 1
+
+
+def test_retries_timeouts(stub):
+    stub.responses = [('sleep', 0.5), ALIEN]
+    assert make_transport(stub, read_timeout=0.1).get_json("t=Alien") == ALIEN
+    assert len(stub.requests) == 2
+
+
+def test_circuit_opens_and_recovers(stub):
+    stub.responses = [500, 500, ALIEN]
+    transport = make_transport(stub, max_retries=0, breaker=CircuitBreaker(failure_threshold=2, reset_timeout=0.2))
+    for _ in range(2):
+        with pytest.raises(OmdbUnavailable):
+            transport.get_json("t=Alien")
+    assert transport.breaker.is_open
+    # open: failed without a request
+    with pytest.raises(OmdbUnavailable):
+        transport.get_json("t=Alien")
+    assert len(stub.requests) == 2
+    # half-open after reset_timeout: the trial request succeeds and closes the circuit
+    time.sleep(0.25)
+    assert transport.get_json("t=Alien") == ALIEN
+    assert not transport.breaker.is_open
+
+
+def test_caches_found_movies_under_their_aliases(stub, tmp_path):
+    client = make_client(stub, tmp_path)
+    assert client.by_title("alien") == ALIEN
+    assert client.by_title("Alien") == ALIEN
+    assert client.by_imdbID("tt0078748") == ALIEN
+    assert len(stub.requests) == 1
+
+
+def test_caches_not_found(stub, tmp_path):
+    stub.responses = [NOT_FOUND]
+    client = make_client(stub, tmp_path)
+    assert client.by_title("Alein") is None
+    assert client.by_title("Alein") is None
+    assert len(stub.requests) == 1
+
+
+def test_does_not_cache_other_errors(stub, tmp_path):
+    stub.responses = [LIMIT_REACHED, ALIEN]
+    client = make_client(stub, tmp_path)
+    assert client.by_title("Alien") is None
+    assert client.by_title("Alien") == ALIEN
+    assert len(stub.requests) == 2
+
+
+def test_does_not_cache_unavailable(stub, tmp_path):
+    stub.responses = [500, 500, 500, ALIEN]
+    client = make_client(stub, tmp_path)
+    assert client.by_title("Alien") is None
+    assert client.by_title("Alien") == ALIEN
+    assert len(stub.requests) == 4
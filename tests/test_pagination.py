@@ -0,0 +1,57 @@
+"""Keyset pagination of libraries and reviews: page tokens round trip, tampered tokens are refused"""
+import base64
+import json
+
+import pytest
+from sqlalchemy import text
+
+from datamanager.SQLite_data_manager import SORT_KEYS, _decode_cursor, _encode_cursor
+
+
+def token(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+
+def test_cursor_round_trip():
+    for values in (["2001", 7], [8.5, 3], [None, 12], [-1.0, 1]):
+        assert _decode_cursor(_encode_cursor(values)) == values
+
+
+@pytest.mark.parametrize("cursor", ["not a token!", token({"key": 1}), token([1]), token([1, 2, 3]),
+                                    token([[1], 2]), token(["2001", "7"]), token([True, 1]), token(["a", 1.5])])
+def test_tampered_cursor(cursor, data_manager):
+    with pytest.raises(ValueError):
+        _decode_cursor(cursor)
+    with pytest.raises(ValueError):
+        data_manager.get_user_movies_rows(1, cursor=cursor)
+
+
+def all_pages(get_page, limit):
+    rows, cursor = get_page(None, limit)
+    while cursor is not None:
+        page, cursor = get_page(cursor, limit)
+        rows.extend(page)
+    return rows
+
+
+@pytest.mark.parametrize("sort", sorted(SORT_KEYS))
+def test_library_pages_cover_the_library_once(data_manager, sort):
+    whole, cursor = data_manager.get_user_movies_rows(1, sort, limit=500)
+    assert cursor is None and len(whole) > 7
+    pages = all_pages(lambda cursor, limit: data_manager.get_user_movies_rows(1, sort, cursor, limit), 7)
+    assert [movie['id'] for movie in pages] == [movie['id'] for movie in whole]
+
+
+def test_review_pages_break_date_ties(data_manager):
+    with data_manager.engine.begin() as conn:
+        movie_id = conn.execute(text("SELECT movie_id FROM movies ORDER BY movie_id LIMIT 1")).scalar()
+        conn.execute(text("INSERT INTO reviews (user_id, movie_id, review_title, review_text, review_rating, "
+                          "review_date) VALUES (1, :movie, :title, 'text', 5, :date)"),
+                     [{'movie': movie_id, 'title': f"review {number}", 'date': f"2024-01-0{1 + number % 3}"}
+                      for number in range(10)])
+    whole, cursor = data_manager.get_reviews_page(movie_id, limit=500)
+    pages = all_pages(lambda cursor, limit: data_manager.get_reviews_page(movie_id, cursor, limit), 3)
+    assert [review.review_id for review in pages] == [review.review_id for review in whole]
+    assert len({review.review_id for review in pages}) == len(whole) >= 10
+    assert [review.review_date for review in whole] == sorted((review.review_date for review in whole),
+                                                              reverse=True)
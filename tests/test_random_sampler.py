@@ -0,0 +1,28 @@
+"""RandomMovieSampler: ids kept up to date by add() and remove()"""
+from datamanager.random_sampler import RandomMovieSampler
+
+
+def loaded(data_manager):
+    sampler = RandomMovieSampler()
+    sampler.sample_ids(data_manager.Session(), 1)
+    return sampler
+
+
+def test_remove_and_add(data_manager):
+    sampler = loaded(data_manager)
+    ids = list(sampler._ids)
+    for movie_id in (ids[0], ids[-1], ids[len(ids) // 2], -1):
+        sampler.remove(movie_id)
+    sampler.add(10 ** 9)
+    sampler.add(10 ** 9)
+    expected = set(ids) - {ids[0], ids[-1], ids[len(ids) // 2]} | {10 ** 9}
+    assert sorted(sampler._ids) == sorted(expected)
+    assert {sampler._ids[index]: index for index in range(len(sampler._ids))} == sampler._positions
+    assert set(sampler.sample_ids(data_manager.Session(), len(ids))) == expected
+
+
+def test_remove_everything(data_manager):
+    sampler = loaded(data_manager)
+    for movie_id in list(sampler._ids):
+        sampler.remove(movie_id)
+    assert len(sampler._ids) == 0 and sampler._positions == {}
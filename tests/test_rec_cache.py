@@ -0,0 +1,97 @@
+"""RecommendationCache: one computation for concurrent callers of a title, in threads, processes and tasks"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+from datamanager import rec_cache
+from datamanager.rec_cache import RecommendationCache
+
+RESULT = ("tt0000001", "tt0000002", "tt0000003")
+
+
+class SlowCompute:
+    """compute(title) taking some time, counting its calls"""
+
+    def __init__(self, error=None):
+        self.calls = 0
+        self.error = error
+        self._lock = threading.Lock()
+
+    def __call__(self, title):
+        with self._lock:
+            self.calls += 1
+        time.sleep(0.2)
+        if self.error is not None:
+            raise self.error
+        return list(RESULT)
+
+
+def call_together(callers):
+    """Run the callers in threads started at the same time. Returns their results (or exceptions)"""
+    barrier = threading.Barrier(len(callers))
+    results = [None] * len(callers)
+
+    def run(index, caller):
+        barrier.wait()
+        try:
+            results[index] = caller()
+        except Exception as error:
+            results[index] = error
+    threads = [threading.Thread(target=run, args=item) for item in enumerate(callers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+@pytest.fixture
+def path(tmp_path, monkeypatch):
+    monkeypatch.setattr(rec_cache, "POLL_INTERVAL", 0.02)
+    return str(tmp_path / "rec_cache.sqlite")
+
+
+def test_threads_share_one_computation(path):
+    cache, compute = RecommendationCache(path), SlowCompute()
+    titles = ["The Matrix", "the  matrix", " THE MATRIX "] * 3
+    assert call_together([lambda title=title: cache.get(title, compute) for title in titles]) == [RESULT] * 9
+    assert compute.calls == 1
+    assert cache.get("The Matrix", compute) == RESULT and compute.calls == 1
+
+
+def test_processes_share_one_computation_through_the_lease(path):
+    # two caches on one file stand for two processes: the second waits for the lease holder's result
+    caches, compute = [RecommendationCache(path), RecommendationCache(path)], SlowCompute()
+    assert call_together([lambda cache=cache: cache.get("Heat", compute) for cache in caches * 3]) == [RESULT] * 6
+    assert compute.calls == 1
+
+
+def test_error_reaches_every_waiter_and_nothing_is_stored(path):
+    cache, compute = RecommendationCache(path), SlowCompute(error=RuntimeError("upstream down"))
+    results = call_together([lambda: cache.get("Alien", compute)] * 4)
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert compute.calls == 1
+    compute.error = None
+    assert cache.get("Alien", compute) == RESULT and compute.calls == 2
+
+
+def test_refresh_computes_again(path):
+    cache, compute = RecommendationCache(path), SlowCompute()
+    cache.get("Up", compute)
+    assert cache.get("Up", compute, refresh=True) == RESULT and compute.calls == 2
+
+
+def test_tasks_share_one_computation(path):
+    cache, calls = RecommendationCache(path), []
+
+    async def compute(title):
+        calls.append(title)
+        await asyncio.sleep(0.1)
+        return list(RESULT)
+
+    async def main():
+        return await asyncio.gather(*(cache.get_async(title, compute) for title in ["Up", "up", " UP"] * 2))
+    assert asyncio.run(main()) == [RESULT] * 6
+    assert len(calls) == 1
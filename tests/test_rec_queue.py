@@ -0,0 +1,67 @@
+"""RecommendationQueue and the recommendation worker, on the test database"""
+import time
+
+import pytest
+
+import recommend_worker
+from datamanager.rate_limit import RateLimited
+from datamanager.rec_queue import MAX_ATTEMPTS
+
+
+@pytest.fixture
+def queue(data_manager):
+    return data_manager.rec_queue
+
+
+def movie_id(data_manager):
+    return data_manager.random_movies(1)[0].id
+
+
+def test_claim_complete(data_manager, queue):
+    movie = movie_id(data_manager)
+    queue.enqueue(movie, user_id=3)
+    job_id, claimed, fresh, user_id = queue.claim()
+    assert (claimed, fresh, user_id) == (movie, False, 3)
+    assert queue.status(movie) == 'running'
+    queue.complete(job_id)
+    assert queue.status(movie) == 'done'
+
+
+def test_failed_after_max_attempts(data_manager, queue):
+    movie = movie_id(data_manager)
+    queue.enqueue(movie)
+    for _ in range(MAX_ATTEMPTS):
+        job_id = queue.claim()[0]
+        queue.fail(job_id, "error")
+    assert queue.status(movie) == 'failed'
+    # page views don't retry it, an explicit request does
+    queue.enqueue(movie, retry_failed=False)
+    assert queue.status(movie) == 'failed'
+    queue.enqueue(movie)
+    assert queue.status(movie) == 'pending'
+
+
+def test_released_job_waits_for_its_delay(data_manager, queue):
+    movie = movie_id(data_manager)
+    queue.enqueue(movie)
+    job_id = queue.claim()[0]
+    queue.release(job_id, delay=0.2)
+    assert queue.status(movie) == 'pending'
+    assert queue.claim() is None
+    time.sleep(0.25)
+    assert queue.claim()[0] == job_id
+
+
+def test_worker_keeps_jobs_of_a_spent_budget(data_manager, queue, monkeypatch):
+    movie = movie_id(data_manager)
+    queue.enqueue(movie, user_id=2)
+
+    def over_budget(movie_id, fresh=False, user_id=None):
+        raise RateLimited(f"openai:user:{user_id}", 3600)
+    monkeypatch.setattr(data_manager, "compute_recommendations", over_budget)
+    monkeypatch.setattr(recommend_worker, "SQLiteDataManager", lambda *args, **kwargs: data_manager)
+    for _ in range(MAX_ATTEMPTS + 1):
+        recommend_worker.run_worker("unused", once=True)
+    # not failed, no attempt counted: taken again once the budget has a token
+    assert queue.status(movie) == 'pending'
+    assert queue.claim() is None
@@ -0,0 +1,42 @@
+"""review_stats: the aggregates updated by add_review equal the ones of a full rebuild"""
+from datetime import date
+
+from sqlalchemy import text
+
+from datamanager import review_stats
+from datamanager.review_stats import bucket, rating_value
+
+RATINGS = [7, 0, 42, 6.5, None, 10, 1, 2.5, 9.49]
+
+
+def test_rating_rule():
+    assert [rating_value(rating) for rating in (0, 1, "7", "seven", 10.5, None)] == [None, 1.0, 7.0, None, None, None]
+    assert [bucket(rating) for rating in (1, 2.5, 6.49, 10, 0)] == [0, 2, 5, 9, None]
+
+
+def stats(data_manager, movie_ids):
+    with data_manager.engine.connect() as conn:
+        return conn.execute(text("SELECT * FROM review_stats WHERE movie_id IN (:first, :second) ORDER BY movie_id"),
+                            {'first': movie_ids[0], 'second': movie_ids[1]}).all()
+
+
+def test_incremental_stats_match_a_rebuild(data_manager):
+    with data_manager.engine.connect() as conn:
+        reviewed = conn.execute(text("SELECT movie_id FROM reviews WHERE movie_id IS NOT NULL LIMIT 1")).scalar()
+        unreviewed = conn.execute(text("SELECT movie_id FROM movies WHERE movie_id NOT IN "
+                                       "(SELECT movie_id FROM reviews WHERE movie_id IS NOT NULL) LIMIT 1")).scalar()
+    movie_ids = sorted((reviewed, unreviewed))
+    for number, rating in enumerate(RATINGS):
+        for movie_id in movie_ids:
+            data_manager.add_review({'user_id': 1 + number % 5, 'movie_id': movie_id, 'review_title': "title",
+                                     'review_text': "text", 'review_rating': rating,
+                                     'review_date': date(2024, 1 + number, 1)})
+    data_manager.close_session()
+    incremental = stats(data_manager, movie_ids)
+    assert len(incremental) == 2
+    review_stats.rebuild(data_manager.engine)
+    rebuilt = stats(data_manager, movie_ids)
+    assert [row[:3] + row[5:] for row in incremental] == [row[:3] + row[5:] for row in rebuilt]
+    for new, full in zip(incremental, rebuilt):
+        assert abs(new.rating_sum - full.rating_sum) < 1e-9 and abs(new.rating_mean - full.rating_mean) < 1e-9
+    assert data_manager.review_stats(unreviewed)['rating_count'] == 6
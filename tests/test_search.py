@@ -0,0 +1,26 @@
+"""search.starts_with and SQLiteDataManager.search_movies ranking, on the full-text index of the test database"""
+from datamanager.search import starts_with
+
+
+def test_starts_with():
+    assert starts_with("The Matrix", "matr")
+    assert starts_with("The Matrix", "the matrix")
+    assert starts_with("Star Wars: Episode I", "star wa")
+    assert not starts_with("Robot Chicken: Star Wars", "star wars")
+    assert not starts_with("The Matrix", "")
+
+
+def titles(data_manager, query, limit=5):
+    return [movie['title'] for movie in data_manager.search_movies(query, limit, fuzzy=False)]
+
+
+def test_prefix_query_ranks_the_shorter_title_first(data_manager):
+    assert data_manager.fts
+    assert titles(data_manager, "matr") == ["The Matrix", "The Matrix Revolutions"]
+    assert titles(data_manager, "matrix rev") == ["The Matrix Revolutions"]
+
+
+def test_titles_starting_with_the_query_first(data_manager):
+    result = titles(data_manager, "star wars", limit=10)
+    assert result[-1] == "Robot Chicken: Star Wars"
+    assert all(title.startswith("Star Wars") for title in result[:-1])
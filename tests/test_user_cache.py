@@ -0,0 +1,66 @@
+"""UserCache: invalidation on commit, and no caching of a user loaded while it was invalidated"""
+from datamanager.database import User
+from datamanager.user_cache import SQLiteInvalidationLog, UserCache
+
+
+def load_with(data_manager):
+    def load(user_id):
+        user = data_manager.Session().get(User, user_id)
+        data_manager.close_session()
+        return user
+    return load
+
+
+def test_invalidated_when_the_change_commits(data_manager):
+    cache = UserCache()
+    cache.watch(User)
+    load = load_with(data_manager)
+    assert cache.get(1, load).username is not None
+    session = data_manager.Session()
+    user = session.get(User, 1)
+    user.username = "renamed"
+    session.flush()
+    # flushed, not committed: other requests still read the old row, the entry stays
+    assert 1 in cache._entries
+    session.commit()
+    data_manager.close_session()
+    assert 1 not in cache._entries
+    assert cache.get(1, load).username == "renamed"
+
+
+def test_rolled_back_change_does_not_invalidate(data_manager):
+    cache = UserCache()
+    cache.watch(User)
+    cache.get(1, load_with(data_manager))
+    session = data_manager.Session()
+    session.get(User, 1).username = "never"
+    session.flush()
+    session.rollback()
+    data_manager.close_session()
+    assert 1 in cache._entries
+
+
+def test_user_invalidated_while_loading_is_not_cached(data_manager):
+    cache = UserCache()
+    load = load_with(data_manager)
+
+    def load_then_invalidate(user_id):
+        # the row read here is outdated by a commit made meanwhile
+        user = load(user_id)
+        cache.invalidate(user_id)
+        return user
+    assert cache.get(1, load_then_invalidate) is not None
+    assert 1 not in cache._entries
+    cache.get(1, load)
+    assert 1 in cache._entries
+
+
+def test_invalidations_are_shared(tmp_path, data_manager):
+    log = str(tmp_path / "user_cache.sqlite")
+    first, second = UserCache(backend=SQLiteInvalidationLog(log)), UserCache(backend=SQLiteInvalidationLog(log))
+    load = load_with(data_manager)
+    second.get(1, load)
+    first.invalidate(1)
+    second._checked_at = 0
+    second.get(2, load)
+    assert 1 not in second._entries